@@ -10,11 +10,18 @@ from __future__ import annotations
 import argparse
 import importlib
 import importlib.util
+import io
 import os
 import sys
-from collections.abc import Iterable, Iterator, Sequence
-from types import ModuleType
-from typing import IO, Any, Callable, Tuple, Type, Union
+from collections.abc import Generator, Iterable, Iterator, Mapping, MutableMapping, Sequence
+from contextlib import AbstractContextManager, ExitStack, contextmanager, nullcontext, suppress
+from types import ModuleType, TracebackType
+from typing import IO, TYPE_CHECKING, Any, Callable, ClassVar, Tuple, Type, Union
+
+if TYPE_CHECKING:
+    from jinja2 import BaseLoader, Environment, Template
+    from jinja2.ext import Extension
+    from typing_extensions import Self
 
 
 class InvalidDataFormat(Exception):
@@ -29,6 +36,10 @@ class InvalidInputData(Exception):
     pass
 
 
+class StaleDataSnapshot(InvalidUsage):
+    pass
+
+
 class MalformedJSON(InvalidInputData):
     pass
 
@@ -65,10 +76,86 @@ class MalformedJSON5(InvalidDataFormat):
     pass
 
 
-ParserFn = Callable[[str], Any]
+class MalformedCSV(InvalidDataFormat):
+    pass
+
+
+class MalformedMsgPack(InvalidDataFormat):
+    pass
+
+
+class MalformedCBOR(InvalidDataFormat):
+    pass
+
+
+class FetchError(InvalidInputData):
+    pass
+
+
+class ResourceLimitExceeded(Exception):
+    pass
+
+
+class MemoryLimitExceeded(ResourceLimitExceeded):
+    pass
+
+
+class OutputTooLarge(ResourceLimitExceeded):
+    pass
+
+
+class RenderTimeout(ResourceLimitExceeded):
+    pass
+
+
+class OperationBudgetExceeded(ResourceLimitExceeded):
+    pass
+
+
+ParserFn = Callable[[Any], Any]
 FormatLoadResult = Tuple[ParserFn, Type[Exception], Type[Exception]]
 ExtensionSpec = Union[str, ModuleType, Type[Any]]
 
+# Buffer size used when writing rendered output to files
+WRITE_BUFFER_SIZE = 256 * 1024
+
+# Options that don't affect rendered content, and so are left out of cache keys
+CACHE_EXCLUDED_OPTIONS = (
+    "template",
+    "data",
+    "outfile",
+    "archive",
+    "each",
+    "if_changed",
+    "manifest",
+    "cache_dir",
+    "cache_ttl",
+    "cache_max_size",
+    "output_encoding",
+    "buffer_size",
+    "memory_report",
+    "max_memory",
+    "max_output_bytes",
+    "timeout",
+    "max_operations",
+    "index_templates",
+    "template_index_file",
+    "profile_template",
+    "filter_stats",
+    "memoize_filters",
+    "memoize_size",
+    "shard",
+    "shard_timings",
+    "record_timings",
+    "jobs",
+    "fragment_cache_dir",
+    "fragment_cache_size",
+    "url_cache",
+    "url_timeout",
+    "metrics",
+    "metrics_interval",
+)
+
 
 def get_format(fmt: str) -> FormatLoadResult:
     try:
@@ -77,6 +164,28 @@ def get_format(fmt: str) -> FormatLoadResult:
         raise InvalidDataFormat(fmt)
 
 
+def get_parser(fmt: str) -> FormatLoadResult:
+    """Like :func:`get_format`, with a hint on how to install missing formats."""
+    try:
+        return get_format(fmt)
+    except InvalidDataFormat:
+        if fmt in ("yml", "yaml"):
+            raise InvalidDataFormat(f"{fmt}: install pyyaml to fix")
+        if fmt == "toml":
+            raise InvalidDataFormat("toml: install tomli to fix")
+        if fmt == "xml":
+            raise InvalidDataFormat("xml: install xmltodict to fix")
+        if fmt == "hjson":
+            raise InvalidDataFormat("hjson: install hjson to fix")
+        if fmt == "json5":
+            raise InvalidDataFormat("json5: install json5 to fix")
+        if fmt == "msgpack":
+            raise InvalidDataFormat("msgpack: install msgpack to fix")
+        if fmt == "cbor":
+            raise InvalidDataFormat("cbor: install cbor2 to fix")
+        raise
+
+
 def has_format(fmt: str) -> bool:
     try:
         get_format(fmt)
@@ -220,6 +329,72 @@ def load_json5() -> FormatLoadResult:
     return json5.loads, Exception, MalformedJSON5
 
 
+def infer_scalar(value: str) -> Any:
+    """
+    Convert a CSV cell to an int, float or bool when it unambiguously is one.
+    Numbers that wouldn't round trip, like ``007`` or ``1e3``, stay strings.
+    """
+    lowered = value.lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    if not value or value[0] not in "-0123456789":
+        return value
+    try:
+        number = int(value)
+    except ValueError:
+        pass
+    else:
+        return number if str(number) == value else value
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if repr(number) == value else value
+
+
+def iter_csv_rows(lines: Iterable[str], delimiter: str) -> Iterator[dict]:
+    """Rows of a CSV file with a header line, with :func:`infer_scalar` applied."""
+    import csv
+
+    for row in csv.DictReader(lines, delimiter=delimiter, restkey="_extra"):
+        yield {
+            k: v if isinstance(v, list) or v is None else infer_scalar(v) for k, v in row.items()
+        }
+
+
+def load_csv() -> FormatLoadResult:
+    import csv
+
+    def _parse_csv(data: str) -> dict:
+        return {"rows": list(iter_csv_rows(io.StringIO(data), ","))}
+
+    return _parse_csv, csv.Error, MalformedCSV
+
+
+def load_tsv() -> FormatLoadResult:
+    import csv
+
+    def _parse_tsv(data: str) -> dict:
+        return {"rows": list(iter_csv_rows(io.StringIO(data), "\t"))}
+
+    return _parse_tsv, csv.Error, MalformedCSV
+
+
+def load_msgpack() -> FormatLoadResult:
+    import msgpack
+
+    def _parse_msgpack(data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    return _parse_msgpack, Exception, MalformedMsgPack
+
+
+def load_cbor() -> FormatLoadResult:
+    import cbor2
+
+    return cbor2.loads, cbor2.CBORDecodeError, MalformedCBOR
+
+
 # Global list of available format parsers on your system
 # mapped to the callable/Exception to parse a string into a dict
 formats = {
@@ -233,9 +408,688 @@ formats = {
     "env": load_env,
     "hjson": load_hjson,
     "json5": load_json5,
+    "csv": load_csv,
+    "tsv": load_tsv,
+    "msgpack": load_msgpack,
+    "cbor": load_cbor,
+}
+
+# Formats parsed from bytes rather than text
+binary_formats = {"msgpack", "cbor"}
+
+# CBOR's optional self-describe tag, the only way to recognize binary data on stdin
+CBOR_SELF_DESCRIBE = b"\xd9\xd9\xf7"
+
+# Formats of data fetched from URLs, by Content-Type
+content_types = {
+    "application/json": "json",
+    "text/json": "json",
+    "application/yaml": "yaml",
+    "application/x-yaml": "yaml",
+    "text/yaml": "yaml",
+    "text/x-yaml": "yaml",
+    "application/toml": "toml",
+    "application/xml": "xml",
+    "text/xml": "xml",
+    "text/csv": "csv",
+    "text/tab-separated-values": "tsv",
+    "application/x-www-form-urlencoded": "querystring",
+    "application/hjson": "hjson",
+    "application/json5": "json5",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/cbor": "cbor",
+}
+
+
+def xml_element_to_data(elem: Any) -> Any:
+    """
+    Convert an ElementTree element to the same shape ``xmltodict`` produces:
+    attributes as ``@name`` keys, text as ``#text`` when mixed with other
+    keys, repeated children as lists, and empty elements as ``None``.
+    """
+    result: dict[str, Any] = {f"@{k}": v for k, v in elem.attrib.items()}
+    for child in elem:
+        value = xml_element_to_data(child)
+        if child.tag in result:
+            existing = result[child.tag]
+            if isinstance(existing, list):
+                existing.append(value)
+            else:
+                result[child.tag] = [existing, value]
+        else:
+            result[child.tag] = value
+
+    text = (elem.text or "").strip()
+    if not result:
+        return text or None
+    if text:
+        result["#text"] = text
+    return result
+
+
+class LazyXML:
+    """
+    Lazily parsed stream of the elements in an XML file matching a selector,
+    each converted to a dict as it's parsed.
+
+    The selector is a ``/`` separated path of tags matched against the end of
+    each element's path, e.g. ``item`` or ``inventory/item``. Without one, the
+    children of the root element are used. Elements are dropped from the tree
+    as soon as they've been handled, so memory stays bounded by the size of a
+    single element rather than the whole document.
+
+    Every iteration re-reads the file.
+    """
+
+    def __init__(self, path: str, selector: str | None = None) -> None:
+        self.path = path
+        self.selector = [tag for tag in (selector or "").split("/") if tag]
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path!r} {self.selector!r}>"
+
+    def cache_token(self) -> str:
+        """Identifies the current content of the source, see :func:`data_digest`."""
+        st = os.stat(self.path)
+        return f"{self!r} {st.st_mtime_ns} {st.st_size}"
+
+    def _matches(self, path: list[str]) -> bool:
+        if not self.selector:
+            return len(path) == 2
+        return path[-len(self.selector) :] == self.selector
+
+    def __iter__(self) -> Iterator[Any]:
+        from xml.etree import ElementTree
+
+        try:
+            with open_data(self.path, binary=True) as fp:
+                yield from self._collect(ElementTree.iterparse(fp, events=("start", "end")))
+        except ElementTree.ParseError as e:
+            raise MalformedXML(f"{self.path}: {e}")
+
+    def _collect(self, events: Iterable[tuple[str, Any]]) -> Iterator[Any]:
+        path: list[str] = []
+        stack: list[Any] = []
+        # Depth of the element currently being collected, if any
+        collecting: int | None = None
+        for event, elem in events:
+            if event == "start":
+                path.append(elem.tag)
+                stack.append(elem)
+                if collecting is None and self._matches(path):
+                    collecting = len(path)
+                continue
+
+            depth = len(path)
+            if collecting == depth:
+                collecting = None
+                yield xml_element_to_data(elem)
+            path.pop()
+            stack.pop()
+            if collecting is None:
+                # Nothing below here is needed anymore
+                if stack:
+                    stack[-1].remove(elem)
+                else:
+                    elem.clear()
+
+
+class LazyJSONLines:
+    """
+    Lazily parsed stream of the records in a JSON Lines file, one JSON value
+    per line. Blank lines are skipped. Every iteration re-reads the file.
+    """
+
+    def __init__(self, path: str, selector: str | None = None) -> None:
+        if selector:
+            raise InvalidUsage(f"{path}: JSON Lines files don't take a selector")
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path!r}>"
+
+    def cache_token(self) -> str:
+        """Identifies the current content of the source, see :func:`data_digest`."""
+        st = os.stat(self.path)
+        return f"{self!r} {st.st_mtime_ns} {st.st_size}"
+
+    def __iter__(self) -> Iterator[Any]:
+        import json
+
+        with open_data(self.path, binary=True) as fp:
+            for lineno, line in enumerate(fp, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise MalformedJSON(f"{self.path}:{lineno}: {e}")
+
+
+class LazyJSON:
+    """
+    Lazily parsed stream of the values in a JSON document, using ijson's
+    incremental parser. The selector is an ijson prefix, defaulting to
+    ``item``: the items of a top-level array. Every iteration re-reads the
+    file.
+    """
+
+    def __init__(self, path: str, selector: str | None = None) -> None:
+        import ijson  # noqa: F401 - fail early when it isn't installed
+
+        self.path = path
+        self.selector = selector or "item"
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path!r} {self.selector!r}>"
+
+    def cache_token(self) -> str:
+        """Identifies the current content of the source, see :func:`data_digest`."""
+        st = os.stat(self.path)
+        return f"{self!r} {st.st_mtime_ns} {st.st_size}"
+
+    def __iter__(self) -> Iterator[Any]:
+        import ijson
+
+        with open_data(self.path, binary=True) as fp:
+            try:
+                yield from ijson.items(fp, self.selector, use_float=True)
+            except ijson.JSONError as e:
+                raise MalformedJSON(f"{self.path}: {e}")
+
+
+class LazyCSV:
+    """
+    Lazily parsed stream of the rows in a CSV (or TSV) file with a header
+    line, as dicts with :func:`infer_scalar` applied. Every iteration re-reads
+    the file.
+    """
+
+    def __init__(self, path: str, selector: str | None = None) -> None:
+        if selector:
+            raise InvalidUsage(f"{path}: CSV files don't take a selector")
+        self.path = path
+        self.delimiter = "\t" if data_extension(path) == "tsv" else ","
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path!r}>"
+
+    def cache_token(self) -> str:
+        """Identifies the current content of the source, see :func:`data_digest`."""
+        st = os.stat(self.path)
+        return f"{self!r} {st.st_mtime_ns} {st.st_size}"
+
+    def __iter__(self) -> Iterator[dict]:
+        import csv
+
+        with open_data(self.path, newline="") as fp:
+            try:
+                yield from iter_csv_rows(fp, self.delimiter)
+            except csv.Error as e:
+                raise MalformedCSV(f"{self.path}: {e}")
+
+
+class LazyArrow:
+    """
+    Lazily read stream of the rows in a Parquet or Arrow IPC (Feather) file,
+    converted to dicts one record batch at a time. The selector is an
+    optional comma separated list of columns to read, which for Parquet
+    means the other columns are never read from disk. Every iteration re-reads
+    the file.
+    """
+
+    # Rows converted to dicts at a time
+    BATCH_SIZE = 64 * 1024
+
+    def __init__(self, path: str, selector: str | None = None) -> None:
+        import pyarrow  # noqa: F401 - fail early when it isn't installed
+
+        self.path = path
+        self.columns = [c.strip() for c in selector.split(",")] if selector else None
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path!r} {self.columns!r}>"
+
+    def cache_token(self) -> str:
+        """Identifies the current content of the source, see :func:`data_digest`."""
+        st = os.stat(self.path)
+        return f"{self!r} {st.st_mtime_ns} {st.st_size}"
+
+    def _batches(self) -> Iterator[Any]:
+        if self.path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            yield from pq.ParquetFile(self.path).iter_batches(
+                batch_size=self.BATCH_SIZE, columns=self.columns
+            )
+            return
+
+        import pyarrow as pa
+
+        with pa.memory_map(self.path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if self.columns is not None:
+                    batch = batch.select(self.columns)
+                yield batch
+
+    def __iter__(self) -> Iterator[dict]:
+        for batch in self._batches():
+            yield from batch.to_pylist()
+
+
+# Global list of formats that can be bound lazily with --lazy, mapped
+# to a class taking the file path and an optional selector
+lazy_formats: dict[str, Callable[[str, str | None], Iterable[Any]]] = {
+    "xml": LazyXML,
+    "jsonl": LazyJSONLines,
+    "ndjson": LazyJSONLines,
+    "json": LazyJSON,
+    "csv": LazyCSV,
+    "tsv": LazyCSV,
+    "parquet": LazyArrow,
+    "arrow": LazyArrow,
+    "feather": LazyArrow,
+}
+
+
+def load_lazy(spec: str) -> tuple[str, Any]:
+    """
+    Parse a ``KEY=FILE[#SELECTOR]`` spec into the key and a lazy source for
+    the file, picking the kind of source by the file extension.
+    """
+    try:
+        key, target = spec.split("=", 1)
+    except ValueError:
+        raise InvalidUsage(f"--lazy expects KEY=FILE[#SELECTOR], got {spec!r}")
+    path, _, selector = target.partition("#")
+    path = os.path.join(os.getcwd(), os.path.expanduser(path))
+    ext = data_extension(path)
+    if ext not in lazy_formats:
+        raise InvalidDataFormat(f"{ext}: can't be loaded lazily")
+    if not os.path.isfile(path):
+        raise InvalidUsage(f"no such file: {path}")
+    try:
+        return key, lazy_formats[ext](path, selector or None)
+    except ModuleNotFoundError as e:
+        raise InvalidDataFormat(f"{ext}: install {e.name} to fix")
+
+
+# How much of stdin is inspected to guess its format
+SNIFF_SIZE = 4096
+
+# Size of the chunks stdin is read in
+READ_CHUNK_SIZE = 256 * 1024
+
+
+# Compression formats, by the file extension that selects them
+compressions = {
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".bz2": "bz2",
+    ".zst": "zstd",
+}
+
+
+def compression_for(path: str) -> str | None:
+    return compressions.get(os.path.splitext(path)[1].lower())
+
+
+# Magic bytes identifying compressed data, mapped to the compression
+compression_magic = {
+    b"\x1f\x8b": "gzip",
+    b"\xfd7zXZ\x00": "xz",
+    b"\x28\xb5\x2f\xfd": "zstd",
 }
 
 
+def sniff_compression(head: bytes) -> str | None:
+    """Identify compressed data by the magic bytes at its start (at least 10 bytes of it)."""
+    for magic, compression in compression_magic.items():
+        if head.startswith(magic):
+            return compression
+    # "BZh" alone could be plain text, so also check the block size and the
+    # magic of the first block (or of the end of an empty stream)
+    if head[:3] == b"BZh" and head[3:4].isdigit() and head[4:10] in (b"1AY&SY", b"\x17rE8P\x90"):
+        return "bz2"
+    return None
+
+
+def data_extension(path: str) -> str:
+    """The extension naming the format of a data file, ignoring any compression extension."""
+    root, ext = os.path.splitext(path)
+    if ext.lower() in compressions:
+        ext = os.path.splitext(root)[1]
+    return ext[1:]
+
+
+def decompress_stream(fileobj: IO[bytes], compression: str) -> IO[bytes]:
+    """Wrap a binary file object so reading from it decompresses on the fly."""
+    if compression == "gzip":
+        import gzip
+
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")  # ty: ignore[invalid-return-type] - a binary file, typeshed just doesn't declare it an IO[bytes]
+    if compression == "xz":
+        import lzma
+
+        return lzma.LZMAFile(fileobj, "rb")
+    if compression == "bz2":
+        import bz2
+
+        return bz2.BZ2File(fileobj, "rb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise InvalidDataFormat("zstd: install zstandard to fix")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+    raise InvalidDataFormat(f"unknown compression: {compression}")
+
+
+def open_data(path: str, binary: bool = False, newline: str | None = None) -> IO[Any]:
+    """
+    Open a data file for reading, transparently decompressing it when it
+    starts with the magic bytes of a supported compression.
+    """
+    # Buffered explicitly, for peek()
+    raw = io.BufferedReader(io.FileIO(path, "rb"), READ_CHUNK_SIZE)
+    try:
+        compression = sniff_compression(raw.peek(16)[:16])
+        if compression is None:
+            if binary:
+                return raw
+            raw.close()
+            return open(path, newline=newline)
+        stream = decompress_stream(raw, compression)
+    except BaseException:
+        raw.close()
+        raise
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, newline=newline)
+
+
+def stdin_encoding() -> str:
+    return getattr(sys.stdin, "encoding", None) or "utf8"
+
+
+class _PrefixedStream(io.RawIOBase):
+    """A raw binary stream reading ``prefix`` before the rest of ``stream``."""
+
+    def __init__(self, prefix: bytes, stream: IO[bytes]) -> None:
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        if self.prefix:
+            n = min(len(buffer), len(self.prefix))
+            buffer[:n] = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            return n
+        data = self.stream.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def read_stdin() -> bytes:
+    """
+    Read all of stdin as bytes in large chunks, rather than through the text
+    layer. Compressed input is decompressed chunk by chunk as it arrives.
+    """
+    stream = getattr(sys.stdin, "buffer", None)
+    if stream is None:
+        return sys.stdin.read().encode(stdin_encoding())
+
+    first = stream.read(READ_CHUNK_SIZE)
+    compression = sniff_compression(first)
+    if compression is None:
+        chunks = [first]
+        while True:
+            chunk = stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    # Only the first chunk has been consumed, so stitch it back in front
+    raw = io.BufferedReader(_PrefixedStream(first, stream), buffer_size=READ_CHUNK_SIZE)
+    with decompress_stream(raw, compression) as decompressed:
+        return decompressed.read()
+
+
+def is_url(path: str) -> bool:
+    return path.startswith(("http://", "https://"))
+
+
+def parse_content_type(value: str | None) -> tuple[str, str | None]:
+    """Split a Content-Type header into the lowercased media type and the charset, if any."""
+    if not value:
+        return "", None
+    media_type, *params = value.split(";")
+    charset = None
+    for param in params:
+        name, _, param_value = param.partition("=")
+        if name.strip().lower() == "charset":
+            charset = param_value.strip().strip('"') or None
+    return media_type.strip().lower(), charset
+
+
+def content_type_format(media_type: str) -> str | None:
+    """The format of data served as ``media_type``, including ``+json`` and ``+xml`` types."""
+    fmt = content_types.get(media_type)
+    if fmt is None and media_type.endswith(("+json", "+xml", "+yaml")):
+        fmt = media_type.rsplit("+", 1)[1]
+    if fmt is None or not has_format(fmt):
+        return None
+    return fmt
+
+
+class RemoteData:
+    """
+    Fetches data files given as ``http(s)://`` URLs, all at once on a pool
+    of threads. With a ``cache_dir``, responses are kept there and
+    revalidated with ``If-None-Match`` and ``If-Modified-Since``, so an
+    unchanged source is neither downloaded nor, see :meth:`load_parsed`,
+    parsed again.
+    """
+
+    def __init__(self, cache_dir: str | None = None, timeout: float = 30, workers: int = 8) -> None:
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.workers = workers
+        self.responses: dict[str, tuple[bytes, str | None, bool]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, url: str) -> str:
+        assert self.cache_dir is not None
+        key = RenderCache.key(url)
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch_all(self, urls: Iterable[str]) -> None:
+        """Fetch every URL not fetched yet, concurrently."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        urls = [url for url in dict.fromkeys(urls) if url not in self.responses]
+        if not urls:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as pool:
+            for url, response in zip(urls, pool.map(self.fetch, urls)):
+                self.responses[url] = response
+                if self.cache_dir:
+                    if response[2]:
+                        self.hits += 1
+                    else:
+                        self.misses += 1
+
+    def get(self, url: str) -> tuple[bytes, str | None, bool]:
+        """Return ``(body, content type, unchanged since cached)`` for ``url``."""
+        if url not in self.responses:
+            self.fetch_all([url])
+        return self.responses[url]
+
+    def fetch(self, url: str) -> tuple[bytes, str | None, bool]:
+        import json
+        import urllib.error
+        import urllib.request
+
+        from jinja2cli import __version__
+
+        cached = self._load(url) if self.cache_dir else None
+        headers = {"User-Agent": f"jinja2-cli/{__version__}"}
+        if cached is not None:
+            meta = cached[0]
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read()
+                content_type = response.headers.get("Content-Type")
+                meta = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "content_type": content_type,
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                meta, body = cached
+                return body, meta.get("content_type"), True
+            raise FetchError(f"{url}: HTTP {e.code} {e.reason}")
+        except (urllib.error.URLError, OSError) as e:
+            raise FetchError(f"{url}: {getattr(e, 'reason', e)}")
+
+        if self.cache_dir and (meta["etag"] or meta["last_modified"]):
+            self._store(url, json.dumps(meta).encode() + b"\n" + body)
+        return body, content_type, False
+
+    def _load(self, url: str) -> tuple[dict, bytes] | None:
+        import json
+
+        try:
+            with open(self._path(url), "rb") as fp:
+                meta = json.loads(fp.readline())
+                return meta, fp.read()
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, url: str, content: bytes, suffix: str = "") -> None:
+        import tempfile
+
+        path = self._path(url) + suffix
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "wb") as fp:
+                fp.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def _parsed_header(format: str, body: bytes) -> bytes:
+        import hashlib
+
+        return f"{format} {hashlib.sha256(body).hexdigest()}\n".encode()
+
+    def load_parsed(self, url: str, format: str) -> Any | None:
+        """
+        The data parsed from ``url`` by :meth:`save_parsed`, if it's still
+        unchanged on the server and was parsed as ``format``. These are
+        pickles, like data snapshots, so only point the cache at a directory
+        you alone write to.
+        """
+        import pickle
+
+        body, _, unchanged = self.get(url)
+        if not unchanged:
+            return None
+        try:
+            with open(self._path(url) + ".parsed", "rb") as fp:
+                if fp.readline() != self._parsed_header(format, body):
+                    return None
+                return pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def save_parsed(self, url: str, format: str, parsed: Any) -> None:
+        import pickle
+
+        body = self.get(url)[0]
+        if self.cache_dir is None or not os.path.exists(self._path(url)):
+            return
+        header = self._parsed_header(format, body)
+        try:
+            content = pickle.dumps(parsed, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        self._store(url, header + content, ".parsed")
+
+
+def sniff_formats(head: str) -> list[str]:
+    """
+    Guess the format of data from its first few KB, returning the formats to
+    try in order. Each guess is followed by yaml (or json, without pyyaml), so
+    anything that isn't recognized is parsed the way it always has been.
+    """
+    import re
+
+    lines = [
+        line.strip()
+        for line in head.lstrip("\ufeff").splitlines()
+        if line.strip() and not line.lstrip().startswith(("#", ";"))
+    ]
+    fallback = "yaml" if has_format("yaml") else "json"
+    if not lines:
+        return [fallback]
+
+    first = lines[0]
+    candidates: list[str] = []
+    if re.match(r"^\[[\w .\-\"']+\]$", first):
+        # A section header, TOML is the stricter of the two
+        candidates = ["toml", "ini"]
+    elif first[0] in "{[":
+        candidates = ["json"]
+    elif first[0] == "<":
+        candidates = ["xml"]
+    elif re.match(r"^[A-Za-z_][\w.\-]*=[^&]*$", first) and all("=" in line for line in lines):
+        candidates = ["env"]
+    elif re.match(r"^[^\s=&]+=[^&\s]*(&[^\s=&]+=[^&\s]*)+$", first) and len(lines) == 1:
+        candidates = ["querystring"]
+    elif re.match(r"^[\w.\-\"']+\s*=\s*\S", first):
+        candidates = ["toml"]
+
+    return [fmt for fmt in candidates if has_format(fmt)] + [fallback]
+
+
+def parse_data(content: str | bytes, candidates: Sequence[str]) -> Any:
+    """
+    Parse ``content`` with the first of ``candidates`` that accepts it,
+    raising the error from the first candidate if none do.
+    """
+    error = None
+    for fmt in candidates:
+        fn, except_exc, raise_exc = get_parser(fmt)
+        try:
+            return fn(content)
+        except except_exc:
+            if error is None:
+                error = raise_exc(f"{content[:60]} ...")
+    assert error is not None
+    raise error
+
+
 def discover_filters(filter_path: str, base_dir: str | None = None) -> dict[str, Callable]:
     import inspect
 
@@ -324,7 +1178,125 @@ def discover_filters(filter_path: str, base_dir: str | None = None) -> dict[str,
     return discovered_filters
 
 
-def render(
+def make_sandbox(max_operations: int | None = None, **env_kwargs: Any) -> Environment:
+    """
+    Create a ``SandboxedEnvironment`` that also limits the work a single
+    render may do. Every call, attribute and item lookup counts as an
+    operation, as does every number yielded by ``range``, and once
+    ``max_operations`` is exceeded the render fails with
+    :class:`OperationBudgetExceeded`. Call ``reset_budget`` before each
+    render; with a ``timeout``, operations also check the deadline, so a
+    render is stopped even where signals can't interrupt it.
+    """
+    import time
+
+    from jinja2 import sandbox
+
+    class BudgetedSandbox(sandbox.SandboxedEnvironment):
+        def __init__(self, *args: Any, **kwargs: Any) -> None:
+            super().__init__(*args, **kwargs)
+            self.max_operations = max_operations
+            self.operations = 0
+            self.timeout: float | None = None
+            self.deadline: float | None = None
+            self.globals["range"] = self.safe_range  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
+
+        def reset_budget(self, timeout: float | None = None) -> None:
+            self.operations = 0
+            self.timeout = timeout
+            self.deadline = None if timeout is None else time.monotonic() + timeout
+
+        def charge(self, operations: int = 1) -> None:
+            self.operations += operations
+            if self.max_operations is not None and self.operations > self.max_operations:
+                raise OperationBudgetExceeded(
+                    f"render exceeded --max-operations of {self.max_operations}"
+                )
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise RenderTimeout(f"render timed out after {self.timeout:g}s")
+
+        def safe_range(self, *args: int) -> range:
+            numbers = sandbox.safe_range(*args)
+            self.charge(len(numbers) + 1)
+            return numbers
+
+        def call(__self, __context: Any, __obj: Any, *args: Any, **kwargs: Any) -> Any:
+            __self.charge()
+            return super().call(__context, __obj, *args, **kwargs)
+
+        def getattr(self, obj: Any, attribute: str) -> Any:
+            self.charge()
+            return super().getattr(obj, attribute)
+
+        def getitem(self, obj: Any, argument: Any) -> Any:
+            self.charge()
+            return super().getitem(obj, argument)
+
+    return BudgetedSandbox(**env_kwargs)
+
+
+@contextmanager
+def render_limits(
+    env: Environment, timeout: float | None, name: str
+) -> Generator[None, None, None]:
+    """
+    Stop whatever runs inside after ``timeout`` seconds with
+    :class:`RenderTimeout`, and restart the operation budget of a sandbox
+    made by :func:`make_sandbox`. The deadline is enforced with ``SIGALRM``
+    where available, and otherwise only by the sandbox.
+    """
+    reset_budget = getattr(env, "reset_budget", None)
+    if reset_budget is not None:
+        reset_budget(timeout)
+    if timeout is None:
+        yield
+        return
+
+    import signal
+    import threading
+
+    if (
+        not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        if reset_budget is None:
+            raise InvalidUsage("--timeout needs --sandbox on this platform")
+        yield
+        return
+
+    def _expired(signum: int, frame: Any) -> None:
+        raise RenderTimeout(f"{name}: render timed out after {timeout:g}s")
+
+    previous = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class EnvironReader:
+    """
+    The ``environ()`` template global, remembering what it read, so the
+    render cache can tell when a variable changed.
+    """
+
+    def __init__(self, strict: bool = False) -> None:
+        self.strict = strict
+        self.reads: dict[str, str | None] = {}
+
+    def __call__(self, key: str) -> str | None:
+        from jinja2 import UndefinedError
+
+        value = os.environ.get(key)
+        self.reads[key] = value
+        if value is None and self.strict:
+            raise UndefinedError(f"environment variable '{key}' is not defined")
+        return value
+
+
+def make_environment(
     template_path: str | None,
     data: dict,
     extensions: list[ExtensionSpec],
@@ -343,14 +1315,17 @@ def render(
     line_comment_prefix: str | None = None,
     newline_sequence: str | None = None,
     search_paths: list[str] | None = None,
-    template_string: str | None = None,
     base_dir: str | None = None,
-) -> str:
+    sandbox: bool = False,
+    max_operations: int | None = None,
+    index_templates: bool = False,
+    template_index_file: str | None = None,
+    environ: EnvironReader | None = None,
+) -> Environment:
     from jinja2 import (
         Environment,
         FileSystemLoader,
         StrictUndefined,
-        UndefinedError,
     )
 
     env_kwargs: dict = {
@@ -364,7 +1339,10 @@ def render(
     if template_path is not None:
         template_dir = os.path.dirname(template_path) or "."
         paths = [template_dir] + (search_paths or [])
-        env_kwargs["loader"] = FileSystemLoader(paths)
+        if index_templates or template_index_file is not None:
+            env_kwargs["loader"] = make_indexed_loader(paths, index_file=template_index_file)
+        else:
+            env_kwargs["loader"] = FileSystemLoader(paths)
 
     if autoescape:
         env_kwargs["autoescape"] = True
@@ -387,7 +1365,10 @@ def render(
     if newline_sequence is not None:
         env_kwargs["newline_sequence"] = newline_sequence
 
-    env = Environment(**env_kwargs)
+    if sandbox or max_operations is not None:
+        env = make_sandbox(max_operations, **env_kwargs)
+    else:
+        env = Environment(**env_kwargs)
     if strict:
         env.undefined = StrictUndefined
 
@@ -399,48 +1380,2003 @@ def render(
             env.filters.update(discovered)
 
     # Add environ global
-    def _environ(key: str):
-        value = os.environ.get(key)
-        if value is None and strict:
-            raise UndefinedError(f"environment variable '{key}' is not defined")
-        return value
-
-    env.globals["environ"] = _environ  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
+    env.globals["environ"] = environ or EnvironReader(strict)  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
     env.globals["get_context"] = lambda: data  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
 
-    if template_string is not None:
-        return env.from_string(template_string).render(data)
-    assert template_path is not None
-    return env.get_template(os.path.basename(template_path)).render(data)
-
-
-def split_extension_path(extension: str) -> tuple[str, str | None]:
-    if ":" in extension:
-        module_name, object_name = extension.split(":", 1)
-        return module_name, object_name or None
-    module_name, _, object_name = extension.rpartition(".")
-    if module_name:
-        return module_name, object_name or None
-    return extension, None
+    return env
 
 
-def load_local_module(module_name: str, base_dir: str) -> ModuleType | None:
-    module_path = os.path.join(base_dir, *module_name.split("."))
-    for candidate in (f"{module_path}.py", os.path.join(module_path, "__init__.py")):
-        if not os.path.isfile(candidate):
-            continue
-        spec = importlib.util.spec_from_file_location(module_name, candidate)
-        if spec is None or spec.loader is None:
-            return None
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module
-        spec.loader.exec_module(module)
-        return module
-    return None
+def load_template(
+    env: Environment, template_path: str | None, template_string: str | None = None
+) -> Template:
+    if template_string is not None:
+        return env.from_string(template_string)
+    assert template_path is not None
+    return env.get_template(os.path.basename(template_path))
 
 
-def resolve_extension(extension: ExtensionSpec, base_dir: str) -> ExtensionSpec:
-    if not isinstance(extension, str):
+def render(
+    template_path: str | None,
+    data: dict,
+    extensions: list[ExtensionSpec],
+    filters: list[str] | None = None,
+    strict: bool = False,
+    trim_blocks: bool = False,
+    lstrip_blocks: bool = False,
+    autoescape: bool = False,
+    variable_start_string: str | None = None,
+    variable_end_string: str | None = None,
+    block_start_string: str | None = None,
+    block_end_string: str | None = None,
+    comment_start_string: str | None = None,
+    comment_end_string: str | None = None,
+    line_statement_prefix: str | None = None,
+    line_comment_prefix: str | None = None,
+    newline_sequence: str | None = None,
+    search_paths: list[str] | None = None,
+    template_string: str | None = None,
+    base_dir: str | None = None,
+    sandbox: bool = False,
+    max_operations: int | None = None,
+    timeout: float | None = None,
+    index_templates: bool = False,
+    template_index_file: str | None = None,
+) -> str:
+    env = make_environment(
+        template_path,
+        data,
+        extensions,
+        filters=filters,
+        strict=strict,
+        trim_blocks=trim_blocks,
+        lstrip_blocks=lstrip_blocks,
+        autoescape=autoescape,
+        variable_start_string=variable_start_string,
+        variable_end_string=variable_end_string,
+        block_start_string=block_start_string,
+        block_end_string=block_end_string,
+        comment_start_string=comment_start_string,
+        comment_end_string=comment_end_string,
+        line_statement_prefix=line_statement_prefix,
+        line_comment_prefix=line_comment_prefix,
+        newline_sequence=newline_sequence,
+        search_paths=search_paths,
+        base_dir=base_dir,
+        sandbox=sandbox,
+        max_operations=max_operations,
+        index_templates=index_templates,
+        template_index_file=template_index_file,
+    )
+    template = load_template(env, template_path, template_string)
+    with render_limits(env, timeout, template.name or "<string>"):
+        return template.render(data)
+
+
+def iter_fan_out(
+    env: Environment, data: dict, each: str, outfile: str
+) -> Iterator[tuple[str, dict]]:
+    """
+    Yield an ``(output path, context)`` pair for each item of the iterable
+    selected by the ``each`` expression. The output path is itself a template
+    rendered against the per-item context.
+    """
+    from jinja2 import Undefined
+
+    items = env.compile_expression(each, undefined_to_none=False)(data)
+    if isinstance(items, Undefined) or items is None:
+        raise InvalidUsage(f"--each expression {each!r} is undefined")
+    if isinstance(items, (str, bytes)) or not isinstance(items, Iterable):
+        raise InvalidUsage(f"--each expression {each!r} is not iterable")
+
+    # A path, not markup, even with --autoescape
+    path_template = env.overlay(autoescape=False).from_string(outfile)
+    seen: set[str] = set()
+    for item in items:
+        context = dict(data)
+        if isinstance(item, Mapping):
+            context.update(item)
+        context["item"] = item
+
+        path = path_template.render(context)
+        if not path:
+            raise InvalidUsage(f"empty output path for item {item!r}")
+        if path in seen:
+            raise InvalidUsage(f"duplicate output path: {path}")
+        seen.add(path)
+
+        yield path, context
+
+
+class Shard:
+    """
+    Deterministically assigns output paths to one of ``count`` shards, so
+    separate machines can each render a slice of a fan-out with no
+    coordination. Paths are spread by a stable hash. With ``timings`` (render
+    seconds by output path, from earlier runs), the known paths are first
+    spread so each shard gets about the same total render time, slowest
+    first, and only new paths fall back to the hash.
+    """
+
+    def __init__(self, index: int, count: int, timings: Mapping[str, float] | None = None) -> None:
+        self.index = index
+        self.count = count
+        self.assigned: dict[str, int] = {}
+        if timings:
+            loads = [0.0] * count
+            for path, seconds in sorted(timings.items(), key=lambda item: (-item[1], item[0])):
+                shard = min(range(count), key=lambda shard: loads[shard])
+                self.assigned[path] = shard
+                loads[shard] += seconds
+
+    @staticmethod
+    def stable_hash(path: str) -> int:
+        import hashlib
+
+        digest = hashlib.sha256(path.encode("utf8", "surrogateescape")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def shard_of(self, path: str) -> int:
+        shard = self.assigned.get(path)
+        if shard is None:
+            shard = self.stable_hash(path) % self.count
+        return shard
+
+    def owns(self, path: str) -> bool:
+        return self.shard_of(path) == self.index
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse ``I/N``, shard ``I`` (from 1) of ``N``, into a 0-based index and count."""
+    index, sep, count = value.partition("/")
+    try:
+        i, n = int(index), int(count)
+    except ValueError:
+        i = n = 0
+    if not sep or n < 1 or not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value!r}, expected I/N like 1/4")
+    return i - 1, n
+
+
+def load_timings(paths: Iterable[str]) -> dict[str, float]:
+    """Merge timings files written by ``--record-timings``, later files winning."""
+    import json
+
+    timings: dict[str, float] = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as fp:
+                timings.update(json.load(fp))
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            raise InvalidInputData(f"{path}: invalid timings file: {e}")
+    return timings
+
+
+def save_timings(path: str, timings: Mapping[str, float]) -> None:
+    """Merge ``timings`` into the timings file at ``path``, atomically."""
+    import json
+    import tempfile
+
+    merged = load_timings([path])
+    merged.update(timings)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".timings.", suffix=".tmp", dir=directory)
+    try:
+        with open(fd, "w") as fp:
+            json.dump(merged, fp, indent=0, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TemplateIndex:
+    """
+    Maps template names to files across search paths, listing a directory
+    the first time a lookup goes through it instead of stat-ing a candidate
+    path per search path on every lookup. Only the directories along looked
+    up names are listed, so nothing is walked up front and symlinked
+    directories are never walked into. Earlier search paths win, as with
+    ``FileSystemLoader``.
+
+    With an ``index_file``, listings are saved there along with the mtime of
+    their directory, and reused by later runs for as long as that directory
+    is unchanged (adding, removing or renaming a template updates the mtime
+    of its directory), so a run only stats the directories it looks in.
+    """
+
+    INDEX_VERSION = 2
+
+    def __init__(self, searchpath: Sequence[str], index_file: str | None = None) -> None:
+        self.searchpath = [os.path.abspath(path) for path in searchpath]
+        self.index_file = index_file
+        # directory -> [mtime_ns, {entry name: is a directory}]
+        self.listings: dict[str, list] = {}
+        self.saved = self._load_index()
+        self.changed = False
+
+    def listing(self, directory: str) -> dict[str, bool] | None:
+        """The entries of ``directory``, or ``None`` when it can't be listed."""
+        cached = self.listings.get(directory)
+        if cached is not None:
+            return cached[1]
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        saved = self.saved.get(directory)
+        if saved is not None and saved[0] == mtime_ns:
+            entries = saved[1]
+        else:
+            try:
+                with os.scandir(directory) as it:
+                    entries = {entry.name: entry.is_dir() for entry in it}
+            except OSError:
+                return None
+            self.changed = True
+        self.listings[directory] = [mtime_ns, entries]
+        return entries
+
+    def find(self, pieces: Sequence[str]) -> str | None:
+        """The file a template name, split into its path segments, resolves to."""
+        for root in self.searchpath:
+            directory = root
+            for i, piece in enumerate(pieces):
+                entries = self.listing(directory)
+                if entries is None or piece not in entries:
+                    break
+                directory = os.path.join(directory, piece)
+                if entries[piece] != (i < len(pieces) - 1):
+                    break
+            else:
+                return directory
+        return None
+
+    def forget(self) -> None:
+        """Drop every listing, e.g. once a listed template turns out to be gone."""
+        self.listings.clear()
+        self.saved.clear()
+
+    def list_templates(self) -> list[str]:
+        templates = set()
+        for root in self.searchpath:
+            for dirpath, _, filenames in os.walk(root):
+                prefix = os.path.relpath(dirpath, root)
+                for filename in filenames:
+                    name = filename if prefix == "." else os.path.join(prefix, filename)
+                    templates.add(name.replace(os.sep, "/"))
+        return sorted(templates)
+
+    def _load_index(self) -> dict[str, list]:
+        import json
+
+        if self.index_file is None:
+            return {}
+        try:
+            with open(self.index_file, "rb") as fp:
+                index = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if index.get("version") != self.INDEX_VERSION or index.get("searchpath") != self.searchpath:
+            return {}
+        return index["directories"]
+
+    def save(self) -> None:
+        """Save the listings to ``index_file``, if any were made since the last save."""
+        import json
+        import tempfile
+
+        if self.index_file is None or not self.changed:
+            return
+        directory = os.path.dirname(os.path.abspath(self.index_file))
+        fd, tmp_path = tempfile.mkstemp(prefix=".index.", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "w") as fp:
+                json.dump(
+                    {
+                        "version": self.INDEX_VERSION,
+                        "searchpath": self.searchpath,
+                        # Listings this run didn't need are kept for the next one
+                        "directories": {**self.saved, **self.listings},
+                    },
+                    fp,
+                )
+            os.replace(tmp_path, self.index_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.changed = False
+
+
+def make_indexed_loader(
+    searchpath: Sequence[str], encoding: str = "utf-8", index_file: str | None = None
+) -> BaseLoader:
+    """
+    A drop-in for jinja2's ``FileSystemLoader`` that looks templates up in a
+    :class:`TemplateIndex`, so a lookup is a dict hit for every directory
+    already listed.
+    """
+    from jinja2 import BaseLoader, TemplateNotFound
+    from jinja2.loaders import split_template_path
+
+    index = TemplateIndex(searchpath, index_file)
+
+    class IndexedLoader(BaseLoader):
+        def get_source(
+            self, environment: Environment, template: str
+        ) -> tuple[str, str, Callable[[], bool]]:
+            pieces = split_template_path(template)
+            filename = index.find(pieces)
+            index.save()
+            if filename is None:
+                raise TemplateNotFound(template)
+            try:
+                with open(filename, encoding=encoding) as fp:
+                    contents = fp.read()
+                mtime = os.path.getmtime(filename)
+            except FileNotFoundError:
+                # Removed since its directory was listed, look again
+                index.forget()
+                if index.find(pieces) in (None, filename):
+                    raise TemplateNotFound(template)
+                return self.get_source(environment, template)
+
+            def uptodate() -> bool:
+                try:
+                    return os.path.getmtime(filename) == mtime
+                except OSError:
+                    return False
+
+            return contents, os.path.normpath(filename), uptodate
+
+        def list_templates(self) -> list[str]:
+            return index.list_templates()
+
+    return IndexedLoader()
+
+
+def make_tracking_loader(loader: BaseLoader, loaded: set[str]) -> BaseLoader:
+    """Wrap a jinja2 loader, adding the filename of every template it loads to ``loaded``."""
+    from jinja2 import BaseLoader
+
+    class TrackingLoader(BaseLoader):
+        has_source_access = loader.has_source_access
+
+        # BaseLoader.load compiles what get_source returns, so every load passes through here
+        def get_source(
+            self, environment: Environment, template: str
+        ) -> tuple[str, str | None, Callable[[], bool] | None]:
+            source, filename, uptodate = loader.get_source(environment, template)
+            if filename is not None:
+                loaded.add(os.path.abspath(filename))
+            return source, filename, uptodate
+
+        def list_templates(self) -> list[str]:
+            return loader.list_templates()
+
+    return TrackingLoader()
+
+
+def file_digest(path: str) -> str:
+    import hashlib
+
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(WRITE_BUFFER_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_signature(path: str) -> list | None:
+    """``[mtime_ns, size, sha256]`` of a file, or ``None`` if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, file_digest(path)]
+
+
+def signature_matches(path: str, recorded: list) -> bool:
+    """
+    Whether a file still matches a signature from :func:`file_signature`.
+    mtime and size are compared first, falling back to the sha256 so that a
+    touched but otherwise identical file still matches.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if [st.st_mtime_ns, st.st_size] == recorded[:2]:
+        return True
+    return st.st_size == recorded[1] and file_digest(path) == recorded[2]
+
+
+def data_digest(obj: Any) -> str:
+    """
+    Stable sha256 of parsed data. Mappings are hashed independent of key
+    order, objects with a ``cache_token()`` method (lazy sources) by its
+    result, and anything else that isn't a plain JSON-like value by its
+    ``repr``.
+    """
+    import hashlib
+
+    h = hashlib.sha256()
+
+    def feed(obj: Any) -> None:
+        if isinstance(obj, Mapping):
+            h.update(b"{")
+            for key, value in sorted(obj.items(), key=lambda kv: repr(kv[0])):
+                feed(key)
+                h.update(b":")
+                feed(value)
+                h.update(b",")
+            h.update(b"}")
+        elif isinstance(obj, (list, tuple)):
+            h.update(b"[")
+            for value in obj:
+                feed(value)
+                h.update(b",")
+            h.update(b"]")
+        elif callable(getattr(type(obj), "cache_token", None)):
+            h.update(obj.cache_token().encode("utf8", "surrogatepass"))
+        else:
+            h.update(repr(obj).encode("utf8", "surrogatepass"))
+
+    feed(obj)
+    return h.hexdigest()
+
+
+def options_digest(
+    opts: argparse.Namespace, args: Sequence[str], exclude: Iterable[str] = ()
+) -> str:
+    """Hash every option and argument that can influence the rendered output."""
+    import hashlib
+    import json
+
+    from jinja2 import __version__ as jinja_version
+
+    from jinja2cli import __version__
+
+    options = {k: v for k, v in vars(opts).items() if k not in exclude}
+    payload = json.dumps(
+        {"args": list(args), "opts": options, "versions": [__version__, jinja_version]},
+        sort_keys=True,
+        default=lambda o: sorted(o) if isinstance(o, (set, frozenset)) else repr(o),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def module_files(objs: Iterable[Any]) -> set[str]:
+    """Source files of the modules defining ``objs``, excluding jinja2 itself."""
+    files = set()
+    for obj in objs:
+        module_name = getattr(obj, "__module__", None) or ""
+        if module_name == "jinja2" or module_name.startswith("jinja2."):
+            continue
+        filename = getattr(sys.modules.get(module_name), "__file__", None)
+        if filename:
+            files.add(os.path.abspath(filename))
+    return files
+
+
+class BuildManifest:
+    """
+    Records the inputs (data files, templates, filter and extension modules) and
+    outputs of a run along with a digest of all options, so that a later run
+    with the same options can skip outputs whose inputs haven't changed.
+
+    Inputs are compared with :func:`signature_matches`, so a touched but
+    otherwise identical file doesn't force a rebuild.
+    """
+
+    VERSION = 1
+    STDIN = "-"
+    STDIN_TEMPLATE = "-S"
+
+    def __init__(self, path: str, options: str) -> None:
+        self.path = path
+        self.options = options
+        self.inputs: dict[str, list] = {}
+        self.outputs: dict[str, list] = {}
+        self.previous: dict = {}
+        self._inputs_unchanged: bool | None = None
+
+        import json
+
+        try:
+            with open(path) as fp:
+                previous = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            # A corrupt manifest just means a full rebuild
+            return
+        if isinstance(previous, dict) and previous.get("version") == self.VERSION:
+            self.previous = previous
+
+    @staticmethod
+    def _stat(path: str) -> list | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    def add_input(self, path: str) -> None:
+        path = os.path.abspath(path)
+        if path in self.inputs:
+            return
+        signature = file_signature(path)
+        if signature is not None:
+            self.inputs[path] = signature
+
+    def add_stdin(self, content: str | bytes, key: str = STDIN) -> None:
+        self.add_remote(key, content)
+
+    def add_remote(self, url: str, content: str | bytes) -> None:
+        import hashlib
+
+        if isinstance(content, str):
+            content = content.encode()
+        self.inputs[url] = [0, len(content), hashlib.sha256(content).hexdigest()]
+
+    def add_output(self, path: str) -> None:
+        stat = self._stat(path)
+        if stat is not None:
+            self.outputs[os.path.abspath(path)] = stat
+
+    def _input_unchanged(self, path: str, recorded: list) -> bool:
+        if path in (self.STDIN, self.STDIN_TEMPLATE) or is_url(path):
+            return self.inputs.get(path) == recorded
+        return signature_matches(path, recorded)
+
+    def inputs_unchanged(self) -> bool:
+        if self._inputs_unchanged is None:
+            previous_inputs = self.previous.get("inputs")
+            self._inputs_unchanged = (
+                self.previous.get("options") == self.options
+                and bool(previous_inputs)
+                and all(self._input_unchanged(p, r) for p, r in previous_inputs.items())
+            )
+        return self._inputs_unchanged
+
+    def output_up_to_date(self, path: str) -> bool:
+        recorded = self.previous.get("outputs", {}).get(os.path.abspath(path))
+        return recorded is not None and self.inputs_unchanged() and self._stat(path) == recorded
+
+    def is_up_to_date(self) -> bool:
+        """
+        Whether every output of the previous run is up to date, checked before
+        any data is read. Runs reading data from stdin or URLs can never be
+        skipped wholesale, since they have to be read to know whether they
+        changed.
+        """
+        previous_inputs = self.previous.get("inputs", {})
+        outputs = self.previous.get("outputs")
+        if not outputs or any(p == self.STDIN or is_url(p) for p in previous_inputs):
+            return False
+        return all(self.output_up_to_date(path) for path in outputs)
+
+    def keep_output(self, path: str) -> None:
+        path = os.path.abspath(path)
+        self.outputs[path] = self.previous["outputs"][path]
+
+    def save(self) -> None:
+        import json
+        import tempfile
+
+        inputs = dict(self.inputs)
+        if self.inputs_unchanged():
+            # Skipped outputs didn't load their templates this time around
+            for path, recorded in self.previous["inputs"].items():
+                inputs.setdefault(path, recorded)
+
+        manifest = {
+            "version": self.VERSION,
+            "options": self.options,
+            "inputs": inputs,
+            "outputs": self.outputs,
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest.", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "w") as fp:
+                json.dump(manifest, fp, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class RenderCache:
+    """
+    Content-addressed on-disk store of rendered output.
+
+    Entries are keyed by the caller (typically a digest of the options, data
+    and template) and also record every template file loaded and every
+    environment variable read with ``environ()`` while rendering, so an entry
+    is only used while those are unchanged. Entries
+    older than ``ttl`` seconds are dropped, and the least recently used ones
+    are evicted once the store grows past ``max_size`` bytes.
+    """
+
+    def __init__(self, directory: str, ttl: float, max_size: int) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Whether anything was put, in this process or (as reported) its workers
+        self.stored = False
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        import hashlib
+
+        return hashlib.sha256("\0".join(parts).encode("utf8", "surrogatepass")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> tuple[str, list[str]] | None:
+        """Return the cached ``(rendered, template files)`` for ``key``, if fresh."""
+        entry = self.open(key)
+        if entry is None:
+            return None
+        fp, deps = entry
+        with fp:
+            return fp.read().decode("utf8", "surrogateescape"), deps
+
+    def open(self, key: str) -> tuple[IO[bytes], list[str]] | None:
+        """
+        Like :meth:`get`, but return the entry as a binary file positioned at
+        the start of the UTF-8 encoded output, so it can be copied as is.
+        """
+        import json
+        import time
+
+        path = self._path(key)
+        with ExitStack() as stack:
+            try:
+                fp = stack.enter_context(open(path, "rb"))
+                header = json.loads(fp.readline())
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+            deps = header.get("deps", {})
+            environ = header.get("environ", {})
+            if (
+                time.time() - header.get("created", 0) > self.ttl
+                or not all(signature_matches(dep, recorded) for dep, recorded in deps.items())
+                or any(os.environ.get(name) != value for name, value in environ.items())
+            ):
+                stack.close()
+                self.misses += 1
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                return None
+
+            # Bump the mtime, eviction is least recently used first
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            self.hits += 1
+            # Left open for the caller
+            stack.pop_all()
+            return fp, list(deps)
+
+    def put(
+        self,
+        key: str,
+        rendered: str,
+        deps: Iterable[str],
+        environ: Mapping[str, str | None] | None = None,
+    ) -> None:
+        import json
+        import tempfile
+        import time
+
+        signatures = {}
+        for dep in deps:
+            signature = file_signature(dep)
+            if signature is None:
+                return
+            signatures[dep] = signature
+
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "wb") as fp:
+                header = {
+                    "created": time.time(),
+                    "deps": signatures,
+                    "environ": dict(environ or {}),
+                }
+                fp.write(json.dumps(header).encode() + b"\n")
+                fp.write(rendered.encode("utf8", "surrogateescape"))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.stored = True
+
+    def evict(self) -> None:
+        """Drop expired entries, then the least recently used until under ``max_size``."""
+        if self.stored:
+            evict_cache_directory(self.directory, self.ttl, self.max_size)
+
+
+def evict_cache_directory(directory: str, ttl: float, max_size: int) -> None:
+    """
+    Drop files in a cache directory not used for ``ttl`` seconds, then the
+    least recently used ones until they add up to at most ``max_size`` bytes.
+    Entries are marked as used by bumping their mtime.
+    """
+    import time
+
+    now = time.time()
+    entries = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > ttl:
+                # Another run sharing the directory may have beaten us to it
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        total -= size
+
+
+class FragmentCache:
+    """
+    Store of rendered ``{% cache %}`` fragments, see
+    :func:`fragment_cache_extension`: the ``size`` most recently used in
+    memory and, with a ``directory``, every one on disk as well, so they
+    carry over to later runs. Entries are keyed by a fingerprint of the
+    block, the ``repr`` of its evaluated key and whether it was autoescaped.
+
+    As with :class:`RenderCache`, entries on disk not used for ``ttl``
+    seconds are dropped, and :meth:`evict` removes the least recently used
+    once they add up to more than ``max_size`` bytes.
+    """
+
+    def __init__(
+        self,
+        size: int = 1024,
+        directory: str | None = None,
+        ttl: float = 7 * 24 * 60 * 60,
+        max_size: int = 512 * 1024**2,
+    ) -> None:
+        from collections import OrderedDict
+
+        self.size = size
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Whether anything was written to disk, in this process or (as reported) its workers
+        self.stored = False
+
+    def _path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(
+        self, fingerprint: str, key: Any, render: Callable[[], str], autoescape: bool = False
+    ) -> str:
+        """Return the fragment stored for ``key``, calling ``render`` to make it if needed."""
+        # Output kept as plain text would be escaped when reused with autoescaping
+        digest = RenderCache.key(fingerprint, repr(key), "html" if autoescape else "text")
+        fragment = self.entries.get(digest)
+        if fragment is not None:
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return fragment
+
+        fragment = self._load(digest) if self.directory else None
+        if fragment is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            fragment = render()
+            if self.directory:
+                self._store(digest, fragment)
+        if self.size > 0:
+            self.entries[digest] = fragment
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return fragment
+
+    def _load(self, digest: str) -> str | None:
+        import time
+
+        path = self._path(digest)
+        try:
+            with open(path, "rb") as fp:
+                if time.time() - os.fstat(fp.fileno()).st_mtime > self.ttl:
+                    fp.close()
+                    os.unlink(path)
+                    return None
+                kind = fp.read(1)
+                fragment = fp.read().decode("utf8", "surrogateescape")
+            # Bump the mtime, eviction is least recently used first
+            os.utime(path)
+        except OSError:
+            return None
+        if kind == b"M":
+            # Autoescaped output, it mustn't be escaped a second time
+            from markupsafe import Markup
+
+            return Markup(fragment)
+        return fragment
+
+    def _store(self, digest: str, fragment: str) -> None:
+        import tempfile
+
+        from markupsafe import Markup
+
+        path = self._path(digest)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "wb") as fp:
+                fp.write(b"M" if isinstance(fragment, Markup) else b"T")
+                fp.write(fragment.encode("utf8", "surrogateescape"))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.stored = True
+
+    def evict(self) -> None:
+        """Drop expired entries on disk, then the least recently used until under ``max_size``."""
+        if self.stored and self.directory:
+            evict_cache_directory(self.directory, self.ttl, self.max_size)
+
+
+def fragment_cache_extension() -> type[Extension]:
+    """
+    The ``cache`` extension, enabled with ``-e cache``. It adds
+    ``{% cache key %}...{% endcache %}``, which renders its body once per
+    distinct ``key`` and reuses the output from then on, via the
+    environment's ``fragment_cache``. The key has to cover everything the
+    body depends on, and can't be undefined. Changing the body's source
+    starts over with new entries, changing a template it includes or a
+    macro it calls doesn't.
+    """
+    import hashlib
+
+    from jinja2 import Undefined, nodes, pass_eval_context
+    from jinja2.ext import Extension
+
+    class FragmentCacheExtension(Extension):
+        def __init__(self, environment: Environment) -> None:
+            super().__init__(environment)
+            # Set per instance, as jinja2's Extension declares it
+            self.tags = {"cache"}
+            self.cache = FragmentCache()
+            environment.extend(fragment_cache=self.cache)
+
+        def parse(self, parser: Any) -> nodes.Node:
+            lineno = next(parser.stream).lineno
+            key = parser.parse_expression()
+            body = parser.parse_statements(("name:endcache",), drop_needle=True)
+            # Node reprs hold every field but no line numbers
+            fingerprint = hashlib.sha256(repr(body).encode("utf8", "surrogatepass")).hexdigest()
+            call = self.call_method("_fetch", [nodes.Const(fingerprint), key])
+            return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+        @pass_eval_context
+        def _fetch(
+            self, eval_ctx: Any, fingerprint: str, key: Any, caller: Callable[[], str]
+        ) -> str:
+            if isinstance(key, Undefined):
+                # They'd all share a single entry
+                key._fail_with_undefined_error()
+            return self.cache.fetch(fingerprint, key, caller, eval_ctx.autoescape)
+
+    return FragmentCacheExtension
+
+
+def compress_stream(fileobj: IO[bytes], compression: str, mtime: int = 0) -> IO[bytes]:
+    """Wrap a binary file object so everything written to it is compressed."""
+    if compression == "gzip":
+        import gzip
+
+        # No filename and a fixed mtime in the header, so identical content compresses identically
+        return gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, mtime=mtime)  # ty: ignore[invalid-return-type] - a binary file, typeshed just doesn't declare it an IO[bytes]
+    if compression == "xz":
+        import lzma
+
+        return lzma.LZMAFile(fileobj, "wb")
+    if compression == "bz2":
+        import bz2
+
+        return bz2.BZ2File(fileobj, "wb")
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise InvalidUsage("zstd: install zstandard to fix")
+        return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+    raise InvalidUsage(f"unknown compression: {compression}")
+
+
+@contextmanager
+def open_output(
+    target: str | int, compression: str | None = None, buffer_size: int = WRITE_BUFFER_SIZE
+) -> Generator[IO[bytes], None, None]:
+    """Open a file (or file descriptor) for writing bytes, compressing it if asked to."""
+    with open(target, "wb", buffering=buffer_size) as raw:
+        if compression is None:
+            yield raw
+            return
+        with compress_stream(raw, compression) as compressed:
+            yield compressed
+
+
+def iter_encoded(
+    chunks: Iterable[str],
+    encoding: str,
+    errors: str = "strict",
+    block_size: int = WRITE_BUFFER_SIZE,
+) -> Iterator[bytes]:
+    """
+    Encode ``chunks`` into blocks of at least ``block_size`` characters (bar
+    the last), so many small chunks, as ``Template.generate`` produces, become
+    a few large writes rather than one each.
+    """
+    batch: list[str] = []
+    pending = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        pending += len(chunk)
+        if pending >= block_size:
+            yield "".join(batch).encode(encoding, errors)
+            batch.clear()
+            pending = 0
+    if batch:
+        yield "".join(batch).encode(encoding, errors)
+
+
+def translate_newlines(chunks: Iterable[str]) -> Iterable[str]:
+    """
+    Translate ``\n`` to ``os.linesep``, as writing to a text file would, for
+    output that's encoded and written as bytes.
+    """
+    if os.linesep == "\n":
+        return chunks
+    return (chunk.replace("\n", os.linesep) for chunk in chunks)
+
+
+def copy_stream(source: IO[bytes], out: IO[bytes], block_size: int = WRITE_BUFFER_SIZE) -> None:
+    """
+    Copy the rest of ``source`` into ``out``, with ``os.sendfile`` when both
+    are real files (so the data never passes through Python), falling back
+    to a plain block by block copy.
+    """
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile is not None:
+        try:
+            in_fd = source.fileno()
+            out_fd = out.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        else:
+            out.flush()
+            offset = source.tell()
+            remaining = os.fstat(in_fd).st_size - offset
+            try:
+                while remaining > 0:
+                    sent = sendfile(out_fd, in_fd, offset, remaining)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+            except OSError:
+                # Not supported between these two, copy what's left the slow way
+                pass
+            source.seek(offset)
+    for block in iter(lambda: source.read(block_size), b""):
+        out.write(block)
+
+
+class ArchiveWriter:
+    """
+    Writes outputs as members of a tar or zip archive, named by their output
+    path, instead of as individual files. The archive is written to a
+    temporary file next to its destination and moved into place once
+    complete.
+
+    Member and gzip header timestamps are ``SOURCE_DATE_EPOCH``, or the
+    epoch when it isn't set, so identical outputs give an identical archive
+    and ``if_changed`` can leave it alone.
+    """
+
+    tar_compressions: ClassVar[dict[str, str | None]] = {
+        ".tar": None,
+        ".tar.gz": "gzip",
+        ".tgz": "gzip",
+        ".tar.xz": "xz",
+        ".txz": "xz",
+        ".tar.bz2": "bz2",
+        ".tbz2": "bz2",
+    }
+
+    def __init__(self, path: str, if_changed: bool = False, encoding: str = "utf8") -> None:
+        import tempfile
+
+        self.path = os.path.realpath(path)
+        self.if_changed = if_changed
+        self.encoding = encoding
+        self.mtime = int(os.environ.get("SOURCE_DATE_EPOCH") or 0)
+        self.members = 0
+        self.replaced = False
+        lowered = path.lower()
+        directory, name = os.path.split(self.path)
+        fd, self.tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        os.close(fd)
+
+        self.zip: Any = None
+        self.tar: Any = None
+        try:
+            with ExitStack() as stack:
+                if lowered.endswith(".zip"):
+                    import zipfile
+
+                    self.zip = stack.enter_context(
+                        zipfile.ZipFile(self.tmp_path, "w", zipfile.ZIP_DEFLATED)
+                    )
+                else:
+                    import tarfile
+
+                    compression = self._tar_compression(lowered)
+                    stream: IO[bytes] = stack.enter_context(open(self.tmp_path, "wb"))
+                    if compression is not None:
+                        # Not left to tarfile, which puts the file name and time in a gzip header
+                        stream = stack.enter_context(
+                            compress_stream(stream, compression, self.mtime)
+                        )
+                    self.tar = stack.enter_context(tarfile.open(fileobj=stream, mode="w"))
+                # The archive and the file (and compression) under it, closed in reverse
+                self.stack = stack.pop_all()
+        except BaseException:
+            os.unlink(self.tmp_path)
+            raise
+
+    def _tar_compression(self, lowered: str) -> str | None:
+        for suffix, compression in self.tar_compressions.items():
+            if lowered.endswith(suffix):
+                return compression
+        raise InvalidUsage(f"unknown archive format: {self.path}")
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @staticmethod
+    def member_name(path: str) -> str:
+        return os.path.normpath(path).replace(os.sep, "/").lstrip("/")
+
+    def add(self, path: str, chunks: Iterable[str]) -> None:
+        name = self.member_name(path)
+        self.members += 1
+        if self.zip is not None:
+            import time
+            import zipfile
+
+            # Zip timestamps can't predate 1980
+            date_time = max(time.gmtime(self.mtime)[:6], (1980, 1, 1, 0, 0, 0))
+            info = zipfile.ZipInfo(name, date_time=date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with self.zip.open(info, "w", force_zip64=True) as member:
+                for block in iter_encoded(chunks, self.encoding):
+                    member.write(block)
+            return
+
+        import tarfile
+
+        # A tar header needs the size up front
+        content = "".join(chunks).encode(self.encoding)
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(content))
+
+    def close(self) -> bool:
+        import filecmp
+
+        self.stack.close()
+        if (
+            self.if_changed
+            and os.path.isfile(self.path)
+            and filecmp.cmp(self.tmp_path, self.path, shallow=False)
+        ):
+            os.unlink(self.tmp_path)
+            return False
+        os.replace(self.tmp_path, self.path)
+        self.replaced = True
+        return True
+
+    def abort(self) -> None:
+        try:
+            self.stack.close()
+        finally:
+            os.unlink(self.tmp_path)
+
+
+class OutputWriter:
+    """
+    Writes rendered output to stdout, to files or into an archive. Output is
+    either a string, or an iterable of chunks (e.g. from ``Template.generate``)
+    that's encoded and written in blocks of ``buffer_size`` as it's produced.
+    Files are compressed when their extension calls for it, e.g. ``.gz``.
+    Without an ``encoding``, stdout's is used for stdout and the locale's for
+    files, as with plain text files.
+
+    Streamed output is written to a temporary file next to the destination
+    and moved into place once complete, so a failed render never leaves a
+    partial file behind. With ``if_changed``, all output is written that way
+    and only moved into place when the content differs from what's already
+    there, leaving unchanged files (and their mtimes) untouched.
+
+    Output past ``max_output_bytes`` (before compression) raises
+    :class:`OutputTooLarge` before it's written.
+    """
+
+    def __init__(
+        self,
+        if_changed: bool = False,
+        archive: ArchiveWriter | None = None,
+        encoding: str | None = None,
+        buffer_size: int = WRITE_BUFFER_SIZE,
+        max_output_bytes: int | None = None,
+    ) -> None:
+        self.if_changed = if_changed
+        self.archive = archive
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.max_output_bytes = max_output_bytes
+        self.changed = 0
+        self.unchanged = 0
+        self.bytes_written = 0
+
+    def file_encoding(self) -> str:
+        if self.encoding is not None:
+            return self.encoding
+        import locale
+
+        return locale.getpreferredencoding(False)
+
+    def write(
+        self, path: str | None, rendered: str | Iterable[str], make_dirs: bool = False
+    ) -> bool:
+        if isinstance(rendered, str):
+            chunks: Iterable[str] = [rendered]
+        else:
+            # Checked as it's rendered, before being buffered into blocks
+            chunks = self.limit_render(rendered, path)
+
+        if path is None:
+            stdout = getattr(sys.stdout, "buffer", None)
+            if stdout is None:
+                # Replaced by something text only, e.g. io.StringIO
+                for chunk in self.limit_render(chunks, path):
+                    sys.stdout.write(chunk)
+                    self.bytes_written += len(chunk)
+                sys.stdout.flush()
+                return True
+            sys.stdout.flush()
+            chunks = translate_newlines(chunks)
+            encoding = self.encoding or sys.stdout.encoding or "utf8"
+            errors = sys.stdout.errors or "strict"
+            blocks = iter_encoded(chunks, encoding, errors, self.buffer_size)
+            for block in self._limit(blocks, path):
+                stdout.write(block)
+            stdout.flush()
+            return True
+
+        if self.archive is not None:
+            # Counted once the archive is closed, see :meth:`count_archive`
+            self.archive.add(path, self._limit_chars(chunks, path))
+            return True
+
+        blocks: Iterable[bytes] = self._limit(
+            iter_encoded(
+                translate_newlines(chunks), self.file_encoding(), "strict", self.buffer_size
+            ),
+            path,
+        )
+        if isinstance(rendered, str):
+            # A single block, encode (and check its size) before opening the file
+            blocks = list(blocks)
+        return self._write_file(
+            path,
+            lambda out: out.writelines(blocks),
+            make_dirs,
+            direct=isinstance(rendered, str),
+        )
+
+    def write_encoded(self, path: str | None, source: IO[bytes], make_dirs: bool = False) -> bool:
+        """
+        Write output that's already UTF-8 encoded, e.g. a render cache entry,
+        from the current position of ``source``. When nothing needs
+        re-encoding or compressing it's copied as is, with ``os.sendfile``
+        where possible.
+        """
+        import codecs
+
+        stdout = getattr(sys.stdout, "buffer", None)
+        if path is None:
+            encoding = self.encoding or getattr(sys.stdout, "encoding", None) or "utf8"
+        else:
+            encoding = self.file_encoding()
+        if (
+            self.archive is not None
+            or (path is None and stdout is None)
+            or (path is not None and compression_for(path) is not None)
+            or codecs.lookup(encoding).name != "utf-8"
+            or os.linesep != "\n"
+        ):
+            rendered = source.read().decode("utf8", "surrogateescape")
+            return self.write(path, rendered, make_dirs)
+
+        size = os.fstat(source.fileno()).st_size - source.tell()
+        self._check_size(size, path)
+
+        if path is None:
+            assert stdout is not None
+            sys.stdout.flush()
+            copy_stream(source, stdout, self.buffer_size)
+            stdout.flush()
+            self.bytes_written += size
+            return True
+
+        changed = self._write_file(
+            path, lambda out: copy_stream(source, out, self.buffer_size), make_dirs, direct=True
+        )
+        self.bytes_written += size
+        return changed
+
+    def _check_size(self, size: int, path: str | None) -> None:
+        if self.max_output_bytes is not None and size > self.max_output_bytes:
+            raise OutputTooLarge(
+                f"{path or '<stdout>'}: output exceeds --max-output-bytes of"
+                f" {format_size(self.max_output_bytes)}"
+            )
+
+    def _limit(self, blocks: Iterable[bytes], path: str | None) -> Iterator[bytes]:
+        written = 0
+        for block in blocks:
+            written += len(block)
+            self._check_size(written, path)
+            self.bytes_written += len(block)
+            yield block
+
+    def limit_render(self, chunks: Iterable[str], path: str | None) -> Iterator[str]:
+        """
+        Pass ``chunks`` through, stopping with :class:`OutputTooLarge` once
+        there are more characters than ``max_output_bytes``, as each takes at
+        least a byte whatever the encoding.
+        """
+        if self.max_output_bytes is None:
+            yield from chunks
+            return
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            self._check_size(written, path)
+            yield chunk
+
+    def _limit_chars(self, chunks: Iterable[str], path: str | None) -> Iterator[str]:
+        # Archive members are encoded by the archive, count characters instead
+        for chunk in self.limit_render(chunks, path):
+            self.bytes_written += len(chunk)
+            yield chunk
+
+    def _write_file(
+        self, path: str, write: Callable[[IO[bytes]], None], make_dirs: bool, direct: bool
+    ) -> bool:
+        if make_dirs:
+            parent = os.path.dirname(path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+
+        if direct and not self.if_changed:
+            # Fully rendered already, nothing can fail halfway through
+            with open_output(path, compression_for(path), self.buffer_size) as out:
+                write(out)
+            self.changed += 1
+            return True
+
+        changed = self._replace(path, write, only_if_changed=self.if_changed)
+        if changed:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+        return changed
+
+    def _replace(
+        self, path: str, write: Callable[[IO[bytes]], None], only_if_changed: bool
+    ) -> bool:
+        import filecmp
+        import tempfile
+
+        # Replace the target of a symlink, not the link itself
+        path = os.path.realpath(path)
+        directory, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        try:
+            with open_output(fd, compression_for(path), self.buffer_size) as out:
+                write(out)
+
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+
+            if (
+                only_if_changed
+                and st is not None
+                and st.st_size == os.path.getsize(tmp_path)
+                and filecmp.cmp(tmp_path, path, shallow=False)
+            ):
+                os.unlink(tmp_path)
+                return False
+
+            if st is not None:
+                os.chmod(tmp_path, st.st_mode & 0o7777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+            return True
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def count_archive(self) -> None:
+        """Count the archive's members as changed or not, once it's closed."""
+        if self.archive is None:
+            return
+        if self.archive.replaced:
+            self.changed += self.archive.members
+        else:
+            self.unchanged += self.archive.members
+
+    def report(self, file: IO[str] | None = None) -> None:
+        print(f"{self.changed} changed, {self.unchanged} unchanged", file=file or sys.stderr)
+
+
+def format_size(size: float) -> str:
+    """Format a byte size the way :func:`parse_size` reads it, e.g. ``1.5M``."""
+    for unit in ("", "K", "M", "G"):
+        if abs(size) < 1024 or unit == "G":
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == "" else f"{size:.1f}{unit}"
+
+
+class MemoryReport:
+    """
+    Accounts memory allocated by each stage of a run (data parse, merge,
+    render, write) with tracemalloc. A stage may be entered any number of
+    times, e.g. once per output; the memory it left allocated is summed, and
+    its peak is the most memory traced at any point while it ran.
+    """
+
+    def __init__(self) -> None:
+        import tracemalloc
+
+        self.stages: dict[str, list[int]] = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        import tracemalloc
+
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        else:
+            # Before Python 3.9 the peak only resets on a restart, which forgets what's traced
+            tracemalloc.stop()
+            tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            after, peak = tracemalloc.get_traced_memory()
+            totals = self.stages.setdefault(name, [0, 0])
+            totals[0] += after - before
+            totals[1] = max(totals[1], peak)
+
+    @staticmethod
+    def peak_rss() -> int | None:
+        """Peak resident set size of this process in bytes, if known."""
+        try:
+            import resource
+        except ImportError:
+            return None
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, kilobytes everywhere else
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def report(self, file: IO[str] | None = None) -> None:
+        file = file or sys.stderr
+        print(f"{'stage':<8} {'allocated':>10} {'peak':>10}", file=file)
+        for name, (allocated, peak) in self.stages.items():
+            print(f"{name:<8} {format_size(allocated):>10} {format_size(peak):>10}", file=file)
+        rss = self.peak_rss()
+        if rss is not None:
+            print(f"peak RSS: {format_size(rss)}", file=file)
+
+
+class FilterStats:
+    """
+    Instruments an environment's filters: with ``timed``, every call is
+    counted and timed, and filters listed in ``memoize`` are wrapped in a
+    bounded LRU cache keyed by their (typed) arguments. Memoizing only makes
+    sense for pure filters; calls with unhashable arguments, such as lists
+    or dicts, always go through to the filter.
+    """
+
+    def __init__(self, timed: bool = False, memoize: Iterable[str] = (), memo_size: int = 1024):
+        self.timed = timed
+        self.memoize = set(memoize)
+        self.memo_size = memo_size
+        # name -> [calls, seconds]
+        self.calls: dict[str, list[float]] = {}
+        # name -> [hits, misses, unhashable]
+        self.memo: dict[str, list[int]] = {}
+        self._caches: dict[str, Any] = {}
+
+    def instrument(self, filters: MutableMapping[str, Callable[..., Any]]) -> None:
+        """Replace ``filters`` in place. Must happen before templates are compiled."""
+        unknown = self.memoize.difference(filters)
+        if unknown:
+            raise InvalidUsage(f"unknown filter: {', '.join(sorted(unknown))}")
+        for name, fn in list(filters.items()):
+            if name in self.memoize:
+                fn = self._memoized(name, fn)
+            if self.timed:
+                fn = self._timed(name, fn)
+            filters[name] = fn
+
+    def _memoized(self, name: str, fn: Callable) -> Callable:
+        import functools
+
+        if getattr(fn, "jinja_pass_arg", None) is not None:
+            raise InvalidUsage(f"{name} is passed the environment or context and can't be memoized")
+
+        def call(args: tuple, kwargs: tuple, types: tuple) -> Any:
+            return fn(*args, **dict(kwargs))
+
+        cached = functools.lru_cache(maxsize=self.memo_size)(call)
+        self._caches[name] = cached
+        stats = self.memo[name] = [0, 0, 0]
+
+        @functools.wraps(fn)
+        def memoized(*args: Any, **kwargs: Any) -> Any:
+            key = tuple(kwargs.items())
+            try:
+                hash(args)
+                hash(key)
+            except TypeError:
+                stats[2] += 1
+                return fn(*args, **kwargs)
+            # Equal arguments of different types, e.g. Markup("<b>") and "<b>"
+            # or 1 and True, can give different results
+            return cached(args, key, (*map(type, args), *map(type, kwargs.values())))
+
+        return memoized
+
+    def _timed(self, name: str, fn: Callable) -> Callable:
+        import functools
+        import time
+
+        stats = self.calls[name] = [0, 0.0]
+        perf_counter = time.perf_counter
+
+        @functools.wraps(fn)
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stats[0] += 1
+                stats[1] += perf_counter() - start
+
+        return timed
+
+    def report(self, file: IO[str] | None = None) -> None:
+        file = file or sys.stderr
+        for name, cached in self._caches.items():
+            info = cached.cache_info()
+            self.memo[name][:2] = [info.hits, info.misses]
+
+        print(f"{'calls':>10} {'time':>9} {'per call':>10} {'hit rate':>9}  filter", file=file)
+        names = sorted(
+            set(self.memo).union(name for name, (calls, _) in self.calls.items() if calls),
+            key=lambda name: self.calls.get(name, [0, 0.0])[1],
+            reverse=True,
+        )
+        for name in names:
+            calls, seconds = self.calls.get(name, [0, 0.0])
+            per_call = f"{seconds / calls * 1e6:.1f}us" if calls else "-"
+            hit_rate = "-"
+            if name in self.memo:
+                hits, misses, unhashable = self.memo[name]
+                lookups = hits + misses + unhashable
+                hit_rate = f"{hits / lookups:.1%}" if lookups else "-"
+            print(
+                f"{int(calls):>10} {seconds:8.4f}s {per_call:>10} {hit_rate:>9}  {name}", file=file
+            )
+        for name, (hits, misses, unhashable) in self.memo.items():
+            if unhashable:
+                print(
+                    f"{name}: {unhashable} calls with unhashable arguments weren't cached",
+                    file=file,
+                )
+
+
+class Histogram:
+    """
+    A latency histogram of :class:`Metrics`: how many observations were at
+    most each of ``Metrics.BUCKETS``, and the sum and count of all of them.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.buckets = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, other: Histogram) -> None:
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.total += other.total
+        self.count += other.count
+
+
+class Metrics:
+    """
+    Counters and latency histograms for a run, written to ``path`` as a
+    Prometheus textfile (for node_exporter's textfile collector) when it
+    ends in ``.prom``, or as a JSON snapshot otherwise. :meth:`tick` writes
+    them every ``interval`` seconds as well, for runs rendering many
+    outputs.
+
+    Objects with ``hits`` and ``misses`` counts, like :class:`RenderCache`,
+    are registered with :meth:`watch_cache` and read whenever the metrics
+    are written.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PREFIX = "jinja2_"
+    HELP: ClassVar[dict[str, str]] = {
+        "renders_total": "Outputs rendered, not counting ones reused from the render cache",
+        "bytes_written_total": "Bytes of output written, before compression",
+        "cache_hits_total": "Lookups served by a cache",
+        "cache_misses_total": "Lookups not served by a cache",
+        "errors_total": "Runs that failed, by exception class",
+        "fetch": "Time spent fetching URL data sources",
+        "parse": "Time spent parsing each data source",
+        "compile": "Time spent compiling the template",
+        "render": "Time spent rendering and writing each output",
+        "run_seconds": "Time since the run started",
+        "renders_per_second": "Outputs rendered per second over the run",
+    }
+
+    def __init__(self, path: str, interval: float | None = None) -> None:
+        import time
+
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self.last_write = time.monotonic()
+        self.counters: dict[tuple[str, str | None], float] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.caches: dict[str, Any] = {}
+        self.counted: list[tuple[str, Callable[[], float]]] = []
+
+    def inc(self, name: str, value: float = 1, label: str | None = None) -> None:
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Add ``seconds`` to the latency histogram of stage ``name``."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(len(self.BUCKETS))
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram.buckets[index] += 1
+        histogram.total += seconds
+        histogram.count += 1
+
+    @contextmanager
+    def timed(self, name: str) -> Generator[None, None, None]:
+        import time
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def error(self, exc: BaseException) -> None:
+        # A failed -j run is counted by what went wrong in each worker
+        for name in getattr(exc, "error_types", None) or [type(exc).__name__]:
+            self.inc("errors_total", label=name)
+
+    def watch_cache(self, name: str, cache: Any) -> None:
+        self.caches[name] = cache
+
+    def watch_counter(self, name: str, read: Callable[[], float]) -> None:
+        """Read counter ``name`` from ``read()`` whenever the metrics are written."""
+        self.counted.append((name, read))
+
+    def state(self) -> dict:
+        """Every counter, watched ones included, and histogram, for :meth:`merge`."""
+        counters = dict(self.counters)
+        for name, cache in self.caches.items():
+            for counter, value in (
+                ("cache_hits_total", cache.hits),
+                ("cache_misses_total", cache.misses),
+            ):
+                counters[(counter, name)] = counters.get((counter, name), 0) + value
+        for name, read in self.counted:
+            counters[(name, None)] = counters.get((name, None), 0) + read()
+        return {"counters": counters, "histograms": self.histograms}
+
+    def reset(self) -> None:
+        """Start over from zero, e.g. in a forked worker whose counts are merged back."""
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, state: dict) -> None:
+        for (name, label), value in state["counters"].items():
+            self.inc(name, value, label)
+        for name, histogram in state["histograms"].items():
+            self.histograms.setdefault(name, Histogram(len(self.BUCKETS))).add(histogram)
+
+    def tick(self) -> None:
+        """Write the metrics if ``interval`` seconds passed since they last were."""
+        import time
+
+        if self.interval is not None and time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self) -> None:
+        import tempfile
+        import time
+
+        state = self.state()
+        run_seconds = time.time() - self.started
+        renders = state["counters"].get(("renders_total", None), 0)
+        gauges = {
+            "run_seconds": run_seconds,
+            "renders_per_second": renders / run_seconds if run_seconds > 0 else 0.0,
+        }
+        if self.path.endswith(".prom"):
+            content = self._prometheus(state, gauges)
+        else:
+            content = self._json(state, gauges)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".metrics.", suffix=".tmp", dir=directory)
+        try:
+            with open(fd, "w") as fp:
+                fp.write(content)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.last_write = time.monotonic()
+
+    def _prometheus(self, state: dict, gauges: dict[str, float]) -> str:
+        lines = []
+
+        def header(name: str, kind: str, help: str) -> None:
+            lines.append(f"# HELP {self.PREFIX}{name} {help}")
+            lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+
+        label_names = {"cache_hits_total": "cache", "cache_misses_total": "cache"}
+        counters = state["counters"]
+        for name in sorted({name for name, _ in counters}):
+            header(name, "counter", self.HELP.get(name, name))
+            for (counter, label), value in sorted(counters.items(), key=lambda item: str(item[0])):
+                if counter != name:
+                    continue
+                if label is None:
+                    lines.append(f"{self.PREFIX}{name} {value:g}")
+                else:
+                    label_name = label_names.get(name, "type")
+                    escaped = label.replace("\\", "\\\\").replace('"', '\\"')
+                    lines.append(f'{self.PREFIX}{name}{{{label_name}="{escaped}"}} {value:g}')
+
+        for stage in sorted(state["histograms"]):
+            histogram = state["histograms"][stage]
+            name = f"{stage}_seconds"
+            header(name, "histogram", self.HELP.get(stage, name))
+            for bound, bucket in zip(self.BUCKETS, histogram.buckets):
+                lines.append(f'{self.PREFIX}{name}_bucket{{le="{bound:g}"}} {bucket}')
+            lines.append(f'{self.PREFIX}{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{self.PREFIX}{name}_sum {histogram.total:.6f}")
+            lines.append(f"{self.PREFIX}{name}_count {histogram.count}")
+
+        for name, value in gauges.items():
+            header(name, "gauge", self.HELP.get(name, name))
+            lines.append(f"{self.PREFIX}{name} {value:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def _json(self, state: dict, gauges: dict[str, float]) -> str:
+        import json
+        import time
+
+        counters: dict[str, Any] = {}
+        for (name, label), value in sorted(
+            state["counters"].items(), key=lambda item: str(item[0])
+        ):
+            if label is None:
+                counters[name] = value
+            else:
+                counters.setdefault(name, {})[label] = value
+
+        hits = counters.get("cache_hits_total", {})
+        misses = counters.get("cache_misses_total", {})
+        hit_rates = {}
+        for name in sorted(set(hits) | set(misses)):
+            lookups = hits.get(name, 0) + misses.get(name, 0)
+            hit_rates[name] = hits.get(name, 0) / lookups if lookups else None
+
+        histograms = {}
+        for stage in sorted(state["histograms"]):
+            histogram = state["histograms"][stage]
+            buckets = zip(self.BUCKETS, histogram.buckets)
+            histograms[f"{stage}_seconds"] = {
+                "count": histogram.count,
+                "sum": histogram.total,
+                "buckets": {
+                    **{f"{bound:g}": bucket for bound, bucket in buckets},
+                    "+Inf": histogram.count,
+                },
+            }
+
+        snapshot = {
+            "time": time.time(),
+            **gauges,
+            "counters": counters,
+            "cache_hit_rates": hit_rates,
+            "histograms": histograms,
+        }
+        return json.dumps(snapshot, indent=1) + "\n"
+
+
+def metrics_stage(metrics: Metrics | None, name: str) -> AbstractContextManager[None]:
+    if metrics is None:
+        return nullcontext()
+    return metrics.timed(name)
+
+
+class TemplateProfiler:
+    """
+    Line level profiler for templates. While :meth:`active`, every frame of
+    compiled template code is traced, and the time between one line event
+    and the next (including whatever that line called, such as filters,
+    macros and included templates) is charged to the template line it maps
+    back to through jinja2's debug info. Time spent in each block, macro
+    and template as a whole is accounted for too.
+    """
+
+    # inspect.CO_GENERATOR, inspect itself is slow to import
+    CO_GENERATOR = 0x20
+
+    def __init__(self) -> None:
+        # (filename, template line) -> [seconds, hits]
+        self.lines: dict[tuple[str, int], list[float]] = {}
+        # (filename, label) -> [seconds, calls]
+        self.functions: dict[tuple[str, str], list[float]] = {}
+        self.total = 0.0
+        self._labels: dict[Any, str] = {}
+        self._linenos: dict[tuple[Any, int], int] = {}
+        # frame -> [template line, time of last event, time of call]
+        self._frames: dict[Any, list] = {}
+
+    def _template_of(self, frame: Any) -> Any:
+        return frame.f_globals.get("__jinja_template__")
+
+    def _label(self, frame: Any, template: Any) -> str:
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            label = code.co_name
+            if label.startswith("block_"):
+                label = f"block {label[6:]}"
+            elif label == "macro":
+                # Called from Macro._invoke, which knows the macro's name
+                caller = frame.f_back.f_locals.get("self") if frame.f_back else None
+                label = f"macro {getattr(caller, 'name', None) or '?'}"
+            elif label == "root":
+                label = "(template)"
+            self._labels[code] = label
+        return label
+
+    def _lineno(self, frame: Any, template: Any) -> int:
+        key = (frame.f_code, frame.f_lineno)
+        lineno = self._linenos.get(key)
+        if lineno is None:
+            lineno = self._linenos[key] = template.get_corresponding_lineno(frame.f_lineno)
+        return lineno
+
+    def _trace(self, frame: Any, event: str, arg: Any) -> Any:
+        if event != "call":
+            return None
+        template = self._template_of(frame)
+        if template is None:
+            return None
+        import time
+
+        now = time.perf_counter()
+        # Generators (the template root and blocks) are called again on every resume
+        self._frames[frame] = [None, now, now]
+        return self._trace_lines
+
+    def _trace_lines(self, frame: Any, event: str, arg: Any) -> Any:
+        import time
+
+        now = time.perf_counter()
+        state = self._frames.get(frame)
+        if state is None:
+            return self._trace_lines
+        template = self._template_of(frame)
+        filename = template.name or template.filename or "<string>"
+        lineno, last, called = state
+        if lineno is not None:
+            stats = self.lines.setdefault((filename, lineno), [0.0, 0])
+            stats[0] += now - last
+        if event == "line":
+            lineno = self._lineno(frame, template)
+            self.lines.setdefault((filename, lineno), [0.0, 0])[1] += 1
+            state[0] = lineno
+            state[1] = time.perf_counter()
+        elif event == "return":
+            stats = self.functions.setdefault((filename, self._label(frame, template)), [0.0, 0])
+            stats[0] += now - called
+            # A generator returning for good, rather than just yielding
+            if arg is None or not frame.f_code.co_flags & self.CO_GENERATOR:
+                stats[1] += 1
+            del self._frames[frame]
+        return self._trace_lines
+
+    @contextmanager
+    def active(self) -> Generator[None, None, None]:
+        import threading
+        import time
+
+        start = time.perf_counter()
+        previous = sys.gettrace()
+        threading.settrace(self._trace)
+        sys.settrace(self._trace)
+        try:
+            yield
+        finally:
+            sys.settrace(previous)
+            threading.settrace(previous)
+            self.total += time.perf_counter() - start
+
+    def _source_line(self, filename: str, lineno: int, loader: Any) -> str:
+        try:
+            source = loader.get_source(None, filename)[0] if loader is not None else ""
+        except Exception:  # noqa: BLE001 - the source is only a nicety in the report
+            return ""
+        lines = source.splitlines()
+        return lines[lineno - 1].strip() if 0 < lineno <= len(lines) else ""
+
+    def report(self, loader: Any = None, limit: int = 25, file: IO[str] | None = None) -> None:
+        file = file or sys.stderr
+        total = self.total or 1.0
+
+        print(f"{'time':>9} {'%':>6} {'hits':>8}  line", file=file)
+        hot = sorted(self.lines.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        for (filename, lineno), (seconds, hits) in hot:
+            source = self._source_line(filename, lineno, loader)
+            line = f"{seconds:8.4f}s {seconds / total:6.1%} {int(hits):>8}  {filename}:{lineno}"
+            print(f"{line}  {source}"[:120].rstrip(), file=file)
+
+        print(f"\n{'time':>9} {'%':>6} {'calls':>8}  block / macro", file=file)
+        hot = sorted(self.functions.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        for (filename, label), (seconds, calls) in hot:
+            line = f"{seconds:8.4f}s {seconds / total:6.1%} {int(calls):>8}  {filename} {label}"
+            print(line, file=file)
+        print(f"\ntotal render time: {self.total:.4f}s", file=file)
+
+
+def memory_stage(memory: MemoryReport | None, name: str) -> AbstractContextManager[None]:
+    return memory.stage(name) if memory is not None else nullcontext()
+
+
+def limit_memory(max_memory: int) -> None:
+    """
+    Cap the address space of this process at ``max_memory`` bytes, so a
+    runaway render raises ``MemoryError`` instead of swapping the host.
+    """
+    try:
+        import resource
+    except ImportError:
+        raise InvalidUsage("--max-memory isn't supported on this platform")
+
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_memory = min(max_memory, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, hard))
+    except (ValueError, OSError) as e:
+        raise InvalidUsage(f"can't limit memory to {format_size(max_memory)}: {e}")
+
+
+def split_extension_path(extension: str) -> tuple[str, str | None]:
+    if ":" in extension:
+        module_name, object_name = extension.split(":", 1)
+        return module_name, object_name or None
+    module_name, _, object_name = extension.rpartition(".")
+    if module_name:
+        return module_name, object_name or None
+    return extension, None
+
+
+def load_local_module(module_name: str, base_dir: str) -> ModuleType | None:
+    module_path = os.path.join(base_dir, *module_name.split("."))
+    for candidate in (f"{module_path}.py", os.path.join(module_path, "__init__.py")):
+        if not os.path.isfile(candidate):
+            continue
+        spec = importlib.util.spec_from_file_location(module_name, candidate)
+        if spec is None or spec.loader is None:
+            return None
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+        return module
+    return None
+
+
+def resolve_extension(extension: ExtensionSpec, base_dir: str) -> ExtensionSpec:
+    if not isinstance(extension, str):
         return extension
     if extension.startswith("jinja2.ext."):
         return extension
@@ -466,7 +3402,9 @@ def resolve_extension(extension: ExtensionSpec, base_dir: str) -> ExtensionSpec:
     return module
 
 
-def cli(opts: argparse.Namespace, args: Sequence[str]) -> int:
+def cli(opts: argparse.Namespace, args: Sequence[str], metrics: Metrics | None = None) -> int:
+    import time
+
     template_string: str | None = None
     template_path: str | None = None
 
@@ -474,13 +3412,30 @@ def cli(opts: argparse.Namespace, args: Sequence[str]) -> int:
         # Stream mode: read template from stdin, all args are data files
         template_string = sys.stdin.read()
         data_files = args
+    elif opts.dump_data:
+        # Nothing is rendered, all args are data files
+        data_files = args
     else:
         # Normal mode: first arg is template, rest are data files
         template_path_arg = args[0]
         data_files = args[1:]
         template_path = os.path.abspath(template_path_arg)
 
-    data: dict = {}
+    if opts.archive and not opts.outfile:
+        raise InvalidUsage("--archive requires -o/--outfile as the member name")
+
+    manifest = None
+    if opts.manifest:
+        if opts.outfile is None:
+            raise InvalidUsage("--manifest requires -o/--outfile")
+        if opts.archive:
+            raise InvalidUsage("--manifest can't be combined with --archive")
+        manifest = BuildManifest(opts.manifest, options_digest(opts, args, exclude=("manifest",)))
+        if template_string is not None:
+            # Already read, so it's compared like any other input
+            manifest.add_stdin(template_string, manifest.STDIN_TEMPLATE)
+        if manifest.is_up_to_date():
+            return 0
 
     # Determine if we're reading from stdin or files
     if not data_files:
@@ -497,73 +3452,82 @@ def cli(opts: argparse.Namespace, args: Sequence[str]) -> int:
     if has_stdin and len(data_files) > 1:
         raise InvalidUsage("cannot mix stdin (-) with file arguments")
 
-    # Load and merge multiple data files
-    for data_file in data_files:
-        format = opts.format
-        data_content = ""
-
-        if data_file in ("-", ""):
-            if data_file == "-" or (data_file == "" and not sys.stdin.isatty()):
-                data_content = sys.stdin.read()
-            if format == "auto":
-                # default to yaml first if available since yaml
-                # is a superset of json
-                if has_format("yaml"):
-                    format = "yaml"
-                else:
-                    format = "json"
-        else:
-            path = os.path.join(os.getcwd(), os.path.expanduser(data_file))
-            if format == "auto":
-                ext = os.path.splitext(path)[1][1:]
-                if has_format(ext):
-                    format = ext
-                else:
-                    raise InvalidDataFormat(ext)
-
-            with open(path) as fp:
-                data_content = fp.read()
+    memory = MemoryReport() if opts.memory_report else None
 
-        if data_content:
-            try:
-                fn, except_exc, raise_exc = get_format(format)
-            except InvalidDataFormat:
-                if format in ("yml", "yaml"):
-                    raise InvalidDataFormat(f"{format}: install pyyaml to fix")
-                if format == "toml":
-                    raise InvalidDataFormat("toml: install tomli to fix")
-                if format == "xml":
-                    raise InvalidDataFormat("xml: install xmltodict to fix")
-                if format == "hjson":
-                    raise InvalidDataFormat("hjson: install hjson to fix")
-                if format == "json5":
-                    raise InvalidDataFormat("json5: install json5 to fix")
-                raise
-            try:
-                parsed = fn(data_content) or {}
-                deep_merge(data, parsed)
-            except except_exc:
-                raise raise_exc(f"{data_content[:60]} ...")
+    sources: list[str] = []
+    if opts.data_snapshot:
+        if any(f != "" for f in data_files):
+            raise InvalidUsage("--data-snapshot can't be combined with data files")
+        with memory_stage(memory, "parse"):
+            data = load_data_snapshot(opts.data_snapshot)
+        if manifest is not None:
+            manifest.add_input(opts.data_snapshot)
+    else:
+        compactor = None
+        if opts.compact_data or opts.compact_records:
+            compactor = Compactor(records=opts.compact_records)
+        remote = RemoteData(opts.url_cache, opts.url_timeout)
+        data = load_data(
+            data_files, opts.format, manifest, memory, compactor, opts.section, remote, metrics
+        )
+        if metrics is not None and opts.url_cache:
+            metrics.inc("cache_hits_total", remote.hits, "url")
+            metrics.inc("cache_misses_total", remote.misses, "url")
+        sources = [
+            os.path.join(os.getcwd(), os.path.expanduser(f))
+            for f in data_files
+            if f not in ("-", "") and not is_url(f)
+        ]
 
     extensions = []
     for ext in opts.extensions:
+        if ext == "cache":
+            # Ours, jinja2 has no cache extension
+            extensions.append(fragment_cache_extension())
+            continue
         # Allow shorthand and assume if it's not a module
         # path, it's probably trying to use builtin from jinja2
         if "." not in ext and ":" not in ext:
             ext = f"jinja2.ext.{ext}"
         extensions.append(resolve_extension(ext, os.getcwd()))
 
-    # Use only a specific section if needed
-    if opts.section:
-        section = opts.section
-        if section in data:
-            data = data[section]
-        else:
-            raise InvalidUsage(f"unknown section: {section}")
-
-    deep_merge(data, parse_kv_string(opts.D or []))
-
-    rendered = render(
+    with memory_stage(memory, "merge"):
+        deep_merge(data, parse_kv_string(opts.D or []))
+
+    # Lazy sources are bound last, nothing above needs to look inside them.
+    # Output is then streamed as well, so the whole thing runs in constant memory.
+    # So it is under --max-output-bytes, to stop a render as soon as it's too large.
+    stream_output = (bool(opts.lazy) or opts.max_output_bytes is not None) and not opts.cache_dir
+    for spec in opts.lazy:
+        key, source = load_lazy(spec)
+        *parents, leaf = key.split(".")
+        current = data
+        for parent in parents:
+            current = current.setdefault(parent, {})
+        current[leaf] = source
+        if manifest is not None:
+            manifest.add_input(source.path)
+
+    if opts.dump_data:
+        dump_data_snapshot(opts.dump_data, data, sources)
+        if memory is not None:
+            memory.report()
+        return 0
+
+    if opts.each and not opts.outfile:
+        raise InvalidUsage("--each requires -o/--outfile as an output path template")
+    if (opts.shard or opts.shard_timings or opts.record_timings) and not opts.each:
+        raise InvalidUsage("--shard, --shard-timings and --record-timings require --each")
+    if opts.jobs > 1:
+        if not opts.each:
+            raise InvalidUsage("--jobs requires --each")
+        for option in ("archive", "memory_report", "profile_template", "filter_stats"):
+            if getattr(opts, option):
+                flag = "--" + option.replace("_", "-")
+                raise InvalidUsage(f"{flag} can't be combined with --jobs")
+
+    environ = EnvironReader(opts.strict)
+    env = make_environment(
         template_path,
         data,
         extensions,
@@ -582,18 +3546,688 @@ def cli(opts: argparse.Namespace, args: Sequence[str]) -> int:
         line_comment_prefix=opts.line_comment_prefix,
         newline_sequence=opts.newline_sequence,
         search_paths=opts.search_paths,
-        template_string=template_string,
+        sandbox=opts.sandbox,
+        max_operations=opts.max_operations,
+        index_templates=opts.index_templates,
+        template_index_file=opts.template_index_file,
+        environ=environ,
     )
+    if opts.compact_records:
+        # json.dumps only knows real dicts, let tojson serialize rows too
+        env.policies["json.dumps_kwargs"] = {
+            **env.policies["json.dumps_kwargs"],
+            "default": mapping_to_json,
+        }
+    fragment_cache: FragmentCache | None = getattr(env, "fragment_cache", None)
+    if opts.fragment_cache_dir or opts.fragment_cache_size is not None:
+        if fragment_cache is None:
+            raise InvalidUsage("--fragment-cache-dir and --fragment-cache-size require -e cache")
+        fragment_cache.directory = opts.fragment_cache_dir
+        fragment_cache.ttl = opts.cache_ttl
+        fragment_cache.max_size = opts.cache_max_size
+        if opts.fragment_cache_size is not None:
+            fragment_cache.size = opts.fragment_cache_size
+    filter_stats = None
+    if opts.filter_stats or opts.memoize_filters:
+        filter_stats = FilterStats(opts.filter_stats, opts.memoize_filters, opts.memoize_size)
+        filter_stats.instrument(env.filters)
+    # Every template file loaded, for the manifest and the render cache
+    loaded: set[str] = set()
+    if (manifest is not None or opts.cache_dir) and env.loader is not None:
+        env.loader = make_tracking_loader(env.loader, loaded)
+    extensions_used = [type(ext) for ext in env.extensions.values()]
+    modules = module_files([*env.filters.values(), *extensions_used])
+
+    # Compiled once, no matter how many outputs it's rendered into
+    with metrics_stage(metrics, "compile"):
+        template = load_template(env, template_path, template_string)
+
+    cache = None
+    cache_base = ""
+    if opts.cache_dir:
+        cache = RenderCache(opts.cache_dir, opts.cache_ttl, opts.cache_max_size)
+        cache_base = cache.key(
+            options_digest(opts, [], exclude=CACHE_EXCLUDED_OPTIONS),
+            template_path or "",
+            template_string if template_string is not None else file_digest(template_path or ""),
+            *sorted(f"{filename}:{file_digest(filename)}" for filename in modules),
+            data_digest(data),
+        )
 
-    if opts.outfile is None:
-        sys.stdout.write(rendered)
-        sys.stdout.flush()
+    template_name = os.path.basename(template_path) if template_path else "<stdin>"
+    profiler = TemplateProfiler() if opts.profile_template else None
+    if opts.each:
+        jobs: Iterable[tuple[str | None, dict]] = iter_fan_out(env, data, opts.each, opts.outfile)
     else:
-        with open(opts.outfile, "w") as out:
-            out.write(rendered)
+        jobs = [(opts.outfile, data)]
+
+    shard = None
+    if opts.shard is not None:
+        shard = Shard(*opts.shard, timings=load_timings(opts.shard_timings))
+    timings: dict[str, float] = {}
+
+    with ExitStack() as stack:
+        archive = None
+        if opts.archive:
+            archive = stack.enter_context(
+                ArchiveWriter(
+                    opts.archive,
+                    if_changed=opts.if_changed,
+                    encoding=opts.output_encoding or "utf8",
+                )
+            )
+        writer = OutputWriter(
+            if_changed=opts.if_changed,
+            archive=archive,
+            encoding=opts.output_encoding,
+            buffer_size=opts.buffer_size,
+            max_output_bytes=opts.max_output_bytes,
+        )
+        if metrics is not None:
+            if cache is not None:
+                metrics.watch_cache("render", cache)
+            if fragment_cache is not None:
+                metrics.watch_cache("fragment", fragment_cache)
+            metrics.watch_counter("bytes_written_total", lambda: writer.bytes_written)
+
+        def render_job(path: str | None, context: dict) -> None:
+            if manifest is not None and path is not None and manifest.output_up_to_date(path):
+                manifest.keep_output(path)
+                return
+
+            name = path or template_name
+            cached = None
+            if cache is not None:
+                key = (
+                    cache.key(cache_base, data_digest(context["item"])) if opts.each else cache_base
+                )
+                cached = cache.open(key)
+            if cached is not None:
+                entry, deps = cached
+                with entry, memory_stage(memory, "write"):
+                    writer.write_encoded(path, entry, make_dirs=bool(opts.each))
+                if manifest is not None:
+                    for filename in deps:
+                        manifest.add_input(filename)
+            else:
+                started = time.perf_counter()
+                if metrics is not None:
+                    metrics.inc("renders_total")
+                limits = render_limits(env, opts.timeout, name)
+                profiling = profiler.active() if profiler is not None else nullcontext()
+                if stream_output:
+                    # Rendered as it's written, so both count as rendering
+                    with memory_stage(memory, "render"), limits, profiling:
+                        writer.write(path, template.generate(context), make_dirs=bool(opts.each))
+                else:
+                    with memory_stage(memory, "render"), limits, profiling:
+                        if opts.max_output_bytes is not None:
+                            # Cached whole, but still stopped once it's too large
+                            rendered = "".join(
+                                writer.limit_render(template.generate(context), path)
+                            )
+                        else:
+                            rendered = template.render(context)
+                    if cache is not None:
+                        cache.put(key, rendered, loaded, environ.reads)
+                    with memory_stage(memory, "write"):
+                        writer.write(path, rendered, make_dirs=bool(opts.each))
+                    del rendered
+                elapsed = time.perf_counter() - started
+                if metrics is not None:
+                    metrics.observe("render", elapsed)
+                if opts.record_timings and path is not None:
+                    timings[path] = elapsed
+
+            if manifest is not None and path is not None:
+                manifest.add_output(path)
+
+        selected = (
+            (path, context)
+            for path, context in jobs
+            if shard is None or path is None or shard.owns(path)
+        )
+        if opts.jobs == 1:
+            for path, context in selected:
+                render_job(path, context)
+                if metrics is not None:
+                    metrics.tick()
+        else:
+            # Dealt out up front, so no worker builds the paths and contexts of the others
+            shares: list[list[tuple[str | None, dict]]] = [[] for _ in range(opts.jobs)]
+            for number, job in enumerate(selected):
+                shares[number % opts.jobs].append(job)
+
+            def work(worker: int) -> dict:
+                if metrics is not None:
+                    # Only this worker's share, the parent has the rest
+                    metrics.reset()
+                for path, context in shares[worker]:
+                    render_job(path, context)
+                return {
+                    "metrics": metrics.state() if metrics is not None else None,
+                    "changed": writer.changed,
+                    "unchanged": writer.unchanged,
+                    "timings": timings,
+                    "inputs": manifest.inputs if manifest is not None else {},
+                    "outputs": manifest.outputs if manifest is not None else {},
+                    "loaded": loaded,
+                    "cache_stored": cache is not None and cache.stored,
+                    "fragment_cache_stored": fragment_cache is not None and fragment_cache.stored,
+                }
+
+            try:
+                results = fork_workers(
+                    opts.jobs, work, metrics.state if metrics is not None else None
+                )
+            except RenderWorkerError as e:
+                # What every worker rendered, up to a failure, still counts
+                if metrics is not None:
+                    for state in [*e.salvaged, *(result["metrics"] for result in e.results)]:
+                        metrics.merge(state)
+                raise
+            for result in results:
+                writer.changed += result["changed"]
+                writer.unchanged += result["unchanged"]
+                timings.update(result["timings"])
+                if manifest is not None:
+                    manifest.inputs.update(result["inputs"])
+                    manifest.outputs.update(result["outputs"])
+                loaded.update(result["loaded"])
+                if cache is not None and result["cache_stored"]:
+                    cache.stored = True
+                if fragment_cache is not None and result["fragment_cache_stored"]:
+                    fragment_cache.stored = True
+                if metrics is not None:
+                    metrics.merge(result["metrics"])
+
+    writer.count_archive()
+    if cache is not None:
+        cache.evict()
+    if fragment_cache is not None:
+        fragment_cache.evict()
+
+    if opts.record_timings:
+        save_timings(opts.record_timings, timings)
+
+    if manifest is not None:
+        for filename in loaded:
+            manifest.add_input(filename)
+        for filename in modules:
+            manifest.add_input(filename)
+        manifest.save()
+
+    if opts.if_changed and opts.outfile is not None:
+        writer.report()
+    if memory is not None:
+        memory.report()
+    if profiler is not None:
+        profiler.report(env.loader)
+    if filter_stats is not None and opts.filter_stats:
+        filter_stats.report()
     return 0
 
 
+class RenderWorkerError(Exception):
+    """
+    One or more workers failed. ``error_types`` names the class of each original
+    error, ``salvaged`` holds what was salvaged from each failed worker and
+    ``results`` what the others returned.
+    """
+
+    def __init__(
+        self, message: str, types: list[str], salvaged: list[Any], results: list[Any]
+    ) -> None:
+        super().__init__(message)
+        self.error_types = types
+        self.salvaged = salvaged
+        self.results = results
+
+
+def fork_workers(
+    count: int, work: Callable[[int], Any], salvage: Callable[[], Any] | None = None
+) -> list[Any]:
+    """
+    Call ``work(index)`` in ``count`` forked child processes and return what
+    each call returned. Everything the parent built so far (parsed data,
+    environment, compiled templates) is shared copy-on-write with the
+    children, and moved out of reach of the garbage collector first with
+    ``gc.freeze()``, so collections in the children don't touch, and so
+    copy, those pages. Failures are collected into a :class:`RenderWorkerError`,
+    along with what ``salvage()`` returned in each failed child.
+    """
+    import gc
+    import pickle
+
+    if not hasattr(os, "fork"):
+        raise InvalidUsage("--jobs isn't supported on this platform")
+
+    # Anything buffered would be written once per child otherwise
+    sys.stdout.flush()
+    sys.stderr.flush()
+    gc.freeze()
+
+    results = []
+    errors = []
+    types = []
+    salvaged = []
+    try:
+        children = []
+        for index in range(count):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                status = 0
+                try:
+                    result: tuple = (True, work(index))
+                except BaseException as e:  # noqa: BLE001 - reported by the parent
+                    status = 1
+                    message = f"{type(e).__name__}: {format_exception_message(e)}"
+                    result = (False, (message, type(e).__name__, salvage() if salvage else None))
+                try:
+                    with open(write_fd, "wb") as fp:
+                        pickle.dump(result, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                    sys.stderr.flush()
+                finally:
+                    # Skip the parent's cleanup, e.g. exit handlers and ExitStacks
+                    os._exit(status)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+
+        for index, (pid, read_fd) in enumerate(children, 1):
+            with open(read_fd, "rb") as fp:
+                payload = fp.read()
+            _, status = os.waitpid(pid, 0)
+            if payload:
+                ok, value = pickle.loads(payload)
+            else:
+                ok, value = False, (f"exited with status {status}", "RenderWorkerError", None)
+            if ok:
+                results.append(value)
+            else:
+                message, name, partial = value
+                errors.append(f"worker {index}: {message}")
+                types.append(name)
+                if partial is not None:
+                    salvaged.append(partial)
+    finally:
+        gc.unfreeze()
+    if errors:
+        raise RenderWorkerError("; ".join(errors), types, salvaged, results)
+    return results
+
+
+def parse_size(value: str) -> int:
+    """Parse a byte size with an optional K, M or G suffix, e.g. ``512M``."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B")
+    multiplier = 1
+    if value and value[-1] in units:
+        multiplier = units[value[-1]]
+        value = value[:-1]
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+
+
+SNAPSHOT_MAGIC = b"jinja2-cli data snapshot 1\n"
+
+
+def dump_data_snapshot(path: str, data: Any, sources: Iterable[str]) -> None:
+    """
+    Write ``data`` to a snapshot that :func:`load_data_snapshot` reads back
+    without any parsing or merging. A header records the signature of every
+    source file so a stale snapshot can be detected.
+    """
+    import json
+    import pickle
+    import tempfile
+
+    signatures = {}
+    for source in sources:
+        signature = file_signature(source)
+        if signature is not None:
+            signatures[os.path.abspath(source)] = signature
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".snapshot.", suffix=".tmp", dir=directory)
+    try:
+        with open(fd, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+            fp.write(SNAPSHOT_MAGIC)
+            fp.write(json.dumps({"sources": signatures}).encode() + b"\n")
+            pickle.dump(data, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_data_snapshot(path: str) -> Any:
+    """
+    Load data written by :func:`dump_data_snapshot`, raising
+    :class:`StaleDataSnapshot` if any of its source files changed since.
+    Snapshots are pickles, so only load ones you created yourself.
+    """
+    import gc
+    import json
+    import pickle
+
+    with open(path, "rb", buffering=READ_CHUNK_SIZE) as fp:
+        if fp.readline() != SNAPSHOT_MAGIC:
+            raise InvalidInputData(f"{path}: not a data snapshot")
+        header = json.loads(fp.readline())
+        for source, recorded in header["sources"].items():
+            if not signature_matches(source, recorded):
+                raise StaleDataSnapshot(f"{path}: {source} changed since the snapshot was taken")
+
+        # Unpickling a large tree allocates a lot of containers, none of
+        # which can be garbage yet, so don't let the collector walk them
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.load(fp)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+def select_section(document: Any, section: str) -> tuple[bool, Any]:
+    """
+    Look up ``section`` in a parsed document, as a dotted path
+    (``envs.prod.web``) or failing that as a top-level key, returning
+    ``(found, subtree)``.
+    """
+    current = document
+    for part in section.split("."):
+        if not isinstance(current, dict) or part not in current:
+            break
+        current = current[part]
+    else:
+        return True, current
+    if isinstance(document, dict) and section in document:
+        return True, document[section]
+    return False, None
+
+
+def can_stream_section(section: str) -> bool:
+    """
+    Whether :func:`stream_section` beats a full parse for ``section``: not
+    when ijson isn't installed, only has its pure Python backend, or would
+    read a part of the path as an array item.
+    """
+    if "item" in section.split("."):
+        return False
+    try:
+        import ijson
+    except ImportError:
+        return False
+    return ijson.backend != "python"
+
+
+def stream_section(path: str, section: str) -> tuple[bool, Any]:
+    """
+    Pull just ``section`` out of a JSON file with ijson, never building the
+    rest of the document, returning ``(found, subtree)``. Reading stops at
+    the first match, so the rest of the file isn't checked, and a repeated
+    key resolves to its first value rather than its last as with ``json``.
+    """
+    import ijson
+
+    with open_data(path, binary=True) as fp:
+        try:
+            for subtree in ijson.items(fp, section, use_float=True):
+                return True, subtree
+        except ijson.JSONError as e:
+            raise MalformedJSON(f"{path}: {e}")
+    return False, None
+
+
+def load_data(
+    data_files: Sequence[str],
+    default_format: str,
+    manifest: BuildManifest | None = None,
+    memory: MemoryReport | None = None,
+    compactor: Compactor | None = None,
+    section: str | None = None,
+    remote: RemoteData | None = None,
+    metrics: Metrics | None = None,
+) -> dict:
+    """
+    Load and deep merge data files, ``-`` or ``""`` meaning stdin. URLs are
+    fetched up front, all at once, with ``remote`` (or a
+    :class:`RemoteData` without a cache). With a
+    ``section``, each document is cut down to that subtree before it's
+    merged, see :func:`select_section`, and JSON files are streamed so the
+    rest is never built at all. Raises :class:`InvalidUsage` if no document
+    has the section. With a ``compactor``, each document is compacted
+    before it's merged.
+    """
+    data: dict = {}
+    found_section = False
+    urls = [f for f in data_files if is_url(f)]
+    if urls:
+        if remote is None:
+            remote = RemoteData()
+        with memory_stage(memory, "parse"), metrics_stage(metrics, "fetch"):
+            remote.fetch_all(urls)
+
+    for data_file in data_files:
+        format = default_format
+        data_content: str | bytes = ""
+        parsed: Any = None
+        url = None
+
+        if data_file in ("-", ""):
+            if data_file == "-" or (data_file == "" and not sys.stdin.isatty()):
+                with memory_stage(memory, "parse"):
+                    data_content = read_stdin()
+                if manifest is not None:
+                    manifest.add_stdin(data_content)
+                if format == "auto" and data_content.startswith(CBOR_SELF_DESCRIBE):
+                    format = "cbor"
+                if format not in binary_formats:
+                    data_content = data_content.decode(stdin_encoding())
+        elif is_url(data_file):
+            assert remote is not None
+            url = data_file
+            body, content_type, _ = remote.get(url)
+            if manifest is not None:
+                manifest.add_remote(url, body)
+            media_type, charset = parse_content_type(content_type)
+            if format == "auto":
+                from urllib.parse import urlsplit
+
+                # Servers often say text/plain or octet-stream, so fall back to the extension
+                ext = data_extension(urlsplit(url).path)
+                format = content_type_format(media_type) or "auto"
+                if format == "auto" and ext in formats and has_format(ext):
+                    format = ext
+                if format == "auto" and body.startswith(CBOR_SELF_DESCRIBE):
+                    format = "cbor"
+
+            parsed = remote.load_parsed(url, format)
+            if parsed is None:
+                compression = sniff_compression(body[:16])
+                if compression is not None:
+                    with memory_stage(memory, "parse"):
+                        body = decompress_stream(io.BytesIO(body), compression).read()
+                if format in binary_formats:
+                    data_content = body
+                else:
+                    data_content = body.decode(charset or "utf8")
+            del body
+        else:
+            path = os.path.join(os.getcwd(), os.path.expanduser(data_file))
+            if format == "auto":
+                ext = data_extension(path)
+                if has_format(ext):
+                    format = ext
+                else:
+                    raise InvalidDataFormat(ext)
+
+            if manifest is not None:
+                manifest.add_input(path)
+
+            if section and format == "json" and can_stream_section(section):
+                with memory_stage(memory, "parse"), metrics_stage(metrics, "parse"):
+                    found, parsed = stream_section(path, section)
+                if found:
+                    found_section = True
+                    merge_section(data, parsed, section, memory, compactor)
+                    continue
+                # Not found might still be a top-level key with dots in it,
+                # otherwise the whole file was just read for nothing
+                if "." not in section:
+                    continue
+
+            # Binary formats are parsed from bytes, everything else from text
+            with memory_stage(memory, "parse"), open_data(
+                path, binary=format in binary_formats
+            ) as fp:
+                data_content = fp.read()
+
+        if data_content:
+            if format == "auto":
+                assert isinstance(data_content, str)
+                candidates = sniff_formats(data_content[:SNIFF_SIZE])
+            else:
+                candidates = [format]
+            with memory_stage(memory, "parse"), metrics_stage(metrics, "parse"):
+                parsed = parse_data(data_content, candidates) or {}
+            del data_content
+            if url is not None:
+                assert remote is not None
+                remote.save_parsed(url, format, parsed)
+
+        if parsed is not None:
+            if section:
+                found, parsed = select_section(parsed, section)
+                if not found:
+                    continue
+                found_section = True
+            merge_section(data, parsed, section, memory, compactor)
+
+    if section and not found_section:
+        raise InvalidUsage(f"unknown section: {section}")
+    return data
+
+
+def merge_section(
+    data: dict,
+    parsed: Any,
+    section: str | None,
+    memory: MemoryReport | None,
+    compactor: Compactor | None,
+) -> None:
+    if section and not isinstance(parsed, dict):
+        raise InvalidUsage(f"section {section} is not a mapping")
+    if compactor is not None:
+        with memory_stage(memory, "compact"):
+            parsed = compactor.compact(parsed)
+    with memory_stage(memory, "merge"):
+        deep_merge(data, parsed)
+
+
+class RecordRow(Mapping):
+    """
+    A read-only mapping sharing its keys with every other row of the same
+    layout, holding just a tuple of values, so a list of a million records
+    stores each key once rather than a million times. Looks like a dict to
+    templates: ``row.name``, ``row["name"]``, ``row.items()`` and so on.
+    """
+
+    __slots__ = ("__fields", "__values")
+
+    def __init__(self, fields: dict[Any, int], values: tuple) -> None:
+        self.__fields = fields
+        self.__values = values
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.__values[self.__fields[key]]
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.__fields
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.__fields)
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        index = self.__fields.get(key)
+        return default if index is None else self.__values[index]
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+    def __reduce__(self) -> tuple:
+        return RecordRow, (self.__fields, self.__values)
+
+
+def mapping_to_json(obj: Any) -> dict:
+    """``default`` for ``json.dumps`` serializing any mapping, such as a :class:`RecordRow`."""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class Compactor:
+    """
+    Shrinks parsed data: dict keys are interned, equal strings are replaced
+    by a single shared copy, and with ``records``, lists of at least
+    ``MIN_RECORDS`` dicts that all have the same keys in the same order
+    become lists of :class:`RecordRow`. One compactor is meant to be used
+    for every document of a run, so strings are shared across documents too.
+    """
+
+    MIN_RECORDS = 4
+
+    def __init__(self, records: bool = True) -> None:
+        self.records = records
+        self.strings: dict[str, str] = {}
+        self.layouts: dict[tuple, dict[Any, int]] = {}
+
+    def compact(self, value: Any) -> Any:
+        """Compact ``value``, reusing its containers where possible rather than copying."""
+        if isinstance(value, str):
+            return self.strings.setdefault(value, value)
+        if isinstance(value, dict):
+            intern = sys.intern
+            if all(type(key) is not str or intern(key) is key for key in value):
+                for key, item in value.items():
+                    value[key] = self.compact(item)
+                return value
+            return {
+                intern(key) if type(key) is str else key: self.compact(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            for index, item in enumerate(value):
+                value[index] = self.compact(item)
+            if self.records and len(value) >= self.MIN_RECORDS:
+                self._to_rows(value)
+            return value
+        return value
+
+    def _to_rows(self, items: list) -> None:
+        first = items[0]
+        if type(first) is not dict:
+            return
+        keys = tuple(first)
+        for item in items:
+            if type(item) is not dict or len(item) != len(keys) or tuple(item) != keys:
+                return
+        fields = self.layouts.get(keys)
+        if fields is None:
+            fields = self.layouts[keys] = {key: index for index, key in enumerate(keys)}
+        # In place, so each dict is freed as soon as its row exists
+        for index, item in enumerate(items):
+            items[index] = RecordRow(fields, tuple(item.values()))
+
+
 def deep_merge(target: dict, source: dict) -> dict:
     for key, value in source.items():
         if key in target and isinstance(target[key], dict) and isinstance(value, dict):
@@ -676,6 +4310,19 @@ def run() -> int:
         action="append",
         default=["do", "loopcontrols"],
     )
+    parser.add_argument(
+        "--fragment-cache-dir",
+        help="Keep {%% cache %%} fragments in DIR between runs (needs -e cache)",
+        dest="fragment_cache_dir",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--fragment-cache-size",
+        help="{%% cache %%} fragments kept in memory (default: 1024)",
+        dest="fragment_cache_size",
+        type=int,
+        metavar="N",
+    )
     parser.add_argument(
         "-F",
         "--filter",
@@ -691,6 +4338,52 @@ def run() -> int:
         action="append",
         metavar="key=value",
     )
+    parser.add_argument(
+        "--lazy",
+        help="Bind KEY to records streamed from FILE as they're iterated (e.g. items=big.xml#item)",
+        dest="lazy",
+        action="append",
+        default=[],
+        metavar="KEY=FILE[#SELECTOR]",
+    )
+    parser.add_argument(
+        "--url-cache",
+        help="Keep data fetched from URLs in DIR and only download it again when it changed",
+        dest="url_cache",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--url-timeout",
+        help="Seconds to wait on a URL before giving up (default: 30)",
+        dest="url_timeout",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--compact-data",
+        help="Save memory on large data by sharing repeated keys and strings",
+        dest="compact_data",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--compact-records",
+        help="Also store lists of same-shaped records as rows sharing their keys (implies --compact-data)",
+        dest="compact_records",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dump-data",
+        help="Write the merged data to a snapshot instead of rendering; all arguments are data",
+        dest="dump_data",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--data-snapshot",
+        help="Load data from a snapshot written by --dump-data instead of data files",
+        dest="data_snapshot",
+        metavar="FILE",
+    )
     parser.add_argument(
         "-I",
         "--include",
@@ -700,10 +4393,22 @@ def run() -> int:
         default=[],
         metavar="DIR",
     )
+    parser.add_argument(
+        "--index-templates",
+        help="List each template directory once instead of on every include",
+        dest="index_templates",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--template-index",
+        help="Keep the template index in FILE between runs (implies --index-templates)",
+        dest="template_index_file",
+        metavar="FILE",
+    )
     parser.add_argument(
         "-s",
         "--section",
-        help="Use only this section from the configuration",
+        help="Use only this section from the configuration, a top-level key or a dotted path",
         dest="section",
     )
     parser.add_argument(
@@ -719,6 +4424,177 @@ def run() -> int:
         dest="outfile",
         metavar="FILE",
     )
+    parser.add_argument(
+        "--output-encoding",
+        help="Encoding of the output (default: stdout's, or the locale's for files)",
+        dest="output_encoding",
+        metavar="ENCODING",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        help="Write output in blocks of this size (default: 256K)",
+        dest="buffer_size",
+        type=parse_size,
+        default=WRITE_BUFFER_SIZE,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--each",
+        help="Render once per item of this expression, writing to the -o path template",
+        dest="each",
+        metavar="EXPR",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Render --each outputs in N forked processes sharing the parsed data",
+        dest="jobs",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--shard",
+        help="Only render the outputs of shard I of N (from 1) of an --each run, e.g. 2/4",
+        dest="shard",
+        type=parse_shard,
+        metavar="I/N",
+    )
+    parser.add_argument(
+        "--shard-timings",
+        help="Balance shards by render times recorded with --record-timings (repeatable)",
+        dest="shard_timings",
+        action="append",
+        default=[],
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--record-timings",
+        help="Record the render time of every output into this file",
+        dest="record_timings",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Write outputs into this tar or zip archive, named by their -o path",
+        dest="archive",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--if-changed",
+        help="Atomically replace output files only when their content changed",
+        dest="if_changed",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Build manifest used to skip outputs whose inputs haven't changed",
+        dest="manifest",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Reuse rendered output from this cache for identical renders",
+        dest="cache_dir",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds before a render or fragment cache entry expires (default: 7 days)",
+        dest="cache_ttl",
+        type=float,
+        default=7 * 24 * 60 * 60,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        help="Evict least recently used render or fragment cache entries past this size (default: 512M)",
+        dest="cache_max_size",
+        type=parse_size,
+        default=512 * 1024**2,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--memory-report",
+        help="Print memory allocated by each stage and the peak RSS to stderr",
+        dest="memory_report",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="Abort once the process needs more than this much memory (e.g. 2G)",
+        dest="max_memory",
+        type=parse_size,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--max-output-bytes",
+        help="Abort when any single output grows past this size (e.g. 100M)",
+        dest="max_output_bytes",
+        type=parse_size,
+        metavar="SIZE",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Abort any single render that takes longer than this many seconds",
+        dest="timeout",
+        type=float,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--sandbox",
+        help="Render in jinja2's sandbox, for templates you don't fully trust",
+        dest="sandbox",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-operations",
+        help="Abort any single render doing more calls, lookups and range steps than this (implies --sandbox)",
+        dest="max_operations",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--profile-template",
+        help="Print the template lines, blocks and macros rendering spent the most time in",
+        dest="profile_template",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--filter-stats",
+        help="Print how often each filter was called and the time spent in it",
+        dest="filter_stats",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--memoize-filter",
+        help="Cache results of this pure filter by its arguments (repeatable)",
+        dest="memoize_filters",
+        action="append",
+        default=[],
+        metavar="NAME",
+    )
+    parser.add_argument(
+        "--memoize-size",
+        help="Results kept per memoized filter (default: 1024)",
+        dest="memoize_size",
+        type=int,
+        default=1024,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Write run metrics to FILE, in Prometheus text format if it ends in .prom, else JSON",
+        dest="metrics",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="Also write --metrics every SECONDS while rendering",
+        dest="metrics_interval",
+        type=float,
+        metavar="SECONDS",
+    )
     parser.add_argument(
         "--trim-blocks",
         help="Trim first newline after a block",
@@ -796,7 +4672,36 @@ def run() -> int:
 
     opts.extensions = set(opts.extensions)
 
-    if not opts.stream:
+    if opts.data_snapshot and opts.dump_data:
+        raise InvalidUsage("--data-snapshot and --dump-data can't be combined")
+    if opts.data_snapshot and opts.section:
+        # The snapshot was written after -s was applied
+        raise InvalidUsage("--data-snapshot can't be combined with -s/--section")
+
+    if opts.output_encoding:
+        import codecs
+
+        try:
+            codecs.lookup(opts.output_encoding)
+        except LookupError:
+            raise InvalidUsage(f"unknown encoding: {opts.output_encoding}")
+    if opts.buffer_size < 1:
+        raise InvalidUsage("--buffer-size must be positive")
+    if opts.timeout is not None and opts.timeout <= 0:
+        raise InvalidUsage("--timeout must be positive")
+    if opts.jobs < 1:
+        raise InvalidUsage("--jobs must be positive")
+    if opts.url_timeout <= 0:
+        raise InvalidUsage("--url-timeout must be positive")
+    if opts.metrics_interval is not None:
+        if not opts.metrics:
+            raise InvalidUsage("--metrics-interval requires --metrics")
+        if opts.metrics_interval <= 0:
+            raise InvalidUsage("--metrics-interval must be positive")
+    if opts.fragment_cache_size is not None and opts.fragment_cache_size < 0:
+        raise InvalidUsage("--fragment-cache-size can't be negative")
+
+    if not opts.stream and not opts.dump_data:
         if len(args) == 0:
             parser.print_help()
             return 1
@@ -805,10 +4710,29 @@ def run() -> int:
         if len(args) == 1:
             args.append("")
 
-        if opts.format not in formats and opts.format != "auto":
-            raise InvalidDataFormat(opts.format)
+    # Checked up front for --dump-data too, which loads data without rendering
+    if opts.format not in formats and opts.format != "auto":
+        raise InvalidDataFormat(opts.format)
 
-    return cli(opts, args)
+    metrics = Metrics(opts.metrics, opts.metrics_interval) if opts.metrics else None
+    try:
+        if opts.max_memory is None:
+            return cli(opts, args, metrics)
+
+        limit_memory(opts.max_memory)
+        try:
+            return cli(opts, args, metrics)
+        except MemoryError:
+            pass
+        # Raised outside the except block, so whatever ran out of memory is freed
+        raise MemoryLimitExceeded(f"exceeded --max-memory of {format_size(opts.max_memory)}")
+    except Exception as e:
+        if metrics is not None:
+            metrics.error(e)
+        raise
+    finally:
+        if metrics is not None:
+            metrics.write()
 
 
 # borrowed from https://github.com/python/cpython/blob/3.14/Lib/_colorize.py#L274
@@ -853,10 +4777,27 @@ def can_colorize(*, file: IO[str] | IO[bytes] | None = None) -> bool:
         return hasattr(file, "isatty") and file.isatty()
 
 
-def format_exception_message(exc: Exception) -> str:
+def template_location(exc: BaseException) -> tuple[str | None, int | None]:
+    """
+    The template file and line an error was raised from during a render,
+    from the frames jinja2 puts into its traceback in place of the
+    compiled code, or ``(None, None)``.
+    """
+    filename, lineno = None, None
+    tb = exc.__traceback__
+    while tb is not None:
+        if "__jinja_exception__" in tb.tb_frame.f_globals:
+            filename, lineno = tb.tb_frame.f_code.co_filename, tb.tb_lineno
+        tb = tb.tb_next
+    return filename, lineno
+
+
+def format_exception_message(exc: BaseException) -> str:
     details = str(exc)
     filename = getattr(exc, "filename", None) or getattr(exc, "name", None)
     lineno = getattr(exc, "lineno", None)
+    if filename is None and lineno is None:
+        filename, lineno = template_location(exc)
 
     if filename and lineno is not None:
         return f"{details} ({filename}:{lineno})"
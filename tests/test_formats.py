@@ -79,3 +79,186 @@ def test_hjson_format():
 def test_json5_format():
     parser = _get_parser("json5")
     assert parser("{foo: 'bar',}") == {"foo": "bar"}
+
+
+@pytest.mark.parametrize(
+    ("head", "expected"),
+    [
+        ('{"foo": "bar"}', "json"),
+        ('  \n[{"foo": "bar"}]', "json"),
+        ("<root><foo>bar</foo></root>", "xml"),
+        ("# comment\nFOO=bar\nBAR=baz\n", "env"),
+        ("foo=bar&ham=spam", "querystring"),
+        ('[server]\nhost = "localhost"\n', "toml"),
+        ('title = "hello"\n', "toml"),
+    ],
+)
+def test_sniff_formats(head, expected):
+    if not cli.has_format(expected):
+        raise pytest.skip.Exception(f"{expected} format not available")
+    assert cli.sniff_formats(head)[0] == expected
+
+
+def test_sniff_formats_falls_back_to_yaml_or_json():
+    fallback = "yaml" if cli.has_format("yaml") else "json"
+    assert cli.sniff_formats("foo: bar\n") == [fallback]
+    assert cli.sniff_formats('{"foo": "bar"}')[-1] == fallback
+
+
+def test_parse_data_tries_candidates_in_order():
+    if not cli.has_format("toml"):
+        raise pytest.skip.Exception("toml format not available")
+    assert cli.parse_data("[server]\nhost = localhost\n", ["toml", "ini"]) == {
+        "server": {"host": "localhost"}
+    }
+    with pytest.raises(cli.MalformedJSON):
+        cli.parse_data("{nope", ["json"])
+
+
+INVENTORY_XML = """<?xml version="1.0"?>
+<inventory vendor="acme">
+  <meta><generated>today</generated></meta>
+  <item id="1"><name>bolt</name><tag>a</tag><tag>b</tag></item>
+  <item id="2"><name>nut</name></item>
+  <group><item id="3"><name>washer</name></item></group>
+</inventory>
+"""
+
+
+def test_lazy_xml_defaults_to_root_children(tmp_path):
+    path = tmp_path / "inventory.xml"
+    path.write_text(INVENTORY_XML)
+
+    records = list(cli.LazyXML(str(path)))
+    assert records[0] == {"generated": "today"}
+    assert records[1] == {"@id": "1", "name": "bolt", "tag": ["a", "b"]}
+    assert len(records) == 4
+
+
+def test_lazy_xml_selector(tmp_path):
+    path = tmp_path / "inventory.xml"
+    path.write_text(INVENTORY_XML)
+
+    names = [record["name"] for record in cli.LazyXML(str(path), "item")]
+    assert names == ["bolt", "nut", "washer"]
+    names = [record["name"] for record in cli.LazyXML(str(path), "inventory/item")]
+    assert names == ["bolt", "nut"]
+
+
+def test_lazy_xml_malformed(tmp_path):
+    path = tmp_path / "broken.xml"
+    path.write_text("<inventory><item></inventory>")
+
+    with pytest.raises(cli.MalformedXML):
+        list(cli.LazyXML(str(path), "item"))
+
+
+def test_lazy_json_lines(tmp_path):
+    path = tmp_path / "rows.jsonl"
+    path.write_text('{"id": 1}\n\n{"id": 2}\n')
+
+    assert list(cli.LazyJSONLines(str(path))) == [{"id": 1}, {"id": 2}]
+
+    path.write_text('{"id": 1}\n{"id": \n')
+    with pytest.raises(cli.MalformedJSON, match="rows.jsonl:2"):
+        list(cli.LazyJSONLines(str(path)))
+
+
+def test_lazy_json(tmp_path):
+    pytest.importorskip("ijson")
+    path = tmp_path / "data.json"
+    path.write_text('{"meta": {}, "rows": [{"id": 1, "score": 0.5}, {"id": 2, "score": 1.5}]}')
+
+    assert list(cli.LazyJSON(str(path), "rows.item")) == [
+        {"id": 1, "score": 0.5},
+        {"id": 2, "score": 1.5},
+    ]
+
+
+def test_csv_format():
+    parser = _get_parser("csv")
+    data = parser("name,port,ratio,enabled,zip,note\nweb,80,0.5,true,01234,\n")
+    assert data == {
+        "rows": [
+            {"name": "web", "port": 80, "ratio": 0.5, "enabled": True, "zip": "01234", "note": ""}
+        ]
+    }
+
+
+def test_tsv_format():
+    parser = _get_parser("tsv")
+    assert parser("name\tport\nweb\t80\n") == {"rows": [{"name": "web", "port": 80}]}
+
+
+def test_csv_format_empty():
+    parser = _get_parser("csv")
+    assert parser("name,port\n") == {"rows": []}
+
+
+def test_lazy_csv(tmp_path):
+    path = tmp_path / "rows.tsv"
+    path.write_text("name\tport\nweb\t80\ndb\t5432\n")
+
+    assert list(cli.LazyCSV(str(path))) == [
+        {"name": "web", "port": 80},
+        {"name": "db", "port": 5432},
+    ]
+
+
+def test_lazy_parquet(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "rows.parquet"
+    pq.write_table(pa.table({"name": ["web", "db"], "port": [80, 5432]}), str(path))
+
+    assert list(cli.LazyArrow(str(path))) == [
+        {"name": "web", "port": 80},
+        {"name": "db", "port": 5432},
+    ]
+    assert list(cli.LazyArrow(str(path), "port")) == [{"port": 80}, {"port": 5432}]
+
+
+def test_lazy_arrow_ipc(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    feather = pytest.importorskip("pyarrow.feather")
+    path = tmp_path / "rows.arrow"
+    feather.write_feather(pa.table({"name": ["web"], "port": [80]}), str(path))
+
+    assert list(cli.LazyArrow(str(path), "name")) == [{"name": "web"}]
+
+
+def test_msgpack_format():
+    parser = _get_parser("msgpack")
+    msgpack = pytest.importorskip("msgpack")
+    assert parser(msgpack.packb({"foo": "bar", 1: [1, 2]})) == {"foo": "bar", 1: [1, 2]}
+    with pytest.raises(cli.MalformedMsgPack):
+        cli.parse_data(b"\xc1", ["msgpack"])
+
+
+def test_cbor_format():
+    parser = _get_parser("cbor")
+    cbor2 = pytest.importorskip("cbor2")
+    assert parser(cbor2.dumps({"foo": "bar"})) == {"foo": "bar"}
+    # An array of two items, cut off after the first
+    with pytest.raises(cli.MalformedCBOR):
+        cli.parse_data(b"\x82\x01", ["cbor"])
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bz2", "lzma"])
+def test_sniff_compression(compression):
+    import importlib
+
+    module = importlib.import_module(compression)
+    expected = {"gzip": "gzip", "bz2": "bz2", "lzma": "xz"}[compression]
+    assert cli.sniff_compression(module.compress(b'{"foo": "bar"}')) == expected
+
+
+def test_sniff_compression_plain_text():
+    assert cli.sniff_compression(b"BZh=1\nFOO=bar\n") is None
+    assert cli.sniff_compression(b'{"foo": "bar"}') is None
+
+
+def test_data_extension():
+    assert cli.data_extension("inventory.json.gz") == "json"
+    assert cli.data_extension("inventory.yaml.ZST") == "yaml"
+    assert cli.data_extension("inventory.json") == "json"
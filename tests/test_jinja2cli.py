@@ -1,5 +1,7 @@
+import json
 import os
 import sys
+from typing import Any, Callable
 
 import pytest
 
@@ -41,9 +43,7 @@ def test_main_prints_template_syntax_error_location(tmp_path, monkeypatch, capsy
         cli.main()
 
     assert exc_info.value.code == 1
-    assert capsys.readouterr().err == (
-        f"TemplateSyntaxError: unexpected '}}' ({template}:1)\n"
-    )
+    assert capsys.readouterr().err == (f"TemplateSyntaxError: unexpected '}}' ({template}:1)\n")
 
 
 class TestDiscoverFilters:
@@ -259,3 +259,1582 @@ class TestParseKvString:
         """Test adding to existing nested path"""
         result = cli.parse_kv_string(["foo.bar=1", "foo.baz=2"])
         assert result == {"foo": {"bar": "1", "baz": "2"}}
+
+
+def _run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["jinja2", *map(str, args)])
+    with pytest.raises(SystemExit) as exc_info:
+        cli.main()
+    return exc_info.value.code
+
+
+@pytest.fixture(autouse=True)
+def no_color(monkeypatch):
+    """Uncoloured error messages, so they can be compared as text"""
+    monkeypatch.setattr(cli, "can_colorize", lambda file: False)
+
+
+@pytest.fixture
+def render_setup(tmp_path):
+    """Write a template.j2 and a data.json into tmp_path and return their paths"""
+
+    def setup(source, data="{}"):
+        template = tmp_path / "template.j2"
+        template.write_text(source, encoding="utf8")
+        data_file = tmp_path / "data.json"
+        data_file.write_text(data if isinstance(data, str) else json.dumps(data))
+        return template, data_file
+
+    return setup
+
+
+class TestFanOut:
+    """Test rendering one output file per data record with --each"""
+
+    def test_renders_one_file_per_item(self, tmp_path, monkeypatch):
+        template = tmp_path / "service.conf.j2"
+        template.write_text("{{ name }}:{{ port }} env={{ env }}\n")
+        data = tmp_path / "data.json"
+        data.write_text(
+            '{"env": "prod", "services": [{"name": "web", "port": 80}, {"name": "db", "port": 5432}]}'
+        )
+
+        out = tmp_path / "out" / "{{ name }}.conf"
+        assert _run_main(monkeypatch, template, data, "--each", "services", "-o", out) == 0
+
+        assert (tmp_path / "out" / "web.conf").read_text() == "web:80 env=prod\n"
+        assert (tmp_path / "out" / "db.conf").read_text() == "db:5432 env=prod\n"
+
+    def test_item_is_available_for_scalars(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", '{"names": ["a", "b"]}')
+
+        out = tmp_path / "{{ item }}.txt"
+        assert _run_main(monkeypatch, template, data, "--each", "names", "-o", out) == 0
+
+        assert (tmp_path / "a.txt").read_text() == "a"
+        assert (tmp_path / "b.txt").read_text() == "b"
+
+    def test_requires_outfile(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item }}", '{"names": ["a"]}')
+
+        assert _run_main(monkeypatch, template, data, "--each", "names") == 1
+        assert "InvalidUsage: --each requires -o/--outfile" in capsys.readouterr().err
+
+    def test_duplicate_output_path(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item }}", '{"names": ["a", "a"]}')
+
+        out = tmp_path / "{{ item }}.txt"
+        assert _run_main(monkeypatch, template, data, "--each", "names", "-o", out) == 1
+        assert "duplicate output path" in capsys.readouterr().err
+
+
+class TestIfChanged:
+    """Test skipping unchanged outputs with --if-changed"""
+
+    def test_paths_arent_autoescaped(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", '{"names": ["a&b"]}')
+        out = tmp_path / "{{ item }}.txt"
+
+        assert (
+            _run_main(monkeypatch, template, data, "--each", "names", "-o", out, "--autoescape")
+            == 0
+        )
+        assert (tmp_path / "a&b.txt").read_text() == "a&amp;b"
+
+    def test_unchanged_output_is_not_rewritten(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name }}", '{"name": "matt"}')
+        out = tmp_path / "out.txt"
+        out.write_text("matt")
+        os.utime(out, (1_000_000, 1_000_000))
+
+        assert _run_main(monkeypatch, template, data, "-o", out, "--if-changed") == 0
+
+        assert out.read_text() == "matt"
+        assert out.stat().st_mtime == 1_000_000
+        assert capsys.readouterr().err == "0 changed, 1 unchanged\n"
+        assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".")] == []
+
+    def test_changed_output_is_replaced(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name }}", '{"name": "matt"}')
+        out = tmp_path / "out.txt"
+        out.write_text("old")
+        out.chmod(0o640)
+
+        assert _run_main(monkeypatch, template, data, "-o", out, "--if-changed") == 0
+
+        assert out.read_text() == "matt"
+        assert out.stat().st_mode & 0o777 == 0o640
+        assert capsys.readouterr().err == "1 changed, 0 unchanged\n"
+
+    def test_counts_fan_out_outputs(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item }}", '{"names": ["a", "b", "c"]}')
+        (tmp_path / "a.txt").write_text("a")
+
+        out = tmp_path / "{{ item }}.txt"
+        args = [template, data, "--each", "names", "-o", out, "--if-changed"]
+        assert _run_main(monkeypatch, *args) == 0
+
+        assert capsys.readouterr().err == "2 changed, 1 unchanged\n"
+        assert (tmp_path / "c.txt").read_text() == "c"
+
+
+class TestManifest:
+    """Test incremental builds with --manifest"""
+
+    def _setup(self, render_setup):
+        template, data = render_setup(
+            '{% include "greeting.j2" %} {{ name }}', '{"name": "matt", "names": ["a", "b"]}'
+        )
+        (template.parent / "partials").mkdir()
+        (template.parent / "partials" / "greeting.j2").write_text("Hello")
+        return template, data
+
+    def test_skips_up_to_date_output(self, tmp_path, render_setup, monkeypatch):
+        template, data = self._setup(render_setup)
+        out = tmp_path / "out.txt"
+        manifest = tmp_path / "manifest.json"
+        args = [template, data, "-I", tmp_path / "partials", "-o", out, "--manifest", manifest]
+
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.read_text() == "Hello matt"
+        os.utime(out, ns=(1_000_000_000, 1_000_000_000))
+        recorded = json.loads(manifest.read_text())
+        assert str(tmp_path / "partials" / "greeting.j2") in recorded["inputs"]
+
+        # The output was touched, so it is no longer considered up to date
+        assert _run_main(monkeypatch, *args) == 0
+        mtime = out.stat().st_mtime_ns
+        assert mtime != 1_000_000_000
+
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.stat().st_mtime_ns == mtime
+
+    def test_rebuilds_when_included_template_changes(self, tmp_path, render_setup, monkeypatch):
+        template, data = self._setup(render_setup)
+        out = tmp_path / "out.txt"
+        manifest = tmp_path / "manifest.json"
+        args = [template, data, "-I", tmp_path / "partials", "-o", out, "--manifest", manifest]
+
+        assert _run_main(monkeypatch, *args) == 0
+        (tmp_path / "partials" / "greeting.j2").write_text("Hi there")
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.read_text() == "Hi there matt"
+
+    def test_rebuilds_when_options_change(self, tmp_path, render_setup, monkeypatch):
+        template, data = self._setup(render_setup)
+        out = tmp_path / "out.txt"
+        manifest = tmp_path / "manifest.json"
+        args = [template, data, "-I", tmp_path / "partials", "-o", out, "--manifest", manifest]
+
+        assert _run_main(monkeypatch, *args) == 0
+        assert _run_main(monkeypatch, *args, "-D", "name=bob") == 0
+        assert out.read_text() == "Hello bob"
+
+    def test_fan_out_only_renders_missing_outputs(self, tmp_path, render_setup, monkeypatch):
+        template, data = self._setup(render_setup)
+        manifest = tmp_path / "manifest.json"
+        out = tmp_path / "out" / "{{ item }}.txt"
+        args = [template, data, "-I", tmp_path / "partials", "--each", "names", "-o", out]
+        args += ["--manifest", manifest]
+
+        assert _run_main(monkeypatch, *args) == 0
+        a_mtime = (tmp_path / "out" / "a.txt").stat().st_mtime_ns
+        (tmp_path / "out" / "b.txt").unlink()
+
+        assert _run_main(monkeypatch, *args) == 0
+        assert (tmp_path / "out" / "b.txt").read_text() == "Hello matt"
+        assert (tmp_path / "out" / "a.txt").stat().st_mtime_ns == a_mtime
+
+    def test_rebuilds_when_stdin_template_changes(self, tmp_path, monkeypatch):
+        import io
+
+        data = tmp_path / "data.json"
+        data.write_text('{"a": 1}')
+        out = tmp_path / "out.txt"
+        args = ["-S", data, "-o", out, "--manifest", tmp_path / "manifest.json"]
+
+        for source in ("v1 {{ a }}", "v2 {{ a }}"):
+            monkeypatch.setattr(sys, "stdin", io.StringIO(source))
+            assert _run_main(monkeypatch, *args) == 0
+            assert out.read_text() == source.replace("{{ a }}", "1")
+
+        monkeypatch.setattr(sys, "stdin", io.StringIO("v2 {{ a }}"))
+        mtime = out.stat().st_mtime_ns
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.stat().st_mtime_ns == mtime
+
+
+class TestRenderCache:
+    """Test reusing rendered output with --cache-dir"""
+
+    class _Unrenderable:
+        def render(self, context):
+            raise AssertionError("should have been served from the cache")
+
+    def _setup(self, render_setup):
+        template, data = render_setup(
+            '{% include "partial.j2" %} {{ name }}', '{"name": "matt", "names": ["a", "b"]}'
+        )
+        (template.parent / "partial.j2").write_text("Hello")
+        return template, data
+
+    def test_identical_render_is_served_from_cache(
+        self, tmp_path, render_setup, monkeypatch, capsys
+    ):
+        template, data = self._setup(render_setup)
+        cache_dir = tmp_path / "cache"
+
+        assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        assert capsys.readouterr().out == "Hello matt"
+
+        load_template = cli.load_template
+        monkeypatch.setattr(
+            cli, "load_template", lambda *args: load_template(*args) and self._Unrenderable()
+        )
+        assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        assert capsys.readouterr().out == "Hello matt"
+
+    def test_changed_data_or_template_misses(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = self._setup(render_setup)
+        cache_dir = tmp_path / "cache"
+
+        assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        data.write_text('{"name": "bob"}')
+        assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        (tmp_path / "partial.j2").write_text("Bye")
+        assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        assert capsys.readouterr().out == "Hello mattHello bobBye bob"
+
+    def test_environ_reads_are_checked(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ environ('FOO') }}")
+        cache_dir = tmp_path / "cache"
+
+        for value in ("1", "2", "2"):
+            monkeypatch.setenv("FOO", value)
+            assert _run_main(monkeypatch, template, data, "--cache-dir", cache_dir) == 0
+        assert capsys.readouterr().out == "122"
+
+    def test_missing_template(self, tmp_path, monkeypatch, capsys):
+        data = tmp_path / "data.json"
+        data.write_text("{}")
+
+        args = [tmp_path / "missing.j2", data, "--cache-dir", tmp_path / "cache"]
+        assert _run_main(monkeypatch, *args) == 1
+        assert capsys.readouterr().err.startswith("TemplateNotFound: ")
+
+    def test_evict_tolerates_concurrent_removal(self, tmp_path, monkeypatch):
+        cache = cli.RenderCache(str(tmp_path), ttl=3600, max_size=0)
+        cache.put("a" * 64, "x", ())
+        unlink = os.unlink
+
+        def racing_unlink(path):
+            # Another run evicting the same entry first
+            unlink(path)
+            unlink(path)
+
+        monkeypatch.setattr(os, "unlink", racing_unlink)
+        cache.evict()
+        assert not any(p.is_file() for p in tmp_path.rglob("*"))
+
+    def test_fan_out_items_are_cached_separately(self, tmp_path, render_setup, monkeypatch):
+        template, data = self._setup(render_setup)
+        cache_dir = tmp_path / "cache"
+        args = [template, data, "--each", "names", "-o", tmp_path / "{{ item }}.txt"]
+
+        assert _run_main(monkeypatch, *args, "-D", "name=x", "--cache-dir", cache_dir) == 0
+        (tmp_path / "a.txt").unlink()
+        (tmp_path / "b.txt").unlink()
+        assert _run_main(monkeypatch, *args, "-D", "name=x", "--cache-dir", cache_dir) == 0
+        assert (tmp_path / "a.txt").read_text() == "Hello x"
+        assert (tmp_path / "b.txt").read_text() == "Hello x"
+
+    def test_evicts_least_recently_used_past_max_size(self, tmp_path):
+        cache = cli.RenderCache(str(tmp_path), ttl=60, max_size=0)
+        cache.put("a" * 64, "x" * 10, [])
+        entry = tmp_path / "aa" / ("a" * 64)
+        os.utime(entry, (entry.stat().st_mtime - 10,) * 2)
+        cache.max_size = entry.stat().st_size + 16
+        cache.put("b" * 64, "y" * 10, [])
+        cache.evict()
+
+        assert cache.get("a" * 64) is None
+        assert cache.get("b" * 64) == ("y" * 10, [])
+
+    def test_expired_entries_are_misses(self, tmp_path):
+        cache = cli.RenderCache(str(tmp_path), ttl=-1, max_size=1024)
+        cache.put("a" * 64, "x", [])
+        assert cache.get("a" * 64) is None
+        assert cache.misses == 1
+
+
+class TestStdinSniffing:
+    """Test guessing the format of data read from stdin"""
+
+    def _stdin(self, monkeypatch, content):
+        import io
+
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(content), encoding="utf8"))
+
+    def test_env_from_stdin(self, tmp_path, monkeypatch, capsys):
+        template = tmp_path / "template.j2"
+        template.write_text("{{ FOO }} {{ BAR }}")
+        self._stdin(monkeypatch, b"FOO=bar\nBAR=baz\n")
+
+        assert _run_main(monkeypatch, template, "-") == 0
+        assert capsys.readouterr().out == "bar baz"
+
+    def test_json_from_stdin(self, tmp_path, monkeypatch, capsys):
+        template = tmp_path / "template.j2"
+        template.write_text("{{ title }}")
+        self._stdin(monkeypatch, '{"title": "naïve"}'.encode())
+
+        assert _run_main(monkeypatch, template) == 0
+        assert capsys.readouterr().out == "naïve"
+
+
+class TestLazy:
+    """Test binding lazily streamed records with --lazy"""
+
+    def test_iterate_xml_records_in_template(self, tmp_path, render_setup, monkeypatch, capsys):
+        (tmp_path / "inventory.xml").write_text(
+            '<inventory><item id="1">bolt</item><item id="2">nut</item></inventory>'
+        )
+        template, data = render_setup(
+            "{% for item in items %}{{ item['@id'] }}={{ item['#text'] }};{% endfor %}"
+        )
+
+        lazy = f"items={tmp_path / 'inventory.xml'}#item"
+        assert _run_main(monkeypatch, template, data, "--lazy", lazy) == 0
+        assert capsys.readouterr().out == "1=bolt;2=nut;"
+
+    def test_data_digest_uses_cache_token(self, tmp_path):
+        path = tmp_path / "rows.jsonl"
+        path.write_text('{"a": 1}\n')
+        source = cli.LazyJSONLines(str(path))
+        before = cli.data_digest({"rows": source})
+        path.write_text('{"a": 1}\n{"a": 2}\n')
+        assert cli.data_digest({"rows": source}) != before
+
+        # repr doesn't touch the file
+        path.unlink()
+        assert repr(source) == f"<LazyJSONLines {str(path)!r}>"
+
+    def test_render_per_xml_record(self, tmp_path, render_setup, monkeypatch):
+        (tmp_path / "inventory.xml").write_text(
+            "<inventory><item><name>bolt</name></item><item><name>nut</name></item></inventory>"
+        )
+        template, data = render_setup("{{ name }}")
+
+        lazy = f"items={tmp_path / 'inventory.xml'}"
+        out = tmp_path / "out" / "{{ name }}.txt"
+        assert (
+            _run_main(monkeypatch, template, data, "--lazy", lazy, "--each", "items", "-o", out)
+            == 0
+        )
+        assert (tmp_path / "out" / "bolt.txt").read_text() == "bolt"
+        assert (tmp_path / "out" / "nut.txt").read_text() == "nut"
+
+    def test_unsupported_extension(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("")
+
+        assert _run_main(monkeypatch, template, data, "--lazy", f"items={data}.nope") == 1
+        assert "nope: can't be loaded lazily" in capsys.readouterr().err
+
+    def test_stream_json_lines_to_file(self, tmp_path, render_setup, monkeypatch):
+        (tmp_path / "rows.ndjson").write_text("".join(f'{{"n": {i}}}\n' for i in range(1000)))
+        template, data = render_setup("{% for row in rows %}{{ row.n }}\n{% endfor %}")
+        out = tmp_path / "out.txt"
+
+        lazy = f"rows={tmp_path / 'rows.ndjson'}"
+        assert _run_main(monkeypatch, template, data, "--lazy", lazy, "-o", out) == 0
+        assert out.read_text() == "".join(f"{i}\n" for i in range(1000))
+
+    def test_failed_streaming_render_keeps_output(self, tmp_path, render_setup, monkeypatch):
+        (tmp_path / "rows.jsonl").write_text('{"n": 1}\n{"n": \n')
+        template, data = render_setup("{% for row in rows %}{{ row.n }}{% endfor %}")
+        out = tmp_path / "out.txt"
+        out.write_text("original content")
+
+        lazy = f"rows={tmp_path / 'rows.jsonl'}"
+        assert _run_main(monkeypatch, template, data, "--lazy", lazy, "-o", out) == 1
+        assert out.read_text() == "original content"
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            "data.json",
+            "out.txt",
+            "rows.jsonl",
+            "template.j2",
+        ]
+
+    def test_csv_rows_by_extension(self, tmp_path, monkeypatch, capsys):
+        template = tmp_path / "template.j2"
+        template.write_text("{% for row in rows %}{{ row.name }}:{{ row.port + 1 }};{% endfor %}")
+        data = tmp_path / "data.csv"
+        data.write_text("name,port\nweb,80\ndb,5432\n")
+
+        assert _run_main(monkeypatch, template, data) == 0
+        assert capsys.readouterr().out == "web:81;db:5433;"
+
+        empty = tmp_path / "empty.json"
+        empty.write_text("{}")
+        assert _run_main(monkeypatch, template, empty, "--lazy", f"rows={data}") == 0
+        assert capsys.readouterr().out == "web:81;db:5433;"
+
+
+class TestBinaryFormats:
+    """Test reading binary data formats from files and stdin"""
+
+    def test_msgpack_file_by_extension(self, tmp_path, monkeypatch, capsys):
+        msgpack = pytest.importorskip("msgpack")
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        data = tmp_path / "data.msgpack"
+        data.write_bytes(msgpack.packb({"name": "zoë"}))
+
+        assert _run_main(monkeypatch, template, data) == 0
+        assert capsys.readouterr().out == "zoë"
+
+    def test_malformed_msgpack(self, tmp_path, monkeypatch, capsys):
+        pytest.importorskip("msgpack")
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        data = tmp_path / "data.msgpack"
+        data.write_bytes(b"\xc1")
+
+        assert _run_main(monkeypatch, template, data) == 1
+        assert capsys.readouterr().err.startswith("MalformedMsgPack: ")
+
+    def test_self_described_cbor_from_stdin(self, tmp_path, monkeypatch, capsys):
+        import io
+
+        cbor2 = pytest.importorskip("cbor2")
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        content = cbor2.dumps(cbor2.CBORTag(55799, {"name": "matt"}))
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(content)))
+
+        assert _run_main(monkeypatch, template, "-") == 0
+        assert capsys.readouterr().out == "matt"
+
+
+class TestDataSnapshot:
+    """Test --dump-data and --data-snapshot"""
+
+    def _setup(self, tmp_path):
+        template = tmp_path / "template.j2"
+        template.write_text("{{ server.host }}:{{ server.port }} {{ extra }}")
+        base = tmp_path / "base.json"
+        base.write_text('{"prod": {"server": {"host": "localhost", "port": 80}}}')
+        override = tmp_path / "override.yaml"
+        override.write_text("prod:\n  server:\n    port: 8080\n")
+        return template, base, override
+
+    def test_round_trip(self, tmp_path, monkeypatch, capsys):
+        template, base, override = self._setup(tmp_path)
+        snapshot = tmp_path / "data.snapshot"
+
+        args = ["--dump-data", snapshot, base, override, "-s", "prod", "-D", "extra=x"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().out == ""
+
+        assert _run_main(monkeypatch, template, "--data-snapshot", snapshot) == 0
+        assert capsys.readouterr().out == "localhost:8080 x"
+
+        args = [template, "--data-snapshot", snapshot, "-D", "extra=y"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().out == "localhost:8080 y"
+
+    def test_stale_snapshot(self, tmp_path, monkeypatch, capsys):
+        template, base, override = self._setup(tmp_path)
+        snapshot = tmp_path / "data.snapshot"
+
+        assert _run_main(monkeypatch, "--dump-data", snapshot, base, override) == 0
+        override.write_text("prod:\n  server:\n    port: 9090\n")
+
+        assert _run_main(monkeypatch, template, "--data-snapshot", snapshot) == 1
+        err = capsys.readouterr().err
+        assert err.startswith("StaleDataSnapshot: ")
+        assert "override.yaml changed" in err
+
+    def test_dump_data_unknown_format(self, tmp_path, monkeypatch, capsys):
+        _, base, _ = self._setup(tmp_path)
+        snapshot = tmp_path / "data.snapshot"
+
+        assert _run_main(monkeypatch, "--dump-data", snapshot, base, "-f", "nope") == 1
+        assert capsys.readouterr().err == "InvalidDataFormat: nope\n"
+        assert not snapshot.exists()
+
+    def test_snapshot_with_data_files(self, tmp_path, monkeypatch, capsys):
+        template, base, _ = self._setup(tmp_path)
+
+        assert _run_main(monkeypatch, template, base, "--data-snapshot", base) == 1
+        assert "can't be combined with data files" in capsys.readouterr().err
+
+    def test_snapshot_with_section(self, tmp_path, monkeypatch, capsys):
+        template, base, _ = self._setup(tmp_path)
+
+        assert _run_main(monkeypatch, template, "--data-snapshot", base, "-s", "prod") == 1
+        assert "can't be combined with -s/--section" in capsys.readouterr().err
+
+    def test_not_a_snapshot(self, tmp_path, monkeypatch, capsys):
+        template, base, _ = self._setup(tmp_path)
+
+        assert _run_main(monkeypatch, template, "--data-snapshot", base) == 1
+        assert "not a data snapshot" in capsys.readouterr().err
+
+
+class TestCompressedOutput:
+    """Test compressing outputs and writing them into archives"""
+
+    data = '{"services": [{"name": "web"}, {"name": "db"}]}'
+
+    def test_compress_by_extension(self, tmp_path, render_setup, monkeypatch):
+        import gzip
+        import lzma
+
+        template, data = render_setup("{{ name }}\n", self.data)
+        out = tmp_path / "out.txt.gz"
+        assert _run_main(monkeypatch, template, data, "-D", "name=x", "-o", out) == 0
+        assert gzip.decompress(out.read_bytes()) == b"x\n"
+
+        out = tmp_path / "out" / "{{ name }}.conf.xz"
+        assert _run_main(monkeypatch, template, data, "--each", "services", "-o", out) == 0
+        assert lzma.decompress((tmp_path / "out" / "web.conf.xz").read_bytes()) == b"web\n"
+
+    def test_compressed_output_if_changed(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name }}\n", self.data)
+        out = tmp_path / "out.txt.gz"
+        args = [template, data, "-D", "name=x", "-o", out, "--if-changed"]
+
+        assert _run_main(monkeypatch, *args) == 0
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().err == "1 changed, 0 unchanged\n0 changed, 1 unchanged\n"
+
+    def test_zip_archive(self, tmp_path, render_setup, monkeypatch):
+        import zipfile
+
+        template, data = render_setup("{{ name }}\n", self.data)
+        archive = tmp_path / "configs.zip"
+        args = [template, data, "--each", "services", "-o", "conf/{{ name }}.conf"]
+        assert _run_main(monkeypatch, *args, "--archive", archive) == 0
+
+        with zipfile.ZipFile(archive) as zf:
+            assert zf.namelist() == ["conf/web.conf", "conf/db.conf"]
+            assert zf.read("conf/db.conf") == b"db\n"
+        assert not (tmp_path / "conf").exists()
+
+    def test_tar_archive(self, tmp_path, render_setup, monkeypatch):
+        import tarfile
+
+        template, data = render_setup("{{ name }}\n", self.data)
+        archive = tmp_path / "configs.tar.gz"
+        args = [template, data, "--each", "services", "-o", "{{ name }}.conf"]
+        assert _run_main(monkeypatch, *args, "--archive", archive) == 0
+
+        with tarfile.open(archive) as tf:
+            assert tf.getnames() == ["web.conf", "db.conf"]
+            member = tf.extractfile("web.conf")
+            assert member is not None
+            assert member.read() == b"web\n"
+
+    @pytest.mark.parametrize("name", ["configs.zip", "configs.tar.gz"])
+    def test_archive_if_changed(self, tmp_path, render_setup, monkeypatch, capsys, name):
+        import time
+
+        monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+        template, data = render_setup("{{ name }}\n", self.data)
+        archive = tmp_path / name
+        args = [template, data, "--each", "services", "-o", "{{ name }}.conf", "--if-changed"]
+
+        assert _run_main(monkeypatch, *args, "--archive", archive) == 0
+        first = archive.read_bytes()
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 3600)
+        assert _run_main(monkeypatch, *args, "--archive", archive) == 0
+        assert archive.read_bytes() == first
+        assert capsys.readouterr().err == "2 changed, 0 unchanged\n0 changed, 2 unchanged\n"
+
+    def test_failed_render_leaves_no_archive(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ name }}\n", self.data)
+        template.write_text("{{ name.missing.attr }}")
+        archive = tmp_path / "configs.zip"
+        args = [template, data, "--each", "services", "-o", "{{ name }}.conf"]
+
+        assert _run_main(monkeypatch, *args, "--archive", archive, "--strict") == 1
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["data.json", "template.j2"]
+
+
+class TestCompressedInput:
+    """Test reading compressed data files and stdin"""
+
+    def test_double_extension(self, tmp_path, monkeypatch, capsys):
+        import gzip
+
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        data = tmp_path / "data.json.gz"
+        data.write_bytes(gzip.compress(b'{"name": "matt"}'))
+
+        assert _run_main(monkeypatch, template, data) == 0
+        assert capsys.readouterr().out == "matt"
+
+    def test_compressed_without_compression_extension(self, tmp_path, monkeypatch, capsys):
+        import lzma
+
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        data = tmp_path / "data.yaml"
+        data.write_bytes(lzma.compress(b"name: matt\n"))
+
+        assert _run_main(monkeypatch, template, data) == 0
+        assert capsys.readouterr().out == "matt"
+
+    def test_zstd(self, tmp_path, monkeypatch, capsys):
+        zstandard = pytest.importorskip("zstandard")
+        template = tmp_path / "template.j2"
+        template.write_text("{{ name }}")
+        data = tmp_path / "data.json.zst"
+        data.write_bytes(zstandard.ZstdCompressor().compress(b'{"name": "matt"}'))
+
+        assert _run_main(monkeypatch, template, data) == 0
+        assert capsys.readouterr().out == "matt"
+
+    def test_compressed_stdin(self, tmp_path, monkeypatch, capsys):
+        import bz2
+        import io
+
+        template = tmp_path / "template.j2"
+        template.write_text("{{ FOO }}")
+        content = bz2.compress(b"FOO=bar\n" * 100_000)
+        monkeypatch.setattr(sys, "stdin", io.TextIOWrapper(io.BytesIO(content)))
+
+        assert _run_main(monkeypatch, template, "-") == 0
+        assert capsys.readouterr().out == "bar"
+
+    def test_compressed_lazy_source(self, tmp_path, render_setup, monkeypatch, capsys):
+        import gzip
+
+        template, data = render_setup("{% for row in rows %}{{ row.n }}{% endfor %}")
+        rows = tmp_path / "rows.jsonl.gz"
+        rows.write_bytes(gzip.compress(b'{"n": 1}\n{"n": 2}\n'))
+
+        assert _run_main(monkeypatch, template, data, "--lazy", f"rows={rows}") == 0
+        assert capsys.readouterr().out == "12"
+
+
+class TestOutputEncoding:
+    """Test output encoding and block-buffered writes"""
+
+    def test_file_encoding(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ name }}\n")
+        out = tmp_path / "out.txt"
+
+        args = [template, data, "-D", "name=café", "-o", out, "--output-encoding", "latin-1"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.read_bytes() == "café\n".encode("latin-1")
+
+    def test_stdout_encoding(self, render_setup, monkeypatch, capsysbinary):
+        template, data = render_setup("{{ name }}")
+
+        args = [template, data, "-D", "name=café", "--output-encoding", "utf-16"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsysbinary.readouterr().out == "café".encode("utf-16")
+
+    def test_unknown_encoding(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("x")
+
+        assert _run_main(monkeypatch, template, data, "--output-encoding", "nope") == 1
+        assert "unknown encoding: nope" in capsys.readouterr().err
+
+    def test_iter_encoded_blocks(self):
+        blocks = list(cli.iter_encoded(["ab"] * 10, "utf8", block_size=5))
+        assert blocks == [b"ababab"] * 3 + [b"ab"]
+
+    def test_streamed_output_small_buffer(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{% for row in rows %}{{ row.n }}\n{% endfor %}")
+        rows = tmp_path / "rows.jsonl"
+        rows.write_text("".join(f'{{"n": {n}}}\n' for n in range(1000)))
+        out = tmp_path / "out.txt"
+
+        args = [template, data, "--lazy", f"rows={rows}", "-o", out, "--buffer-size", "64"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.read_text() == "".join(f"{n}\n" for n in range(1000))
+
+    @pytest.mark.parametrize("encoding", ["utf8", "latin-1"])
+    def test_cache_hit(self, tmp_path, render_setup, monkeypatch, encoding):
+        template, data = render_setup("{{ name }}\n")
+        out = tmp_path / "out.txt"
+        args = [template, data, "-D", "name=café", "-o", out, "--cache-dir", tmp_path / "cache"]
+
+        assert _run_main(monkeypatch, *args) == 0
+        out.unlink()
+        assert _run_main(monkeypatch, *args, "--output-encoding", encoding) == 0
+        assert out.read_bytes() == "café\n".encode(encoding)
+
+    @pytest.mark.parametrize("cached", [False, True])
+    def test_newlines_translated(self, tmp_path, render_setup, monkeypatch, cached):
+        template, data = render_setup("a\nb\n")
+        out = tmp_path / "out.txt"
+        args = [template, data, "-o", out, "--cache-dir", tmp_path / "cache"]
+        if cached:
+            assert _run_main(monkeypatch, *args) == 0
+
+        monkeypatch.setattr(os, "linesep", "\r\n")
+        assert _run_main(monkeypatch, *args) == 0
+        assert out.read_bytes() == b"a\r\nb\r\n"
+
+    def test_copy_stream(self, tmp_path):
+        source = tmp_path / "source"
+        source.write_bytes(b"header\n" + b"x" * 100_000)
+        target = tmp_path / "target"
+
+        with open(source, "rb") as src, open(target, "wb") as out:
+            src.readline()
+            out.write(b"<")
+            cli.copy_stream(src, out, block_size=1024)
+        assert target.read_bytes() == b"<" + b"x" * 100_000
+
+
+class TestResourceLimits:
+    """Test memory accounting and output size limits"""
+
+    data = '{"name": "matt"}'
+
+    def test_memory_report(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name }}", self.data)
+
+        assert _run_main(monkeypatch, template, data, "--memory-report") == 0
+        captured = capsys.readouterr()
+        assert captured.out == "matt"
+        stages = [line.split()[0] for line in captured.err.splitlines()]
+        assert stages[:5] == ["stage", "parse", "merge", "render", "write"]
+        assert "peak RSS:" in captured.err
+
+    def test_max_output_bytes(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name * 100 }}", self.data)
+        out = tmp_path / "out.txt"
+
+        assert _run_main(monkeypatch, template, data, "-o", out, "--max-output-bytes", "1K") == 0
+        assert _run_main(monkeypatch, template, data, "-o", out, "--max-output-bytes", "100") == 1
+        assert "output exceeds --max-output-bytes of 100" in capsys.readouterr().err
+        assert out.read_text() == "matt" * 100
+
+    def test_max_output_bytes_streamed(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{% for row in rows %}{{ row.n }}\n{% endfor %}", self.data)
+        rows = tmp_path / "rows.jsonl"
+        rows.write_text('{"n": 1}\n' * 10_000)
+        out = tmp_path / "out.txt"
+
+        args = [template, data, "--lazy", f"rows={rows}", "-o", out, "--buffer-size", "1K"]
+        assert _run_main(monkeypatch, *args, "--max-output-bytes", "4K") == 1
+        assert "OutputTooLarge" in capsys.readouterr().err
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            "data.json",
+            "rows.jsonl",
+            "template.j2",
+        ]
+
+    @pytest.mark.parametrize("cached", [False, True])
+    def test_max_output_bytes_stops_render(
+        self, tmp_path, render_setup, monkeypatch, capsys, cached
+    ):
+        calls = []
+        make_environment = cli.make_environment
+
+        def counting_environment(*args, **kwargs):
+            env = make_environment(*args, **kwargs)
+            env.globals["tick"] = calls.append  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
+            return env
+
+        monkeypatch.setattr(cli, "make_environment", counting_environment)
+        template, data = render_setup(
+            '{% for i in range(10000) %}{{ tick(i) or "0123456789" }}{% endfor %}', self.data
+        )
+        args = [template, data, "-o", tmp_path / "out.txt", "--max-output-bytes", "1K"]
+        if cached:
+            args += ["--cache-dir", tmp_path / "cache"]
+
+        assert _run_main(monkeypatch, *args) == 1
+        assert "output exceeds --max-output-bytes of 1.0K" in capsys.readouterr().err
+        assert len(calls) < 1000
+        assert not (tmp_path / "out.txt").exists()
+
+    @pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs RLIMIT_AS")
+    def test_max_memory(self, render_setup):
+        import subprocess
+
+        template, data = render_setup("{{ 'x' * 4 * 1024 ** 3 }}", self.data)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+        result = subprocess.run(
+            [sys.executable, "-m", "jinja2cli.cli", str(template), str(data), "--max-memory", "1G"],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        assert result.returncode == 1
+        assert "MemoryLimitExceeded: exceeded --max-memory of 1.0G" in result.stderr
+
+
+class TestRenderLimits:
+    """Test --timeout, --sandbox and --max-operations"""
+
+    quadratic = "{% for i in range(100000) %}{% for j in range(100000) %}{% endfor %}{% endfor %}"
+
+    data = '{"names": ["a", "b"]}'
+
+    def test_timeout(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup(self.quadratic, self.data)
+
+        assert _run_main(monkeypatch, template, data, "--timeout", "0.2") == 1
+        assert "RenderTimeout: template.j2: render timed out after 0.2s" in capsys.readouterr().err
+
+    def test_timeout_is_per_output(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup(self.quadratic, self.data)
+        out = tmp_path / "out" / "{{ item }}.txt"
+
+        args = [template, data, "--each", "names", "-o", out, "--timeout", "0.2"]
+        assert _run_main(monkeypatch, *args) == 1
+        assert "a.txt: render timed out" in capsys.readouterr().err
+
+    def test_sandbox(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ names.__class__.__mro__ }}", self.data)
+
+        assert _run_main(monkeypatch, template, data, "--sandbox", "--strict") == 1
+        assert "SecurityError: access to attribute '__class__'" in capsys.readouterr().err
+
+    def test_max_operations(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup(self.quadratic, self.data)
+
+        assert _run_main(monkeypatch, template, data, "--max-operations", "300000") == 1
+        err = capsys.readouterr().err
+        assert "OperationBudgetExceeded: render exceeded --max-operations of 300000" in err
+
+    def test_sandbox_deadline(self):
+        env = cli.make_sandbox()
+        template = env.from_string(self.quadratic)
+        env.reset_budget(timeout=0.2)  # ty: ignore[unresolved-attribute] - typed as a plain Environment
+        with pytest.raises(cli.RenderTimeout):
+            template.render()
+
+    def test_render_with_limits(self, render_setup):
+        template, _ = render_setup("{% for n in names %}{{ n.upper() }}{% endfor %}", self.data)
+        assert cli.render(str(template), {"names": ["a", "b"]}, [], max_operations=10) == "AB"
+        with pytest.raises(cli.OperationBudgetExceeded):
+            cli.render(str(template), {"names": list("abcdefghijklmnop")}, [], max_operations=10)
+
+
+class TestIndexedLoader:
+    """Test looking templates up in a prebuilt index with --index-templates"""
+
+    def _setup(self, render_setup):
+        template, data = render_setup(
+            '{% from "macros/greet.j2" import greet %}{{ greet(name) }} {% include "shared.j2" %}',
+            '{"name": "matt"}',
+        )
+        first = template.parent / "first"
+        second = template.parent / "second"
+        (second / "macros").mkdir(parents=True)
+        first.mkdir()
+        (first / "shared.j2").write_text("first")
+        (second / "shared.j2").write_text("second")
+        (second / "macros" / "greet.j2").write_text("{% macro greet(n) %}hi {{ n }}{% endmacro %}")
+        return template, data, first, second
+
+    def test_lookup_matches_filesystem_loader(self, render_setup, monkeypatch, capsys):
+        template, data, first, second = self._setup(render_setup)
+        args = [template, data, "-I", first, "-I", second]
+
+        assert _run_main(monkeypatch, *args) == 0
+        expected = capsys.readouterr().out
+        assert expected == "hi matt first"
+        assert _run_main(monkeypatch, *args, "--index-templates") == 0
+        assert capsys.readouterr().out == expected
+
+    def test_missing_template(self, tmp_path):
+        from jinja2 import Environment, TemplateNotFound
+
+        loader = cli.make_indexed_loader([str(tmp_path)])
+        with pytest.raises(TemplateNotFound):
+            Environment(loader=loader).get_template("nope.j2")
+
+    def test_persisted_index(self, tmp_path, render_setup, monkeypatch):
+        from jinja2 import Environment
+
+        _, _, first, second = self._setup(render_setup)
+        index_file = str(tmp_path / "index.json")
+        loader = cli.make_indexed_loader([str(first), str(second)], index_file=index_file)
+        env = Environment(loader=loader)
+        assert env.get_template("macros/greet.j2").render() == ""
+        assert env.get_template("shared.j2").render() == "first"
+
+        # Reused as long as no directory changed
+        def scandir(*args, **kwargs):
+            raise AssertionError("should have used the saved index")
+
+        monkeypatch.setattr(os, "scandir", scandir)
+        loader = cli.make_indexed_loader([str(first), str(second)], index_file=index_file)
+        assert Environment(loader=loader).get_template("shared.j2").render() == "first"
+        monkeypatch.undo()
+
+        (second / "macros" / "new.j2").write_text("new")
+        loader = cli.make_indexed_loader([str(first), str(second)], index_file=index_file)
+        assert Environment(loader=loader).get_template("macros/new.j2").render() == "new"
+
+    def test_removed_template_falls_back(self, render_setup):
+        from jinja2 import Environment
+
+        _, _, first, second = self._setup(render_setup)
+        loader = cli.make_indexed_loader([str(first), str(second)])
+        assert Environment(loader=loader).get_template("shared.j2").render() == "first"
+        (first / "shared.j2").unlink()
+        assert Environment(loader=loader).get_template("shared.j2").render() == "second"
+
+    @pytest.mark.skipif(not hasattr(os, "symlink"), reason="needs symlinks")
+    def test_symlink_loop(self, render_setup):
+        from jinja2 import Environment
+
+        _, _, first, second = self._setup(render_setup)
+        (second / "loop").symlink_to(second)
+        loader = cli.make_indexed_loader([str(first), str(second)])
+        assert loader.list_templates() == ["macros/greet.j2", "shared.j2"]
+        assert Environment(loader=loader).get_template("loop/loop/shared.j2").render() == "second"
+
+
+class TestTemplateProfiler:
+    """Test the per-line template profiler"""
+
+    def test_report(self, tmp_path, monkeypatch, capsys):
+        (tmp_path / "base.j2").write_text("<html>\n{% block content %}{% endblock %}\n</html>\n")
+        (tmp_path / "row.j2").write_text("{{ r | upper }}\n")
+        template = tmp_path / "page.j2"
+        template.write_text(
+            '{% extends "base.j2" %}\n'
+            "{% macro cell(r) %}<td>{{ r }}</td>{% endmacro %}\n"
+            "{% block content %}\n"
+            "{% for r in rows %}\n"
+            "{{ cell(r) }}\n"
+            '{% include "row.j2" %}\n'
+            "{% endfor %}\n"
+            "{% endblock %}\n"
+        )
+        data = tmp_path / "data.json"
+        data.write_text('{"rows": ["a", "b", "c"]}')
+        trace = sys.gettrace()
+
+        assert _run_main(monkeypatch, template, data, "--profile-template") == 0
+        captured = capsys.readouterr()
+        assert "<td>a</td>" in captured.out
+        assert sys.gettrace() is trace
+
+        lines = captured.err.splitlines()
+        assert any(line.endswith('page.j2:6  {% include "row.j2" %}') for line in lines)
+        assert any(line.endswith("row.j2:1  {{ r | upper }}") for line in lines)
+        functions = {" ".join(line.split()[3:]): line.split()[2] for line in lines if "s " in line}
+        assert functions["page.j2 macro cell"] == "3"
+        assert functions["page.j2 block content"] == "1"
+        assert functions["row.j2 (template)"] == "3"
+        assert lines[-1].startswith("total render time: ")
+
+
+class TestFilterStats:
+    """Test filter call metrics and --memoize-filter"""
+
+    def test_memoize(self):
+        calls = []
+
+        def slow(value, suffix="!"):
+            calls.append(value)
+            return f"{value}{suffix}"
+
+        filters: dict[str, Callable[..., Any]] = {"slow": slow}
+        stats = cli.FilterStats(timed=True, memoize=["slow"], memo_size=2)
+        stats.instrument(filters)
+
+        assert [filters["slow"](v) for v in "aabab"] == ["a!", "a!", "b!", "a!", "b!"]
+        assert filters["slow"]("a", suffix="?") == "a?"
+        assert filters["slow"](["a"]) == "['a']!"
+        assert calls == ["a", "b", "a", ["a"]]
+        assert filters["slow"].__name__ == "slow"
+
+        import io
+
+        out = io.StringIO()
+        stats.report(file=out)
+        lines = out.getvalue().splitlines()
+        assert lines[1].split()[0] == "7"
+        assert lines[1].split()[3:] == ["42.9%", "slow"]
+        assert lines[2] == "slow: 1 calls with unhashable arguments weren't cached"
+
+    def test_memoize_keeps_types_apart(self):
+        from markupsafe import Markup
+
+        filters: dict[str, Callable[..., Any]] = {"ident": lambda value: value}
+        cli.FilterStats(memoize=["ident"]).instrument(filters)
+        assert type(filters["ident"]("<b>")) is str
+        assert type(filters["ident"](Markup("<b>"))) is Markup
+
+        filters = {"pick": lambda value, x: x}
+        cli.FilterStats(memoize=["pick"]).instrument(filters)
+        assert type(filters["pick"](None, x=1)) is int
+        assert type(filters["pick"](None, x=True)) is bool
+
+    def test_cli(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup(
+            "{% for n in names %}{{ n | upper }}{% endfor %}", '{"names": ["a", "b", "a", "a"]}'
+        )
+
+        args = [template, data, "--filter-stats", "--memoize-filter", "upper"]
+        assert _run_main(monkeypatch, *args) == 0
+        captured = capsys.readouterr()
+        assert captured.out == "ABAA"
+        calls, _, _, hit_rate, name = captured.err.splitlines()[1].split()
+        assert (calls, hit_rate, name) == ("4", "50.0%", "upper")
+
+    @pytest.mark.parametrize(
+        "name, message",
+        [("nope", "unknown filter: nope"), ("attr", "attr is passed the environment or context")],
+    )
+    def test_invalid(self, render_setup, monkeypatch, capsys, name, message):
+        template, data = render_setup("x")
+
+        assert _run_main(monkeypatch, template, data, "--memoize-filter", name) == 1
+        assert message in capsys.readouterr().err
+
+
+class TestShard:
+    """Test splitting --each runs with --shard"""
+
+    data = json.dumps({"items": [f"n{n}" for n in range(50)]})
+
+    def test_shards_partition_outputs(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", self.data)
+        out = tmp_path / "out"
+        args = [template, data, "--each", "items", "-o", f"{out}/{{{{ item }}}}.txt"]
+        rendered: list[str] = []
+        for i in range(1, 4):
+            assert _run_main(monkeypatch, *args, "--shard", f"{i}/3") == 0
+            names = sorted(p.name for p in out.iterdir() if p.name not in rendered)
+            assert names
+            rendered.extend(names)
+        assert sorted(rendered) == sorted(f"n{n}.txt" for n in range(50))
+
+    def test_stable_assignment(self):
+        shard = cli.Shard(0, 4)
+        assert [shard.shard_of(f"out/{n}.txt") for n in range(8)] == [
+            cli.Shard.stable_hash(f"out/{n}.txt") % 4 for n in range(8)
+        ]
+        assert shard.shard_of("out/0.txt") == cli.Shard(3, 4).shard_of("out/0.txt")
+
+    def test_timings_balance_shards(self):
+        timings = {"a": 10.0, "b": 6.0, "c": 5.0, "d": 1.0}
+        shards = [cli.Shard(i, 2, timings) for i in range(2)]
+        owned = [sorted(p for p in timings if shard.owns(p)) for shard in shards]
+        assert owned == [["a", "d"], ["b", "c"]]
+
+    def test_record_timings(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", self.data)
+        timings = tmp_path / "timings.json"
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+        args = [template, data, "--each", "items", "-o", out, "--record-timings", timings]
+
+        assert _run_main(monkeypatch, *args, "--shard", "1/2") == 0
+        assert _run_main(monkeypatch, *args, "--shard", "2/2") == 0
+        recorded = json.loads(timings.read_text())
+        assert sorted(recorded) == sorted(f"{tmp_path}/out/n{n}.txt" for n in range(50))
+
+        # Measured timings are noisy, make one output outweigh all the others
+        recorded = {path: 1.0 for path in recorded}
+        recorded[f"{tmp_path}/out/n7.txt"] = 100.0
+        timings.write_text(json.dumps(recorded))
+        (tmp_path / "out").rename(tmp_path / "old")
+        args = [template, data, "--each", "items", "-o", out, "--shard-timings", timings]
+        assert _run_main(monkeypatch, *args, "--shard", "1/2") == 0
+        assert [p.name for p in (tmp_path / "out").iterdir()] == ["n7.txt"]
+
+    @pytest.mark.parametrize("value", ["0/2", "3/2", "1", "a/b", "1/0"])
+    def test_invalid(self, render_setup, monkeypatch, capsys, value):
+        template, data = render_setup("{{ item }}", self.data)
+        args = [template, data, "--each", "items", "-o", "x", "--shard", value]
+        assert _run_main(monkeypatch, *args) == 2
+        assert "invalid shard" in capsys.readouterr().err
+
+
+class TestCompactData:
+    """Test --compact-data and --compact-records"""
+
+    @staticmethod
+    def _records():
+        # Fresh every time, compacting works in place
+        return [{"name": f"host{n}", "role": "web", "port": 80} for n in range(5)]
+
+    def test_strings_are_shared(self):
+        compactor = cli.Compactor(records=False)
+        # Equal to the literal, but separate objects
+        web = b"web".decode()
+        first = compactor.compact({"a": {"role": "web"}, "b": [b"web".decode()]})
+        second = compactor.compact({"c": web})
+        assert first == {"a": {"role": "web"}, "b": ["web"]}
+        assert first["a"]["role"] is first["b"][0] is second["c"]
+
+    def test_records_become_rows(self):
+        rows = cli.Compactor().compact(self._records())
+        assert all(isinstance(row, cli.RecordRow) for row in rows)
+        assert rows == self._records()
+        assert rows[1]["name"] == "host1"
+        assert rows[1].get("nope", 1) == 1
+        assert list(rows[1].items()) == list(self._records()[1].items())
+        assert repr(rows[1]) == repr(self._records()[1])
+
+    def test_mixed_lists_stay_dicts(self):
+        mixed = [*self._records(), {"name": "x"}]
+        assert all(type(row) is dict for row in cli.Compactor().compact(mixed))
+        short = self._records()[:2]
+        assert all(type(row) is dict for row in cli.Compactor().compact(short))
+
+    def test_rows_pickle(self):
+        import pickle
+
+        rows = cli.Compactor().compact(self._records())
+        assert pickle.loads(pickle.dumps(rows)) == self._records()
+
+    def test_cli(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup(
+            "{% for h in hosts %}{{ h.name }}:{{ h['port'] }} {% endfor %}"
+            "{{ hosts | map(attribute='role') | unique | join }} {{ hosts[0] | tojson }}",
+            {"hosts": self._records()},
+        )
+
+        assert _run_main(monkeypatch, template, data) == 0
+        expected = capsys.readouterr().out
+        assert _run_main(monkeypatch, template, data, "--compact-records") == 0
+        assert capsys.readouterr().out == expected
+
+    def test_fan_out_over_rows(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup(
+            "{{ role }} {{ port }}", json.dumps({"hosts": self._records()})
+        )
+        out = tmp_path / "out" / "{{ name }}.txt"
+
+        args = [template, data, "--each", "hosts", "-o", out, "--compact-records"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert (tmp_path / "out" / "host3.txt").read_text() == "web 80"
+
+
+class TestSection:
+    """Test pushing -s/--section down into loading"""
+
+    @staticmethod
+    def _doc():
+        return {"envs": {"prod": {"web": {"port": 80}, "db": {"port": 5432}}}, "a.b": {"port": 1}}
+
+    def test_select_section(self):
+        assert cli.select_section(self._doc(), "envs.prod.web") == (True, {"port": 80})
+        assert cli.select_section(self._doc(), "a.b") == (True, {"port": 1})
+        assert cli.select_section(self._doc(), "envs.dev") == (False, None)
+        assert cli.select_section(["x"], "envs") == (False, None)
+
+    def test_stream_section(self, tmp_path):
+        pytest.importorskip("ijson")
+        data = tmp_path / "data.json"
+        data.write_text(json.dumps(self._doc()))
+        assert cli.stream_section(str(data), "envs.prod.web") == (True, {"port": 80})
+        assert cli.stream_section(str(data), "a.b") == (True, {"port": 1})
+        assert cli.stream_section(str(data), "envs.dev") == (False, None)
+        assert not cli.can_stream_section("envs.item")
+
+    def test_documents_are_pruned_before_merging(self, tmp_path):
+        base = tmp_path / "base.json"
+        base.write_text(json.dumps(self._doc()))
+        override = tmp_path / "override.yaml"
+        override.write_text("envs:\n  prod:\n    web:\n      host: w1\n  dev: {}\n")
+        other = tmp_path / "other.json"
+        other.write_text('{"unrelated": 1}')
+
+        files = [str(base), str(other), str(override)]
+        data = cli.load_data(files, "auto", section="envs.prod.web")
+        assert data == {"port": 80, "host": "w1"}
+        assert cli.load_data([str(base)], "auto", section="a.b") == {"port": 1}
+
+    def test_streamed_miss_isnt_parsed_again(self, tmp_path, monkeypatch):
+        pytest.importorskip("ijson")
+        base = tmp_path / "base.json"
+        base.write_text(json.dumps(self._doc()))
+        other = tmp_path / "other.json"
+        other.write_text('{"unrelated": 1}')
+
+        def parse_data(*args):
+            raise AssertionError("parsed in full")
+
+        monkeypatch.setattr(cli, "parse_data", parse_data)
+        assert cli.load_data([str(base), str(other)], "auto", section="envs") == self._doc()["envs"]
+
+    def test_errors(self, tmp_path):
+        data = tmp_path / "data.json"
+        data.write_text(json.dumps(self._doc()))
+        with pytest.raises(cli.InvalidUsage, match="unknown section: envs.dev"):
+            cli.load_data([str(data)], "auto", section="envs.dev")
+        with pytest.raises(cli.InvalidUsage, match="not a mapping"):
+            cli.load_data([str(data)], "auto", section="envs.prod.web.port")
+
+    def test_cli(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ port }} {{ host }}", json.dumps(self._doc()))
+
+        args = [template, data, "-s", "envs.prod.web", "-D", "host=w1"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().out == "80 w1"
+
+
+class TestFragmentCache:
+    """Test the {% cache %} extension enabled with -e cache"""
+
+    source = "{% for h in hosts %}{% cache h.role %}{{ h.role }}{{ counter() }} {% endcache %}{% endfor %}"
+
+    def _env(self, **kwargs):
+        from jinja2 import Environment
+
+        env = Environment(extensions=[cli.fragment_cache_extension()], **kwargs)
+        calls = iter(range(100))
+        env.globals["counter"] = lambda: next(calls)  # ty: ignore[invalid-assignment] - jinja2's globals dict is unannotated
+        return env
+
+    def test_renders_once_per_key(self):
+        env = self._env()
+        hosts = [{"role": "web"}, {"role": "db"}, {"role": "web"}]
+        assert env.from_string(self.source).render(hosts=hosts) == "web0 db1 web0 "
+        assert env.fragment_cache.hits == 1
+        assert env.fragment_cache.misses == 2
+
+    def test_blocks_dont_share_entries(self):
+        env = self._env()
+        template = env.from_string("{% cache 1 %}a{% endcache %}{% cache 1 %}b{% endcache %}")
+        assert template.render() == "ab"
+
+    def test_lru(self):
+        env = self._env()
+        env.fragment_cache.size = 1
+        hosts = [{"role": "web"}, {"role": "db"}, {"role": "web"}]
+        assert env.from_string(self.source).render(hosts=hosts) == "web0 db1 web2 "
+
+    def test_disk_store_keeps_markup(self, tmp_path):
+        for _ in range(2):
+            env = self._env(autoescape=True)
+            env.fragment_cache.directory = str(tmp_path)
+            template = env.from_string("{% cache key %}<b>{{ counter() }}{% endcache %}")
+            assert template.render(key="k") == "<b>0"
+        assert env.fragment_cache.hits == 1
+
+    def test_disk_entries_expire(self, tmp_path):
+        for ttl in (60, 0):
+            env = self._env()
+            env.fragment_cache.directory = str(tmp_path)
+            env.fragment_cache.ttl = ttl
+            assert env.from_string("{% cache 1 %}{{ counter() }}{% endcache %}").render() == "0"
+        assert env.fragment_cache.misses == 1
+        assert env.fragment_cache.hits == 0
+
+    def test_autoescape_doesnt_share_entries(self, tmp_path):
+        from jinja2 import select_autoescape
+
+        env = self._env(autoescape=select_autoescape(default_for_string=False))
+        env.fragment_cache.directory = str(tmp_path)
+        source = "{% cache key %}<i>{{ '&' }}</i>{% endcache %}"
+        assert env.from_string(source).render(key="k") == "<i>&</i>"
+        env.fragment_cache.entries.clear()
+        html = env.from_string("{% autoescape true %}" + source + "{% endautoescape %}")
+        assert html.render(key="k") == "<i>&amp;</i>"
+        assert env.fragment_cache.misses == 2
+
+    def test_undefined_key(self):
+        from jinja2 import StrictUndefined, UndefinedError
+
+        template = self._env().from_string("{% cache key %}{{ counter() }}{% endcache %}")
+        with pytest.raises(UndefinedError, match="'key' is undefined"):
+            template.render()
+        template = self._env(undefined=StrictUndefined).from_string(
+            "{% cache key.missing %}{% endcache %}"
+        )
+        with pytest.raises(UndefinedError, match="has no attribute 'missing'"):
+            template.render(key={})
+
+    def test_cli(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup(
+            self.source.replace("{{ counter() }}", ""),
+            '{"hosts": [{"role": "web"}, {"role": "web"}]}',
+        )
+        store = tmp_path / "fragments"
+
+        args = [template, data, "-e", "cache", "--fragment-cache-dir", store]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().out == "web web "
+        assert len([p for p in store.rglob("*") if p.is_file()]) == 1
+
+        # Written, then evicted once the run is over
+        store = tmp_path / "evicted"
+        args = [template, data, "-e", "cache", "--fragment-cache-dir", store]
+        assert _run_main(monkeypatch, *args, "--cache-max-size", "0") == 0
+        assert capsys.readouterr().out == "web web "
+        assert store.is_dir()
+        assert not [p for p in store.rglob("*") if p.is_file()]
+
+    def test_options_require_extension(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("x")
+
+        assert _run_main(monkeypatch, template, data, "--fragment-cache-size", "10") == 1
+        assert "require -e cache" in capsys.readouterr().err
+
+
+class TestRemoteData:
+    """Test data files given as http:// URLs"""
+
+    @pytest.fixture
+    def server(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Server(ThreadingHTTPServer):
+            def __init__(self):
+                super().__init__(("127.0.0.1", 0), Handler)
+                self.base = f"http://127.0.0.1:{self.server_address[1]}"
+                self.routes = {
+                    "/data": ("application/json; charset=utf-8", b'{"name": "json"}'),
+                    "/data.yaml": ("application/octet-stream", b"name: yaml\n"),
+                    "/plain": ("text/plain", b"[app]\nname = ini\n"),
+                }
+                self.requests = []
+                self.barrier = None
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server = self.server
+                assert isinstance(server, Server)
+                server.requests.append((self.path, self.headers.get("If-None-Match")))
+                if server.barrier is not None:
+                    server.barrier.wait(timeout=5)
+                if self.path not in server.routes:
+                    self.send_error(404)
+                    return
+                content_type, body = server.routes[self.path]
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = Server()
+        thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+        thread.start()
+        yield httpd
+        httpd.shutdown()
+        httpd.server_close()
+
+    def test_format_from_content_type(self, server):
+        load = cli.load_data
+        assert load([f"{server.base}/data"], "auto") == {"name": "json"}
+        assert load([f"{server.base}/data.yaml"], "auto") == {"name": "yaml"}
+        assert load([f"{server.base}/plain"], "auto") == {"app": {"name": "ini"}}
+        assert cli.content_type_format("application/vnd.api+json") == "json"
+        assert cli.content_type_format("text/html") is None
+
+    def test_fetched_concurrently(self, server):
+        import threading
+
+        server.barrier = threading.Barrier(2)
+        data = cli.load_data([f"{server.base}/data.yaml", f"{server.base}/data"], "auto")
+        assert data == {"name": "json"}
+
+    def test_conditional_get(self, server, tmp_path, monkeypatch):
+        url = f"{server.base}/data"
+        remote = cli.RemoteData(str(tmp_path))
+        assert cli.load_data([url], "auto", remote=remote) == {"name": "json"}
+
+        def parse_data(*args):
+            raise AssertionError("unchanged data was parsed again")
+
+        monkeypatch.setattr(cli, "parse_data", parse_data)
+        remote = cli.RemoteData(str(tmp_path))
+        assert cli.load_data([url], "auto", remote=remote) == {"name": "json"}
+        assert server.requests == [("/data", None), ("/data", '"v1"')]
+
+    def test_errors(self, server):
+        with pytest.raises(cli.FetchError, match="HTTP 404"):
+            cli.load_data([f"{server.base}/missing"], "auto")
+
+    def test_cli(self, server, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ name }}", '{"name": "file", "other": 1}')
+
+        args = [template, data, f"{server.base}/data", "--url-cache", tmp_path / "urls"]
+        assert _run_main(monkeypatch, *args) == 0
+        assert capsys.readouterr().out == "json"
+
+
+class TestMetrics:
+    """Test writing run metrics with --metrics"""
+
+    def test_histograms_and_merge(self, tmp_path):
+        metrics = cli.Metrics(str(tmp_path / "m.json"))
+        metrics.observe("render", 0.003)
+        other = cli.Metrics(str(tmp_path / "other.json"))
+        other.observe("render", 20)
+        other.inc("errors_total", label="MalformedYAML")
+        metrics.merge(other.state())
+
+        histogram = metrics.histograms["render"]
+        assert histogram.count == 2
+        assert histogram.total == pytest.approx(20.003)
+        assert histogram.buckets[cli.Metrics.BUCKETS.index(0.005)] == 1
+        assert histogram.buckets[-1] == 1
+        assert metrics.counters == {("errors_total", "MalformedYAML"): 1}
+
+    def test_prometheus(self, tmp_path):
+        path = tmp_path / "m.prom"
+        metrics = cli.Metrics(str(path))
+        metrics.inc("renders_total", 3)
+        metrics.error(ValueError())
+        metrics.observe("render", 0.5)
+        metrics.write()
+
+        lines = path.read_text().splitlines()
+        assert "# TYPE jinja2_renders_total counter" in lines
+        assert "jinja2_renders_total 3" in lines
+        assert 'jinja2_errors_total{type="ValueError"} 1' in lines
+        assert 'jinja2_render_seconds_bucket{le="0.25"} 0' in lines
+        assert 'jinja2_render_seconds_bucket{le="0.5"} 1' in lines
+        assert 'jinja2_render_seconds_bucket{le="+Inf"} 1' in lines
+        assert "jinja2_render_seconds_count 1" in lines
+
+    def test_cli(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", '{"names": ["a", "bb"]}')
+        path = tmp_path / "m.json"
+
+        out = tmp_path / "out" / "{{ item }}.txt"
+        args = [template, data, "--each", "names", "-o", out, "--metrics", path]
+        assert _run_main(monkeypatch, *args, "--cache-dir", tmp_path / "cache") == 0
+        assert _run_main(monkeypatch, *args, "--cache-dir", tmp_path / "cache") == 0
+
+        metrics = json.loads(path.read_text())
+        assert metrics["counters"]["bytes_written_total"] == 3
+        assert metrics["counters"].get("renders_total", 0) == 0
+        assert metrics["cache_hit_rates"] == {"render": 1.0}
+        assert metrics["histograms"]["parse_seconds"]["count"] == 1
+
+    def test_errors_by_class(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ nope }}")
+        path = tmp_path / "m.json"
+
+        assert _run_main(monkeypatch, template, data, "--strict", "--metrics", path) == 1
+        assert json.loads(path.read_text())["counters"]["errors_total"] == {"UndefinedError": 1}
+
+    def test_interval(self, tmp_path, monkeypatch):
+        metrics = cli.Metrics(str(tmp_path / "m.json"), interval=60)
+        metrics.tick()
+        assert not (tmp_path / "m.json").exists()
+        metrics.interval = 0.000001
+        metrics.tick()
+        assert (tmp_path / "m.json").exists()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+class TestJobs:
+    """Test rendering --each outputs in forked workers with -j/--jobs"""
+
+    data = json.dumps({"items": [f"n{n}" for n in range(20)]})
+
+    def test_all_outputs_rendered(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item }}", self.data)
+        out = tmp_path / "out"
+        args = [
+            template,
+            data,
+            "--each",
+            "items",
+            "-o",
+            f"{out}/{{{{ item }}}}.txt",
+            "--if-changed",
+        ]
+
+        assert _run_main(monkeypatch, *args, "-j", "3") == 0
+        assert sorted(p.name for p in out.iterdir()) == sorted(f"n{n}.txt" for n in range(20))
+        assert (out / "n7.txt").read_text() == "n7"
+        assert capsys.readouterr().err == "20 changed, 0 unchanged\n"
+
+    def test_manifest(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", self.data)
+        manifest = tmp_path / "manifest.json"
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+        args = [template, data, "--each", "items", "-o", out, "--manifest", manifest, "-j", "2"]
+
+        assert _run_main(monkeypatch, *args) == 0
+        recorded = json.loads(manifest.read_text())
+        assert len(recorded["outputs"]) == 20
+        assert str(template) in recorded["inputs"]
+
+    def test_metrics(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}", self.data)
+        metrics = tmp_path / "metrics.json"
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+        args = [template, data, "--each", "items", "-o", out, "--metrics", metrics, "-j", "2"]
+
+        assert _run_main(monkeypatch, *args) == 0
+        recorded = json.loads(metrics.read_text())
+        assert recorded["counters"]["renders_total"] == 20
+        assert recorded["counters"]["bytes_written_total"] == 50
+        assert recorded["histograms"]["render_seconds"]["count"] == 20
+        assert recorded["histograms"]["parse_seconds"]["count"] == 1
+
+    def test_cache_eviction(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item }}{{ 'x' * 1000 }}", self.data)
+        cache = tmp_path / "cache"
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+        args = [template, data, "--each", "items", "-o", out, "-j", "2"]
+
+        assert _run_main(monkeypatch, *args, "--cache-dir", cache, "--cache-max-size", "10K") == 0
+        sizes = [p.stat().st_size for p in cache.rglob("*") if p.is_file()]
+        # Workers only put entries, the parent still evicts once they're done
+        assert 0 < sum(sizes) <= 10 * 1024
+
+    def test_worker_error(self, tmp_path, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item if item != 'n5' else undefined_name.x }}", self.data)
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+
+        assert _run_main(monkeypatch, template, data, "--each", "items", "-o", out, "-j", "2") == 1
+        err = capsys.readouterr().err
+        assert err.startswith("RenderWorkerError: worker 2: UndefinedError: ")
+        # Where in the template it failed, as a single process would report it
+        assert err.endswith(f"({template}:1)\n")
+
+    def test_worker_error_metrics(self, tmp_path, render_setup, monkeypatch):
+        template, data = render_setup("{{ item if item != 'n5' else undefined_name.x }}", self.data)
+        metrics = tmp_path / "metrics.json"
+        out = f"{tmp_path}/out/{{{{ item }}}}.txt"
+        args = [template, data, "--each", "items", "-o", out, "--metrics", metrics, "-j", "2"]
+
+        assert _run_main(monkeypatch, *args) == 1
+        recorded = json.loads(metrics.read_text())
+        assert recorded["counters"]["errors_total"] == {"UndefinedError": 1}
+        # Worker 2 got as far as n5, its third item
+        assert recorded["counters"]["renders_total"] == 10 + 3
+
+    def test_fork_failure_unfreezes(self, monkeypatch):
+        import gc
+
+        def fork():
+            raise OSError("Resource temporarily unavailable")
+
+        monkeypatch.setattr(os, "fork", fork)
+        with pytest.raises(OSError):
+            cli.fork_workers(2, lambda index: index)
+        assert gc.get_freeze_count() == 0
+
+    def test_requires_each(self, render_setup, monkeypatch, capsys):
+        template, data = render_setup("{{ item }}", self.data)
+
+        assert _run_main(monkeypatch, template, data, "-j", "2") == 1
+        assert "--jobs requires --each" in capsys.readouterr().err